@@ -0,0 +1,88 @@
+# =====================
+# Benchmark dos backends XML (ElementTree e lxml) sobre o mesmo corpus sintético
+# Para cada backend, lê cada XML (carregar_documento: parse e metadados) e edita com todas as
+# alterações ligadas (_editar_documento: buscas, edição e serialização), sem gravar nada em disco.
+# Termina com código 1 se algum arquivo gerado for diferente entre os backends.
+# Uso: python benchmarks/bench_backend.py [--arquivos 2000] [--itens 3] [--repeticoes 3] [--pasta /tmp/corpus]
+# =====================
+
+import argparse
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import manipuladorXML as m  # noqa: E402
+from bench_pipeline import constantes_benchmark  # noqa: E402
+from gerador_corpus import gerar_corpus  # noqa: E402
+
+
+# Contexto de edição como o de editar_arquivos, com saída externa para receber o XML gerado
+def montar_contexto(pasta, constantes):
+    contexto = m._montar_contexto_edicao(constantes, sincronizar=False, saida_externa=True)
+    documentos = m.carregar_documentos(pasta, manter_arvores=False)
+    chave_mapping, grafo, chave_da_venda_nova = m._prepara_mapeamentos(
+        documentos, contexto['alterar_emitente'], contexto['alterar_data'], contexto['execucao'])
+    contexto.update(chave_mapping=chave_mapping, grafo=grafo, chave_da_venda_nova=chave_da_venda_nova)
+    return contexto
+
+
+# Tempos de leitura e de edição (melhor de 'repeticoes') e o XML gerado de cada arquivo
+def medir(backend, arquivos, contexto, repeticoes):
+    m.configurar_backend_xml(backend)
+    melhor_leitura = melhor_edicao = float('inf')
+    for _ in range(repeticoes):
+        leitura = edicao = 0.0
+        gerados = {}
+        for caminho in arquivos:
+            inicio = time.perf_counter()
+            documento = m.carregar_documento(caminho)
+            meio = time.perf_counter()
+            _, _, erro, _, _, conteudo = m._editar_documento(documento, contexto)
+            edicao += time.perf_counter() - meio
+            leitura += meio - inicio
+            gerados[caminho] = erro or conteudo
+        melhor_leitura, melhor_edicao = min(melhor_leitura, leitura), min(melhor_edicao, edicao)
+    return melhor_leitura, melhor_edicao, gerados
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark dos backends XML do ManipuladorXML")
+    parser.add_argument('--arquivos', type=int, default=2000, help="Quantidade de XMLs do corpus.")
+    parser.add_argument('--itens', type=int, default=3, help="Máximo de itens <det> por NFe.")
+    parser.add_argument('--repeticoes', type=int, default=3, help="Repetições de cada backend (vale a melhor).")
+    parser.add_argument('--pasta', default=None, help="Pasta do corpus gerado (reaproveitada entre execuções).")
+    args = parser.parse_args()
+    if m.lxml_etree is None:
+        print("lxml não está instalado: só há o backend ElementTree para medir.")
+        sys.exit(0)
+
+    pasta_base = args.pasta or tempfile.mkdtemp(prefix='bench_backend_')
+    corpus = os.path.join(pasta_base, f'corpus_{args.arquivos}_{args.itens}')
+    try:
+        if not os.path.isdir(corpus):
+            gerar_corpus(corpus, args.arquivos, args.itens)
+        arquivos = sorted(os.path.join(corpus, nome) for nome in os.listdir(corpus) if nome.endswith('.xml'))
+        with open(os.devnull, 'w') as nulo, contextlib.redirect_stdout(nulo):
+            m.configurar_saida(0)
+            contexto = montar_contexto(corpus, constantes_benchmark())
+            resultados = {backend: medir(backend, arquivos, contexto, args.repeticoes) for backend in ('etree', 'lxml')}
+    finally:
+        if args.pasta is None:
+            shutil.rmtree(pasta_base, ignore_errors=True)
+
+    base = resultados['etree']
+    print(f"{len(arquivos)} arquivos, melhor de {args.repeticoes} repetições:")
+    for backend, (leitura, edicao, _) in resultados.items():
+        print(f"  {backend:6s} leitura {leitura:6.2f}s ({base[0] / leitura:4.2f}x)   "
+              f"edição e serialização {edicao:6.2f}s ({base[1] / edicao:4.2f}x)")
+    diferentes = [caminho for caminho in arquivos if resultados['lxml'][2][caminho] != base[2][caminho]]
+    if diferentes:
+        print(f"FALHA: {len(diferentes)} arquivo(s) com saída diferente entre os backends, por exemplo "
+              f"{os.path.basename(diferentes[0])}.")
+        sys.exit(1)
+    print("Saída idêntica byte a byte nos dois backends.")
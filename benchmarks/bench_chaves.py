@@ -0,0 +1,91 @@
+# =====================
+# Micro-benchmark: geração das novas chaves de acesso e validação dos DVs
+# Compara a montagem anterior (uma chave por vez, com o DV calculado em um laço sobre os 43
+# dígitos) com gerar_chaves/validar_chaves em lote, com NumPy (se instalado) e sem ele, e
+# confere se as chaves geradas e as validações são idênticas.
+# Uso: python benchmarks/bench_chaves.py [chaves] [repeticoes]
+# =====================
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import manipuladorXML as m  # noqa: E402
+from gerador_corpus import montar_chave  # noqa: E402
+
+NOVO_ANO_MES = '2403'
+NOVO_CNPJ = '78242849000169'
+
+
+# --- Implementação anterior, mantida apenas para comparação ---
+def calcular_dv_legado(chave):
+    soma, multiplicador = 0, 2
+    for i in range(len(chave) - 1, -1, -1):
+        soma += int(chave[i]) * multiplicador
+        multiplicador += 1
+        if multiplicador > 9:
+            multiplicador = 2
+    dv = 11 - soma % 11
+    return '0' if dv in [0, 1, 10, 11] else str(dv)
+
+
+def gerar_chaves_legado(chaves):
+    novas = []
+    for chave in chaves:
+        sem_dv = chave[:2] + NOVO_ANO_MES + NOVO_CNPJ + chave[20:43]
+        novas.append(sem_dv + calcular_dv_legado(sem_dv))
+    return novas
+
+
+def validar_chaves_legado(chaves):
+    return [bool(c) and len(c) == 44 and c.isdigit() and calcular_dv_legado(c[:43]) == c[43] for c in chaves]
+
+
+# Chaves válidas e, a cada 50, uma com o DV trocado (documento corrompido)
+def gerar_entradas(quantidade, semente=42):
+    rng = random.Random(semente)
+    chaves = [montar_chave(n) for n in range(1, quantidade + 1)]
+    for i in range(0, quantidade, 50):
+        chaves[i] = chaves[i][:43] + str((int(chaves[i][43]) + rng.randint(1, 9)) % 10)
+    return chaves
+
+
+def medir(funcao, chaves, repeticoes):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        resultado = funcao(chaves)
+    return resultado, (time.perf_counter() - inicio) / (repeticoes * len(chaves))
+
+
+if __name__ == '__main__':
+    quantidade = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    repeticoes = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    chaves = gerar_entradas(quantidade)
+    validas = [c for c in chaves if calcular_dv_legado(c[:43]) == c[43]]
+
+    implementacoes = {'legado': (gerar_chaves_legado, validar_chaves_legado)}
+    numpy = m.np
+    m.np = None
+    implementacoes['lote (Python)'] = (lambda c: m.gerar_chaves(c, NOVO_ANO_MES, NOVO_CNPJ), m.validar_chaves)
+    resultados = {nome: (medir(gerar, validas, repeticoes), medir(validar, chaves, repeticoes))
+                  for nome, (gerar, validar) in implementacoes.items()}
+    if numpy is not None:
+        m.np = numpy
+        resultados['lote (NumPy)'] = (medir(lambda c: m.gerar_chaves(c, NOVO_ANO_MES, NOVO_CNPJ), validas, repeticoes),
+                                      medir(m.validar_chaves, chaves, repeticoes))
+
+    (chaves_legado, _), (validacao_legado, _) = resultados['legado']
+    for nome, ((novas, _), (validacao, _)) in resultados.items():
+        assert novas == chaves_legado, f"{nome}: chaves geradas diferentes"
+        assert validacao == validacao_legado, f"{nome}: validação diferente"
+    print(f"{quantidade} chaves ({quantidade - len(validas)} com DV inválido): resultados idênticos."
+          + ("" if numpy is not None else " NumPy não instalado: só o caminho em Python puro foi medido."))
+
+    print(f"Tempo médio por chave ({repeticoes} repetições):")
+    (_, geracao_base), (_, validacao_base) = resultados['legado']
+    for nome, ((_, geracao), (_, validacao)) in resultados.items():
+        print(f"  {nome:14s} geração {geracao * 1e9:6.0f} ns ({geracao_base / geracao:5.2f}x)   "
+              f"validação {validacao * 1e9:6.0f} ns ({validacao_base / validacao:5.2f}x)")
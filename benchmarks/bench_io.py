@@ -0,0 +1,139 @@
+# =====================
+# Benchmark da edição com leitura antecipada e gravação em segundo plano (--threads-io)
+# Simula um disco lento ou uma pasta de rede: cada abertura de arquivo pelo manipuladorXML espera
+# a latência informada, e cada arquivo gravado espera de novo ao ser fechado (envio e confirmação).
+# Mede a etapa de edição (_executar_edicao, com diário e gravação atômica) sobre a mesma pasta, com
+# o laço sequencial atual e com cada quantidade de threads, sem latência e com ela, e confere se
+# os arquivos gerados são idênticos byte a byte.
+# Uso: python benchmarks/bench_io.py [--arquivos 1000] [--latencia-ms 2] [--threads 2,4,8]
+#      [--fila 64] [--pasta /tmp/corpus]
+# =====================
+
+import argparse
+import builtins
+import contextlib
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import manipuladorXML as m  # noqa: E402
+from bench_pipeline import constantes_benchmark  # noqa: E402
+from gerador_corpus import gerar_corpus  # noqa: E402
+
+
+# Arquivo aberto pelo manipuladorXML com a latência de um disco remoto na abertura e,
+# para arquivos gravados, também no fechamento
+class ArquivoLento:
+    def __init__(self, arquivo, latencia):
+        self._arquivo, self._latencia = arquivo, latencia
+
+    def __getattr__(self, nome):
+        return getattr(self._arquivo, nome)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excecao):
+        self.close()
+
+    def __iter__(self):
+        return iter(self._arquivo)
+
+    def close(self):
+        if self._arquivo.writable() and not self._arquivo.closed:
+            time.sleep(self._latencia)
+        self._arquivo.close()
+
+
+# Substitui o open usado pelo manipuladorXML (latência em segundos; 0 restaura o open normal)
+def injetar_latencia(latencia):
+    if not latencia:
+        m.__dict__.pop('open', None)
+        return
+
+    def abrir_lento(*args, **kwargs):
+        time.sleep(latencia)
+        return ArquivoLento(builtins.open(*args, **kwargs), latencia)
+    m.open = abrir_lento
+
+
+def hashes_pasta(pasta):
+    return {nome: hashlib.md5(open(os.path.join(pasta, nome), 'rb').read()).hexdigest()
+            for nome in sorted(os.listdir(pasta)) if nome.endswith('.xml')}
+
+
+# Edita uma cópia do corpus com a quantidade de threads de E/S; retorna (segundos, hashes dos XMLs)
+def medir(corpus, trabalho, constantes, threads, fila, latencia):
+    shutil.rmtree(trabalho, ignore_errors=True)
+    shutil.copytree(corpus, trabalho)
+    with open(os.devnull, 'w') as nulo, contextlib.redirect_stdout(nulo):
+        m.configurar_saida(0)
+        m.configurar_pipeline_io(threads, fila, fila)
+        documentos = m.carregar_documentos(trabalho, manter_arvores=False)
+        contexto = m._montar_contexto_edicao(constantes, sincronizar=False)
+        # Mesmo horário em todas as medições, para que as saídas possam ser comparadas
+        contexto['execucao'] = m.criar_contexto_execucao(constantes.get('data', {}).get('nova_data'),
+                                                         constantes.get('emitente'), agora=datetime(2024, 1, 1, 12))
+        chave_mapping, grafo, chave_da_venda_nova = m._prepara_mapeamentos(
+            documentos, contexto['alterar_emitente'], contexto['alterar_data'], contexto['execucao'],
+            contexto['regras']['vendas'])
+        contexto.update(chave_mapping=chave_mapping, grafo=grafo, chave_da_venda_nova=chave_da_venda_nova)
+        diario = m.abrir_diario(trabalho, 'editar', sincronizar=False)
+        injetar_latencia(latencia)
+        try:
+            inicio = time.perf_counter()
+            m._executar_edicao(documentos, contexto, diario=diario)
+            m.fechar_diario(diario)
+            segundos = time.perf_counter() - inicio
+        finally:
+            injetar_latencia(0)
+    return segundos, hashes_pasta(trabalho)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark da leitura e gravação em segundo plano do ManipuladorXML")
+    parser.add_argument('--arquivos', type=int, default=1000, help="Quantidade de XMLs do corpus.")
+    parser.add_argument('--itens', type=int, default=3, help="Máximo de itens <det> por NFe.")
+    parser.add_argument('--latencia-ms', type=float, default=2.0, help="Latência simulada por abertura e por gravação.")
+    parser.add_argument('--threads', default='2,4,8', help="Quantidades de threads de E/S, separadas por vírgula.")
+    parser.add_argument('--fila', type=int, default=64, help="Profundidade das filas de leitura e de gravação.")
+    parser.add_argument('--pasta', default=None, help="Pasta do corpus gerado (reaproveitada entre execuções).")
+    args = parser.parse_args()
+
+    constantes = constantes_benchmark()
+    pasta_base = args.pasta or tempfile.mkdtemp(prefix='bench_io_')
+    corpus = os.path.join(pasta_base, f'corpus_{args.arquivos}_{args.itens}')
+    trabalho = os.path.join(pasta_base, 'trabalho')
+    configuracoes = [0] + [int(n) for n in args.threads.split(',')]
+    resultados = {}
+    try:
+        if not os.path.isdir(corpus):
+            gerar_corpus(corpus, args.arquivos, args.itens)
+        for latencia in (0.0, args.latencia_ms / 1000):
+            for threads in configuracoes:
+                resultados[latencia, threads] = medir(corpus, trabalho, constantes, threads, args.fila, latencia)
+    finally:
+        shutil.rmtree(trabalho, ignore_errors=True)
+        if args.pasta is None:
+            shutil.rmtree(pasta_base, ignore_errors=True)
+
+    referencia = resultados[0.0, 0][1]
+    diferentes = [chave for chave, (_, hashes) in resultados.items() if hashes != referencia]
+    print(f"{args.arquivos} arquivos, filas de {args.fila}; edição com diário, sem fsync:")
+    for latencia in (0.0, args.latencia_ms / 1000):
+        base = resultados[latencia, 0][0]
+        print(f"  latência {latencia * 1000:4.1f} ms:")
+        for threads in configuracoes:
+            segundos = resultados[latencia, threads][0]
+            nome = 'sequencial' if threads == 0 else f'{threads} threads'
+            print(f"    {nome:12s} {segundos:7.2f}s  {args.arquivos / segundos:7.0f} arquivos/s  ({base / segundos:4.2f}x)")
+    if diferentes:
+        print(f"FALHA: saída diferente da execução sequencial em {len(diferentes)} configuração(ões).")
+        sys.exit(1)
+    print("Saída idêntica byte a byte em todas as configurações.")
@@ -0,0 +1,120 @@
+# =====================
+# Benchmark de memória para pastas muito grandes
+# Em um processo novo (para que o pico de RSS seja só desta medição), carrega os metadados de
+# um corpus sintético com a leitura incremental e monta os mapeamentos de chaves; com --completo,
+# executa renomeação e edição no modo de memória limitada sobre uma cópia do corpus.
+# Termina com código 1 se o pico de RSS, descontado o processo ocioso, passar do orçamento por arquivo.
+# Orçamentos padrão, medidos com 200 mil arquivos: 0,8 KB para os metadados (medido: 0,64 KB) e
+# 1,2 KB com --completo (medido: 0,96 KB, com o planejamento das renomeações e as infos reextraídas
+# na edição). Com poucos milhares de arquivos, a memória fixa da execução pesa no valor por arquivo.
+# Uso: python benchmarks/bench_memoria.py [--arquivos 200000] [--itens 3] [--orcamento-kb 0.8]
+#      [--pasta /tmp/corpus_memoria] [--completo]
+# =====================
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import manipuladorXML as m  # noqa: E402
+from bench_pipeline import constantes_benchmark  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Windows: sem ru_maxrss
+    resource = None
+
+
+_ORCAMENTO_KB = 0.8
+_ORCAMENTO_COMPLETO_KB = 1.2
+
+
+def pico_rss_mb():
+    escala = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / escala
+
+
+# Executada no processo filho: devolve (em JSON na saída padrão) o pico antes e depois
+def medir(pasta, completo):
+    base = pico_rss_mb()
+    inicio = time.perf_counter()
+    with open(os.devnull, 'w') as nulo, contextlib.redirect_stdout(nulo):
+        constantes = constantes_benchmark()
+        if completo:
+            documentos = m.processar_arquivos(pasta, sincronizar=False)
+            m.editar_arquivos(pasta, constantes, documentos, sincronizar=False)
+        else:
+            cfg = constantes['alterar']
+            documentos = m.carregar_documentos(pasta, manter_arvores=False)
+            execucao = m.criar_contexto_execucao(constantes.get('data', {}).get('nova_data'), constantes.get('emitente'))
+            m._prepara_mapeamentos(documentos, cfg.get('emitente'), cfg.get('data'), execucao)
+    return {
+        'arquivos': len(documentos),
+        'segundos': round(time.perf_counter() - inicio, 2),
+        'rss_base_mb': round(base, 1),
+        'rss_pico_mb': round(pico_rss_mb(), 1),
+    }
+
+
+def medir_em_processo(pasta, completo):
+    comando = [sys.executable, os.path.abspath(__file__), '--medir', pasta] + (['--completo'] if completo else [])
+    saida = subprocess.run(comando, capture_output=True, text=True, check=True).stdout
+    return json.loads(saida.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark de memória do ManipuladorXML")
+    parser.add_argument('--arquivos', type=int, default=200000, help="Quantidade de XMLs do corpus.")
+    parser.add_argument('--itens', type=int, default=3, help="Máximo de itens <det> por NFe.")
+    parser.add_argument('--orcamento-kb', type=float, default=None,
+                        help="Pico de RSS permitido por arquivo, em KB (padrão: 0.8, ou 1.2 com --completo).")
+    parser.add_argument('--pasta', default=None, help="Pasta do corpus gerado (reaproveitada entre execuções).")
+    parser.add_argument('--completo', action='store_true', help="Mede renomeação e edição com --memoria-limitada.")
+    parser.add_argument('--medir', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.orcamento_kb is None:
+        args.orcamento_kb = _ORCAMENTO_COMPLETO_KB if args.completo else _ORCAMENTO_KB
+    if resource is None:
+        print("Medição de RSS indisponível nesta plataforma.")
+        sys.exit(0)
+
+    if args.medir:
+        m.configurar_saida(0)
+        print(json.dumps(medir(args.medir, args.completo)))
+        sys.exit(0)
+
+    pasta_base = args.pasta or tempfile.mkdtemp(prefix='bench_memoria_')
+    corpus = os.path.join(pasta_base, f'corpus_{args.arquivos}_{args.itens}')
+    try:
+        if not os.path.isdir(corpus):
+            # Em outro processo: no Linux o pico de RSS do pai é herdado pelo filho da medição
+            print(f"Gerando {args.arquivos} XMLs em {corpus}...")
+            subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gerador_corpus.py'),
+                            corpus, str(args.arquivos), str(args.itens)], check=True, stdout=subprocess.DEVNULL)
+        pasta = corpus
+        if args.completo:
+            pasta = os.path.join(pasta_base, 'trabalho')
+            shutil.rmtree(pasta, ignore_errors=True)
+            # Também em outro processo, pelo mesmo motivo (copytree eleva o pico de RSS do pai)
+            subprocess.run([sys.executable, '-c', 'import shutil, sys; shutil.copytree(*sys.argv[1:])', corpus, pasta],
+                           check=True)
+        resultado = medir_em_processo(pasta, args.completo)
+    finally:
+        if args.pasta is None:
+            shutil.rmtree(pasta_base, ignore_errors=True)
+        elif args.completo:
+            shutil.rmtree(os.path.join(pasta_base, 'trabalho'), ignore_errors=True)
+
+    por_arquivo_kb = (resultado['rss_pico_mb'] - resultado['rss_base_mb']) * 1024 / resultado['arquivos']
+    print(f"{resultado['arquivos']} arquivos em {resultado['segundos']}s: RSS {resultado['rss_base_mb']} MB ocioso, "
+          f"pico {resultado['rss_pico_mb']} MB ({por_arquivo_kb:.2f} KB por arquivo, orçamento {args.orcamento_kb} KB)")
+    if por_arquivo_kb > args.orcamento_kb:
+        print("FALHA: pico de memória acima do orçamento.")
+        sys.exit(1)
@@ -0,0 +1,131 @@
+# =====================
+# Benchmark do fluxo completo sobre corpora sintéticos (gerador_corpus.py)
+# Mede separadamente processar_arquivos, _prepara_mapeamentos, editar_arquivos e _salvar_xml
+# para cada tamanho de corpus e acrescenta o resultado (JSON, uma linha por execução) ao
+# arquivo de histórico, para acompanhar regressões entre versões.
+# Uso: python benchmarks/bench_pipeline.py [--tamanhos 1000,10000,100000] [--itens 3]
+#      [--workers 1] [--sem-fsync] [--saida benchmarks/resultados_pipeline.jsonl]
+# =====================
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import manipuladorXML as m  # noqa: E402
+from gerador_corpus import gerar_corpus  # noqa: E402
+
+PASTA_BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+
+
+# Constantes de edição com todas as alterações ligadas (primeira empresa do constantes.json)
+def constantes_benchmark():
+    with open(os.path.join(os.path.dirname(PASTA_BENCHMARKS), 'constantes.json'), encoding='utf-8') as f:
+        constantes = next(iter(json.load(f).values()))
+    constantes['alterar'] = {chave: True for chave in constantes.get('alterar', {})}
+    return constantes
+
+
+def versao_codigo():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PASTA_BENCHMARKS,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cronometrar(funcao, *args, **kwargs):
+    inicio = time.perf_counter()
+    resultado = funcao(*args, **kwargs)
+    return resultado, time.perf_counter() - inicio
+
+
+# Tempo somado apenas das chamadas a _salvar_xml (o parse de cada arquivo não entra na conta)
+def medir_salvar_xml(pasta_origem, pasta_destino):
+    os.makedirs(pasta_destino, exist_ok=True)
+    total = 0.0
+    for nome in os.listdir(pasta_origem):
+        if not nome.endswith('.xml'):
+            continue
+        root = ET.parse(os.path.join(pasta_origem, nome), m._novo_parser()).getroot()
+        inicio = time.perf_counter()
+        m._salvar_xml(root, os.path.join(pasta_destino, nome))
+        total += time.perf_counter() - inicio
+    return total
+
+
+def medir_tamanho(quantidade, itens, workers, sincronizar, constantes, pasta_base):
+    corpus = os.path.join(pasta_base, f'corpus_{quantidade}')
+    trabalho = os.path.join(pasta_base, 'trabalho')
+    if not os.path.isdir(corpus):
+        gerar_corpus(corpus, quantidade, itens)
+    shutil.rmtree(trabalho, ignore_errors=True)
+    shutil.copytree(corpus, trabalho)
+    cfg = constantes['alterar']
+    etapas = {}
+
+    with open(os.devnull, 'w') as nulo, contextlib.redirect_stdout(nulo):
+        documentos, etapas['processar_arquivos'] = cronometrar(
+            m.processar_arquivos, trabalho, workers=workers, sincronizar=sincronizar)
+        _, etapas['_prepara_mapeamentos'] = cronometrar(
+            m._prepara_mapeamentos, documentos, cfg.get('emitente'), cfg.get('data'),
+            m.criar_contexto_execucao(constantes.get('data', {}).get('nova_data'), constantes.get('emitente')))
+        _, etapas['editar_arquivos'] = cronometrar(
+            m.editar_arquivos, trabalho, constantes, workers=workers, sincronizar=sincronizar)
+    etapas['_salvar_xml'] = medir_salvar_xml(trabalho, os.path.join(pasta_base, 'saida'))
+    shutil.rmtree(os.path.join(pasta_base, 'saida'), ignore_errors=True)
+
+    arquivos = len(documentos)
+    return {
+        'arquivos': arquivos,
+        'segundos': {etapa: round(tempo, 4) for etapa, tempo in etapas.items()},
+        'arquivos_por_segundo': {etapa: round(arquivos / tempo, 1) if tempo else None for etapa, tempo in etapas.items()},
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark do fluxo completo do ManipuladorXML")
+    parser.add_argument('--tamanhos', default='1000,10000,100000', help="Quantidades de arquivos, separadas por vírgula.")
+    parser.add_argument('--itens', type=int, default=3, help="Máximo de itens <det> por NFe.")
+    parser.add_argument('--workers', type=int, default=1, help="Processos usados por processar_arquivos/editar_arquivos.")
+    parser.add_argument('--sem-fsync', action='store_true', help="Desliga o fsync das gravações (sincronizar_disco=false).")
+    parser.add_argument('--pasta', default=None, help="Pasta para os corpora gerados (reaproveitados entre execuções).")
+    parser.add_argument('--saida', default=os.path.join(PASTA_BENCHMARKS, 'resultados_pipeline.jsonl'),
+                        help="Arquivo JSONL onde o resultado desta execução é acrescentado.")
+    args = parser.parse_args()
+
+    constantes = constantes_benchmark()
+    pasta_base = args.pasta or tempfile.mkdtemp(prefix='bench_manipuladorXML_')
+    execucao = {
+        'data': datetime.now().isoformat(timespec='seconds'),
+        'commit': versao_codigo(),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'workers': args.workers,
+        'itens_por_nfe': args.itens,
+        'fsync': not args.sem_fsync,
+        'resultados': [],
+    }
+    try:
+        for quantidade in (int(t) for t in args.tamanhos.split(',')):
+            resultado = medir_tamanho(quantidade, args.itens, args.workers, not args.sem_fsync, constantes, pasta_base)
+            execucao['resultados'].append(resultado)
+            tempos = ', '.join(f"{etapa} {tempo:.2f}s" for etapa, tempo in resultado['segundos'].items())
+            print(f"{resultado['arquivos']:>7} arquivos: {tempos}")
+    finally:
+        if args.pasta is None:
+            shutil.rmtree(pasta_base, ignore_errors=True)
+
+    with open(args.saida, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(execucao, ensure_ascii=False) + '\n')
+    print(f"Resultado acrescentado a {args.saida}")
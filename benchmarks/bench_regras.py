@@ -0,0 +1,150 @@
+# =====================
+# Micro-benchmark: avaliação das regras de renomeação e de CST/IPI
+# Compara a cadeia if/elif anterior (listas de CFOP, REMESSAS_CFOP + RETORNOS_CFOP montado a
+# cada item) com as regras compiladas (compilar_regras) sobre notas com CFOPs, natOp e xTexto
+# variados, e confere se os nomes gerados são idênticos. Também compara, com as regras padrão e
+# com regras extras, a tabela por CFOP com a leitura da lista de regras em ordem a cada nota.
+# Uso: python benchmarks/bench_regras.py [notas] [repeticoes] [regras_extras]
+# =====================
+
+import json
+import os
+import random
+from functools import partial
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import manipuladorXML as m  # noqa: E402
+from gerador_corpus import montar_chave  # noqa: E402
+
+NAT_OPS = [
+    'Venda de mercadoria', 'Devolucao de mercadorias', 'Retorno de mercadoria nao entregue',
+    'Outras Entradas - Retorno Simbolico de Deposito Temporario', 'Outras Entradas - Retorno de Deposito Temporario',
+    'Remessa para deposito temporario', 'Remessa simbolica',
+]
+X_TEXTOS = ['', 'DEVOLUTION_PLACES', 'SALE_DEVOLUTION', 'DEVOLUTION_devolution', 'Pedido 123 - SALE_DEVOLUTION', 'Outro texto']
+# CFOPs de todos os grupos e alguns fora deles (nenhuma regra)
+CFOPS = m.VENDAS_CFOP + m.DEVOLUCOES_CFOP + m.RETORNOS_CFOP + m.REMESSAS_CFOP + ['5910', '1102', '6910', '5202']
+
+
+# --- Implementação anterior, mantida apenas para comparação ---
+def gerar_novo_nome_legado(info):
+    cfop = info.get('cfop')
+    nat_op = info.get('nat_op', '')
+    ref_nfe = info.get('ref_nfe')
+    x_texto = info.get('x_texto', '')
+    nfe_number = info.get('nfe_number', '')
+    if cfop in m.DEVOLUCOES_CFOP and ref_nfe:
+        ref_nfe_num = ref_nfe[25:34].lstrip('0')
+        if nat_op == "Retorno de mercadoria nao entregue":
+            return f"{nfe_number} - Insucesso de entrega da venda {ref_nfe_num}.xml"
+        elif nat_op == "Devolucao de mercadorias":
+            if x_texto and ("DEVOLUTION_PLACES" in x_texto or "SALE_DEVOLUTION" in x_texto):
+                return f"{nfe_number} - Devoluçao pro Mercado Livre da venda - {ref_nfe_num}.xml"
+            elif x_texto and "DEVOLUTION_devolution" in x_texto:
+                return f"{nfe_number} - Devolucao da venda {ref_nfe_num}.xml"
+    elif cfop in m.VENDAS_CFOP:
+        return f"{nfe_number} - Venda.xml"
+    elif cfop in m.RETORNOS_CFOP and ref_nfe:
+        ref_nfe_num = ref_nfe[25:34].lstrip('0')
+        if nat_op == "Outras Entradas - Retorno Simbolico de Deposito Temporario":
+            return f"{nfe_number} - Retorno da remessa {ref_nfe_num}.xml"
+        elif nat_op == "Outras Entradas - Retorno de Deposito Temporario":
+            return f"{nfe_number} - Retorno Efetivo da remessa {ref_nfe_num}.xml"
+    elif cfop in m.REMESSAS_CFOP:
+        if ref_nfe:
+            return f"{nfe_number} - Remessa simbólica da venda {ref_nfe[25:34].lstrip('0')}.xml"
+        else:
+            return f"{nfe_number} - Remessa.xml"
+    return ''
+
+
+# Decisões por item da edição (CST e zeragem de IPI), como eram feitas antes
+def regras_item_legado(cfop, mapeamento_cst):
+    cst = list(mapeamento_cst[cfop].items()) if cfop in mapeamento_cst else None
+    return cst, cfop in m.REMESSAS_CFOP + m.RETORNOS_CFOP, cfop in m.VENDAS_CFOP
+
+
+def regras_item_compiladas(cfop, regras):
+    return regras['cst'].get(cfop), cfop in regras['ipi_remessa_retorno'], cfop in regras['ipi_venda']
+
+
+# Avaliação das regras declaradas sem a tabela por CFOP: percorre a lista inteira a cada nota
+def interpretar_regras(info, regras, grupos):
+    ref_nfe = info.get('ref_nfe')
+    for regra in regras:
+        cfops = grupos[regra['grupo']] if 'grupo' in regra else regra['cfop']
+        if info.get('cfop') not in cfops or (regra.get('exige_ref') and not ref_nfe):
+            continue
+        if 'natOp' in regra and info.get('nat_op', '') != regra['natOp']:
+            continue
+        x_texto = info.get('x_texto', '') or ''
+        if 'xTexto_contem' in regra and not any(termo in x_texto for termo in regra['xTexto_contem']):
+            continue
+        return regra['nome'].format(nNF=info.get('nfe_number', ''), ref=ref_nfe[25:34].lstrip('0') if ref_nfe else '')
+    return ''
+
+
+# Regras extras por CFOP (como uma empresa com muitas operações próprias), antes das padrão
+def regras_extras(quantidade):
+    return [{'cfop': [f'{5000 + i}', f'{6000 + i}'], 'natOp': f'Operacao {i}', 'nome': f'{{nNF}} - Operacao {i}.xml'}
+            for i in range(quantidade)]
+
+
+def gerar_notas(quantidade, semente=42):
+    rng = random.Random(semente)
+    return [m.InfoNFe(
+        tipo='nfe', caminho_completo=f'{n}.xml', nfe_number=str(n), cfop=rng.choice(CFOPS), nat_op=rng.choice(NAT_OPS),
+        ref_nfe=montar_chave(n + 1) if rng.random() < 0.7 else None, x_texto=rng.choice(X_TEXTOS),
+        chave=montar_chave(n), emit_cnpj='11222333000181',
+    ) for n in range(1, quantidade + 1)]
+
+
+def medir(funcao, itens, repeticoes):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        for item in itens:
+            funcao(item)
+    return (time.perf_counter() - inicio) / (repeticoes * len(itens))
+
+
+if __name__ == '__main__':
+    quantidade = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeticoes = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    extras = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'constantes.json'),
+              encoding='utf-8') as f:
+        constantes = next(iter(json.load(f).values()))
+    regras = m.compilar_regras(constantes)
+    mapeamento_cst = constantes.get('mapeamento_cst', {})
+    notas = gerar_notas(quantidade)
+
+    diferentes = [n for n in notas if gerar_novo_nome_legado(n) != m._gerar_novo_nome_nfe(n, regras)]
+    assert not diferentes, f"{len(diferentes)} nomes diferentes, por exemplo {diferentes[0]!r}"
+    cfops = [n['cfop'] for n in notas]
+    for cfop in set(cfops):
+        legado = regras_item_legado(cfop, mapeamento_cst)
+        compilado = regras_item_compiladas(cfop, regras)
+        assert (legado[0] or None, legado[1:]) == (list(compilado[0]) if compilado[0] else None, compilado[1:]), cfop
+    renomeadas = sum(1 for n in notas if m._gerar_novo_nome_nfe(n, regras))
+    print(f"{quantidade} notas com {len(set(cfops))} CFOPs ({renomeadas} renomeadas): nomes e regras de CST/IPI idênticos.")
+
+    tempos = {
+        'renomeação': (medir(gerar_novo_nome_legado, notas, repeticoes),
+                       medir(partial(m._gerar_novo_nome_nfe, regras=regras), notas, repeticoes)),
+        'CST/IPI por item': (medir(partial(regras_item_legado, mapeamento_cst=mapeamento_cst), cfops, repeticoes),
+                             medir(partial(regras_item_compiladas, regras=regras), cfops, repeticoes)),
+    }
+    grupos = {nome: frozenset(cfops) for nome, cfops in m.GRUPOS_CFOP_PADRAO.items()}
+    for titulo, lista in (('regras padrão', m.REGRAS_RENOMEACAO_PADRAO),
+                          (f'+{extras} regras', regras_extras(extras) + m.REGRAS_RENOMEACAO_PADRAO)):
+        compiladas = m.compilar_regras({'regras_renomeacao': lista})
+        assert all(interpretar_regras(n, lista, grupos) == m._gerar_novo_nome_nfe(n, compiladas) for n in notas)
+        tempos[titulo] = (medir(partial(interpretar_regras, regras=lista, grupos=grupos), notas, repeticoes),
+                          medir(partial(m._gerar_novo_nome_nfe, regras=compiladas), notas, repeticoes))
+    print(f"Tempo médio por nota/item ({repeticoes} repetições; 'legado' é o if/elif ou a lista de regras em ordem):")
+    for etapa, (legado, compilado) in tempos.items():
+        print(f"  {etapa:18s} legado {legado * 1e9:7.0f} ns   compilado {compilado * 1e9:7.0f} ns   "
+              f"ganho {legado / compilado:.2f}x")
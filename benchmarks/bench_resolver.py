@@ -0,0 +1,89 @@
+# =====================
+# Micro-benchmark: resolução de caminhos XML em uma NFe com 500 itens
+# Compara find_element/find_all_elements/find_element_deep atuais com a versão anterior
+# (até três buscas por chamada, reconstruindo os caminhos com prefixo a cada uso).
+# Uso: python benchmarks/bench_resolver.py [itens] [repeticoes]
+# =====================
+
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import manipuladorXML as m  # noqa: E402
+from gerador_corpus import gerar_nfe  # noqa: E402
+
+
+# --- Implementação anterior, mantida apenas para comparação ---
+def find_element_legado(parent, path):
+    if parent is None: return None
+    element = parent.find('/'.join([f'nfe:{tag}' for tag in path.split('/')]), m.NS)
+    if element is not None: return element
+    element = parent.find('/'.join([f'cte:{tag}' for tag in path.split('/')]), m.NS)
+    if element is not None: return element
+    return parent.find(path)
+
+
+def find_all_elements_legado(parent, path):
+    if parent is None: return []
+    elements = parent.findall('/'.join([f'nfe:{tag}' for tag in path.split('/')]), m.NS)
+    if elements: return elements
+    elements = parent.findall('/'.join([f'cte:{tag}' for tag in path.split('/')]), m.NS)
+    if elements: return elements
+    return parent.findall(path)
+
+
+def find_element_deep_legado(parent, path):
+    if parent is None: return None
+    element = parent.find('.//' + '/'.join([f'nfe:{tag}' for tag in path.split('/')]), m.NS)
+    if element is not None: return element
+    element = parent.find('.//' + '/'.join([f'cte:{tag}' for tag in path.split('/')]), m.NS)
+    if element is not None: return element
+    return parent.find(f'.//{path}')
+
+
+RESOLVEDORES = {
+    'legado': (find_element_legado, find_all_elements_legado, find_element_deep_legado),
+    'compilado': (m.find_element, m.find_all_elements, m.find_element_deep),
+}
+
+
+# Edição completa de uma NFe (todas as flags ligadas), usando o resolvedor indicado
+def editar(xml_bytes, resolvedor):
+    m.find_element, m.find_all_elements, m.find_element_deep = RESOLVEDORES[resolvedor]
+    root = ET.fromstring(xml_bytes)
+    chave = m.find_element_deep(root, 'infNFe').get('Id')[3:]
+    m._editar_nfe(
+        root, True, {'CNPJ': '78242849000169', 'xNome': 'NOVA', 'xLgr': 'Rua Nova', 'fone': '4700000000'},
+        True, {'xProd': 'Produto novo', 'cEAN': '7897180599911', 'cProd': '300002011'},
+        True, {'pICMS': '18.00', 'pPIS': '1.65', 'pCOFINS': '7.60', 'pIPI': '5.00'},
+        True, m.compilar_regras({'mapeamento_cst': {'5102': {'ICMS': '00', 'IPI': '50', 'PIS': '01', 'COFINS': '01'}}}),
+        False, True, False, None, {chave: chave}, True, {}
+    )
+    return ET.tostring(root)
+
+
+def medir(xml_bytes, resolvedor, repeticoes):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        editar(xml_bytes, resolvedor)
+    return (time.perf_counter() - inicio) / repeticoes
+
+
+if __name__ == '__main__':
+    itens = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    repeticoes = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    xml_bytes = gerar_nfe(4253, '5102', 'Venda', itens=itens).encode('utf-8')
+    originais = (m.find_element, m.find_all_elements, m.find_element_deep)
+
+    saidas = {nome: editar(xml_bytes, nome) for nome in RESOLVEDORES}
+    assert saidas['legado'] == saidas['compilado'], "Os resolvedores produziram resultados diferentes."
+
+    tempos = {nome: medir(xml_bytes, nome, repeticoes) for nome in RESOLVEDORES}
+    m.find_element, m.find_all_elements, m.find_element_deep = originais
+    print(f"NFe com {itens} itens, {repeticoes} repetições (parse + _editar_nfe):")
+    for nome, tempo in tempos.items():
+        print(f"  {nome:10s} {tempo * 1000:8.2f} ms por NFe")
+    print(f"  ganho:     {tempos['legado'] / tempos['compilado']:.2f}x")
@@ -0,0 +1,85 @@
+# =====================
+# Micro-benchmark: gravação do XML editado
+# Compara o _salvar_xml atual (uma passada pela árvore) com a versão anterior
+# (ET.tostring seguido de várias substituições e regex sobre o documento inteiro)
+# e confere se os arquivos gerados são idênticos byte a byte.
+# Uso: python benchmarks/bench_serializador.py [itens] [repeticoes]
+# =====================
+
+import os
+import re
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import manipuladorXML as m  # noqa: E402
+from gerador_corpus import gerar_cte, gerar_nfe, montar_chave  # noqa: E402
+
+
+# --- Implementação anterior, mantida apenas para comparação ---
+def salvar_xml_legado(root, file_path):
+    if m.find_element_deep(root, 'infNFe'):
+        ET.register_namespace('', m.NS['nfe'])
+    ET.register_namespace('ds', m.NS_DS['ds'])
+    xml_str = ET.tostring(root, encoding='utf-8', method='xml', xml_declaration=True).decode('utf-8')
+    xml_str = xml_str.replace(f' xmlns:ds="{m.NS_DS["ds"]}"', '')
+    xml_str = xml_str.replace('<ds:Signature>', f'<Signature xmlns="{m.NS_DS["ds"]}">')
+    xml_str = xml_str.replace('</ds:Signature>', '</Signature>')
+    xml_str = xml_str.replace('<ds:', '<').replace('</ds:', '</')
+    xml_str = re.sub(r'>\s+<', '><', xml_str.strip())
+    xml_str = re.sub(r'<(/?)(ns0:)', r'<\1', xml_str)
+    xml_str = xml_str.replace('xmlns:ns0="http://www.portalfiscal.inf.br/cte"', '')
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write(xml_str)
+
+
+SERIALIZADORES = {'legado': salvar_xml_legado, 'atual': m._salvar_xml}
+
+
+# Casos de borda: indentação, comentários, textos só com espaços, Signature com atributo
+def gerar_casos_borda():
+    indentada = ET.fromstring(gerar_nfe(10, '5102', 'Venda', x_texto='Obs: a &lt; b &amp; "c"', itens=3))
+    ET.indent(indentada)
+    comentada = gerar_nfe(11, '5949', 'Remessa', itens=2).replace(
+        '<ide>', '<ide><!-- gerado > manualmente  <ds:x> --><vazio>   </vazio><vazio2/>', 1)
+    assinatura_com_id = gerar_nfe(12, '5102', 'Venda').replace('<Signature ', '<Signature Id="sig" ', 1)
+    return [ET.tostring(indentada, encoding='unicode'), comentada, assinatura_com_id]
+
+
+def gravar(xml, serializador, caminho):
+    root = ET.fromstring(xml, parser=m._novo_parser())
+    SERIALIZADORES[serializador](root, caminho)
+    with open(caminho, 'rb') as f:
+        return f.read()
+
+
+def medir(root, serializador, caminho, repeticoes):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        SERIALIZADORES[serializador](root, caminho)
+    return (time.perf_counter() - inicio) / repeticoes
+
+
+if __name__ == '__main__':
+    itens = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    repeticoes = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    ET.register_namespace('', m.NS['nfe'])
+    nfe_grande = gerar_nfe(4253, '5102', 'Venda', itens=itens)
+    amostras = [nfe_grande, gerar_cte(9001, montar_chave(4253))] + gerar_casos_borda()
+
+    with tempfile.TemporaryDirectory() as pasta:
+        caminho = os.path.join(pasta, 'saida.xml')
+        for i, xml in enumerate(amostras):
+            saidas = {nome: gravar(xml, nome, caminho) for nome in SERIALIZADORES}
+            assert saidas['legado'] == saidas['atual'], f"Saídas diferentes na amostra {i}."
+        print(f"{len(amostras)} amostras (NFe, CT-e e casos de borda) idênticas byte a byte.")
+
+        root = ET.fromstring(nfe_grande, parser=m._novo_parser())
+        tempos = {nome: medir(root, nome, caminho, repeticoes) for nome in SERIALIZADORES}
+    print(f"NFe com {itens} itens, {repeticoes} repetições (_salvar_xml):")
+    for nome, tempo in tempos.items():
+        print(f"  {nome:10s} {tempo * 1000:8.2f} ms por NFe")
+    print(f"  ganho:     {tempos['legado'] / tempos['atual']:.2f}x")
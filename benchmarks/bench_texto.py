@@ -0,0 +1,94 @@
+# =====================
+# Benchmark da edição da NF-e direto no texto (sem árvore) contra a edição pela árvore
+# Usa só as alterações de data, emitente e refNFe (os casos da edição em texto) e edita cada XML
+# do corpus com a edição em texto ligada e desligada, lendo do disco e sem gravar nada. Termina com
+# código 1 se algum resultado (mensagem, alterações, metadados ou XML gerado) for diferente.
+# Uso: python benchmarks/bench_texto.py [--arquivos 2000] [--itens 3] [--repeticoes 3] [--pasta /tmp/corpus]
+# =====================
+
+import argparse
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import manipuladorXML as m  # noqa: E402
+from bench_pipeline import constantes_benchmark  # noqa: E402
+from gerador_corpus import gerar_corpus  # noqa: E402
+
+
+# Contexto de edição só com as alterações de texto, com saída externa para receber o XML gerado
+def montar_contexto(documentos, constantes):
+    constantes['alterar'] = {'emitente': True, 'data': True, 'refNFe': True}
+    contexto = m._montar_contexto_edicao(constantes, sincronizar=False, saida_externa=True)
+    chave_mapping, grafo, chave_da_venda_nova = m._prepara_mapeamentos(
+        documentos, contexto['alterar_emitente'], contexto['alterar_data'], contexto['execucao'])
+    contexto.update(chave_mapping=chave_mapping, grafo=grafo, chave_da_venda_nova=chave_da_venda_nova)
+    return contexto
+
+
+# Tempo de edição (melhor de 'repeticoes') e o resultado de cada arquivo
+def medir(documentos, contexto, em_texto, repeticoes):
+    contexto['edicao_em_texto'] = em_texto
+    melhor = float('inf')
+    for _ in range(repeticoes):
+        gerados = {}
+        inicio = time.perf_counter()
+        for documento in documentos:
+            msg, alteracoes, erro, info, _, conteudo = m._editar_documento(m.Documento(**dict(documento)), contexto)
+            gerados[documento['caminho_completo']] = (msg, sorted(alteracoes), erro, info and dict(info), conteudo)
+        melhor = min(melhor, time.perf_counter() - inicio)
+    return melhor, gerados
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark da edição em texto do ManipuladorXML")
+    parser.add_argument('--arquivos', type=int, default=2000, help="Quantidade de XMLs do corpus.")
+    parser.add_argument('--itens', type=int, default=3, help="Máximo de itens <det> por NFe.")
+    parser.add_argument('--repeticoes', type=int, default=3, help="Repetições de cada modo (vale a melhor).")
+    parser.add_argument('--pasta', default=None, help="Pasta do corpus gerado (reaproveitada entre execuções).")
+    args = parser.parse_args()
+
+    pasta_base = args.pasta or tempfile.mkdtemp(prefix='bench_texto_')
+    corpus = os.path.join(pasta_base, f'corpus_{args.arquivos}_{args.itens}')
+    editar_em_texto = m._editar_nfe_em_texto
+    em_texto = []
+
+    # Conta as NF-e editadas no texto (as demais voltam para a árvore)
+    def contar(*argumentos):
+        resultado = editar_em_texto(*argumentos)
+        em_texto.append(resultado is not None)
+        return resultado
+
+    try:
+        if not os.path.isdir(corpus):
+            gerar_corpus(corpus, args.arquivos, args.itens)
+        with open(os.devnull, 'w') as nulo, contextlib.redirect_stdout(nulo):
+            m.configurar_saida(0)
+            documentos = m.carregar_documentos(corpus, manter_arvores=False)
+            contexto = montar_contexto(documentos, constantes_benchmark())
+            arvore = medir(documentos, contexto, False, args.repeticoes)
+            m._editar_nfe_em_texto = contar
+            texto = medir(documentos, contexto, True, 1)
+            m._editar_nfe_em_texto = editar_em_texto
+            texto = min(texto, medir(documentos, contexto, True, args.repeticoes), key=lambda resultado: resultado[0])
+    finally:
+        m._editar_nfe_em_texto = editar_em_texto
+        if args.pasta is None:
+            shutil.rmtree(pasta_base, ignore_errors=True)
+
+    nfes = sum(1 for documento in documentos if documento['tipo'] == 'nfe')
+    print(f"{len(documentos)} arquivos ({nfes} NF-e, {sum(em_texto)} editadas no texto), "
+          f"melhor de {args.repeticoes} repetições:")
+    print(f"  árvore  {arvore[0]:6.2f}s  {len(documentos) / arvore[0]:7.0f} arquivos/s")
+    print(f"  texto   {texto[0]:6.2f}s  {len(documentos) / texto[0]:7.0f} arquivos/s  ({arvore[0] / texto[0]:4.2f}x)")
+    diferentes = [caminho for caminho, resultado in arvore[1].items() if texto[1][caminho] != resultado]
+    if diferentes:
+        print(f"FALHA: {len(diferentes)} arquivo(s) com resultado diferente entre a edição em texto e pela árvore, "
+              f"por exemplo {os.path.basename(diferentes[0])}.")
+        sys.exit(1)
+    print("Resultados idênticos nos dois modos (XML gerado byte a byte, mensagens e metadados).")
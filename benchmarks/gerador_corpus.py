@@ -0,0 +1,172 @@
+# =====================
+# Gerador de XMLs sintéticos para os benchmarks do ManipuladorXML
+# Uso: python benchmarks/gerador_corpus.py <pasta> <quantidade> [itens_por_nfe]
+# =====================
+
+import os  # Caminhos
+import random  # Escolha reprodutível de CFOPs e quantidade de itens
+import sys  # Ajuste do sys.path para importar o script principal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from manipuladorXML import (  # noqa: E402
+    DEVOLUCOES_CFOP, NS, NS_DS, REMESSAS_CFOP, RETORNOS_CFOP, VENDAS_CFOP, calcular_dv_chave,
+)
+
+
+# Monta uma chave de acesso de 44 dígitos com DV válido
+def montar_chave(numero, cuf='41', ano_mes='2401', cnpj='11222333000181', modelo='55', serie=1, codigo=None):
+    codigo = numero * 7 % 10**8 if codigo is None else codigo
+    chave = f"{cuf}{ano_mes}{cnpj}{modelo}{serie:03d}{numero:09d}1{codigo:08d}"
+    return chave + calcular_dv_chave(chave)
+
+
+# Bloco <Signature> no formato emitido pela SEFAZ
+def gerar_assinatura(referencia):
+    return (
+        f'<Signature xmlns="{NS_DS["ds"]}"><SignedInfo>'
+        '<CanonicalizationMethod Algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315" />'
+        '<SignatureMethod Algorithm="http://www.w3.org/2000/09/xmldsig#rsa-sha1" />'
+        f'<Reference URI="#{referencia}"><Transforms>'
+        '<Transform Algorithm="http://www.w3.org/2000/09/xmldsig#enveloped-signature" />'
+        '<Transform Algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315" /></Transforms>'
+        '<DigestMethod Algorithm="http://www.w3.org/2000/09/xmldsig#sha1" /><DigestValue>q1w2e3r4t5y6u7i8o9p0=</DigestValue>'
+        '</Reference></SignedInfo><SignatureValue>QUJDREVGR0hJSktMTU5PUFFSU1RVVldYWVo=</SignatureValue>'
+        '<KeyInfo><X509Data><X509Certificate>MIIHQDCCBSigAwIBAgIIMIIHQDCCBSig</X509Certificate></X509Data></KeyInfo></Signature>'
+    )
+
+
+# Um item <det> completo (produto e impostos)
+def gerar_det(n_item, cfop):
+    return (
+        f'<det nItem="{n_item}"><prod><cProd>P{n_item:05d}</cProd><cEAN>7890000000000</cEAN><xProd>Produto &amp; Cia {n_item}</xProd>'
+        f'<NCM>85166000</NCM><CFOP>{cfop}</CFOP><uCom>UN</uCom><qCom>1.0000</qCom><vUnCom>100.0000000000</vUnCom><vProd>100.00</vProd>'
+        '<cEANTrib>7890000000000</cEANTrib><uTrib>UN</uTrib><qTrib>1.0000</qTrib><vUnTrib>100.0000000000</vUnTrib><vFrete>5.00</vFrete>'
+        '<indTot>1</indTot></prod><imposto><vTotTrib>0.00</vTotTrib><ICMS><ICMS00><orig>0</orig><CST>00</CST><modBC>3</modBC>'
+        '<vBC>100.00</vBC><pICMS>12.00</pICMS><vICMS>12.00</vICMS></ICMS00></ICMS><IPI><cEnq>999</cEnq><IPITrib><CST>50</CST>'
+        '<vBC>100.00</vBC><pIPI>5.0000</pIPI><vIPI>5.00</vIPI></IPITrib></IPI><PIS><PISAliq><CST>01</CST><vBC>100.00</vBC>'
+        '<pPIS>1.65</pPIS><vPIS>1.65</vPIS></PISAliq></PIS><COFINS><COFINSAliq><CST>01</CST><vBC>100.00</vBC><pCOFINS>7.60</pCOFINS>'
+        '<vCOFINS>7.60</vCOFINS></COFINSAliq></COFINS></imposto></det>'
+    )
+
+
+# NFe autorizada (nfeProc) com a quantidade de itens pedida
+def gerar_nfe(numero, cfop, nat_op, ref_nfe=None, x_texto=None, itens=1, cnpj='11222333000181'):
+    chave = montar_chave(numero, cnpj=cnpj)
+    nfref = f'<NFref><refNFe>{ref_nfe}</refNFe></NFref>' if ref_nfe else ''
+    inf_adic = f'<infAdic><obsCont xCampo="tipo"><xTexto>{x_texto}</xTexto></obsCont></infAdic>' if x_texto else ''
+    dets = ''.join(gerar_det(n, cfop) for n in range(1, itens + 1))
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?><nfeProc xmlns="{NS["nfe"]}" versao="4.00"><NFe xmlns="{NS["nfe"]}">'
+        f'<infNFe Id="NFe{chave}" versao="4.00"><ide><cUF>41</cUF><cNF>{chave[35:43]}</cNF><natOp>{nat_op}</natOp><mod>55</mod>'
+        f'<serie>1</serie><nNF>{numero}</nNF><dhEmi>2024-01-15T10:00:00-03:00</dhEmi><dhSaiEnt>2024-01-15T10:00:00-03:00</dhSaiEnt>'
+        f'<tpNF>1</tpNF><idDest>2</idDest><cMunFG>4118501</cMunFG><tpImp>1</tpImp><tpEmis>1</tpEmis><cDV>{chave[43]}</cDV>'
+        f'<tpAmb>1</tpAmb><finNFe>1</finNFe>{nfref}</ide>'
+        f'<emit><CNPJ>{cnpj}</CNPJ><xNome>EMPRESA ORIGINAL LTDA</xNome><enderEmit><xLgr>Rua Original</xLgr><nro>100</nro>'
+        '<xCpl>Sala 1</xCpl><xBairro>Centro</xBairro><cMun>4118501</cMun><xMun>Pato Branco</xMun><UF>PR</UF><CEP>85501000</CEP>'
+        '<fone>4630000000</fone></enderEmit><IE>9012345678</IE><CRT>3</CRT></emit>'
+        '<dest><CPF>12345678909</CPF><xNome>Cliente São João</xNome><indIEDest>9</indIEDest></dest>'
+        f'{dets}<total><ICMSTot><vBC>{100 * itens:.2f}</vBC><vICMS>{12 * itens:.2f}</vICMS><vProd>{100 * itens:.2f}</vProd>'
+        f'<vFrete>{5 * itens:.2f}</vFrete><vSeg>0.00</vSeg><vDesc>0.00</vDesc><vIPI>{5 * itens:.2f}</vIPI><vOutro>0.00</vOutro>'
+        f'<vNF>{110 * itens:.2f}</vNF></ICMSTot></total><transp><modFrete>9</modFrete></transp>{inf_adic}</infNFe>'
+        f'{gerar_assinatura("NFe" + chave)}</NFe><protNFe versao="4.00"><infProt><tpAmb>1</tpAmb><verAplic>PR-v4_8_35</verAplic>'
+        f'<chNFe>{chave}</chNFe><dhRecbto>2024-01-15T10:00:05-03:00</dhRecbto><nProt>141240000000001</nProt>'
+        '<digVal>q1w2e3r4t5y6u7i8o9p0=</digVal><cStat>100</cStat><xMotivo>Autorizado o uso da NF-e</xMotivo></infProt></protNFe></nfeProc>'
+    )
+
+
+# Evento de cancelamento (procEventoNFe) de uma NFe
+def gerar_cancelamento(chave_nfe, cnpj='11222333000181'):
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?><procEventoNFe xmlns="{NS["nfe"]}" versao="1.00"><evento versao="1.00">'
+        f'<infEvento Id="ID110111{chave_nfe}01"><cOrgao>41</cOrgao><tpAmb>1</tpAmb><CNPJ>{cnpj}</CNPJ><chNFe>{chave_nfe}</chNFe>'
+        '<dhEvento>2024-01-16T09:00:00-03:00</dhEvento><tpEvento>110111</tpEvento><nSeqEvento>1</nSeqEvento><verEvento>1.00</verEvento>'
+        '<detEvento versao="1.00"><descEvento>Cancelamento</descEvento><nProt>141240000000001</nProt>'
+        '<xJust>Erro na emissao da nota fiscal</xJust></detEvento></infEvento>'
+        f'{gerar_assinatura("ID110111" + chave_nfe + "01")}</evento><retEvento versao="1.00"><infEvento><tpAmb>1</tpAmb>'
+        f'<cStat>135</cStat><chNFe>{chave_nfe}</chNFe><tpEvento>110111</tpEvento>'
+        '<dhRegEvento>2024-01-16T09:00:01-03:00</dhRegEvento><nProt>141240000000002</nProt></infEvento></retEvento></procEventoNFe>'
+    )
+
+
+# CT-e autorizado (cteProc) que transporta a NFe informada
+def gerar_cte(numero, chave_nfe, cnpj='11222333000181'):
+    chave = montar_chave(numero, modelo='57', cnpj=cnpj)
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?><cteProc xmlns="{NS["cte"]}" versao="4.00"><CTe xmlns="{NS["cte"]}">'
+        f'<infCte Id="CTe{chave}" versao="4.00"><ide><cUF>41</cUF><cCT>{chave[35:43]}</cCT><CFOP>6353</CFOP>'
+        f'<natOp>Prestacao de servico de transporte</natOp><mod>57</mod><serie>1</serie><nCT>{numero}</nCT>'
+        '<dhEmi>2024-01-15T11:00:00-03:00</dhEmi></ide>'
+        f'<rem><CNPJ>{cnpj}</CNPJ><IE>9012345678</IE><xNome>REM &amp; CIA</xNome><enderReme><xLgr>Rua Original</xLgr>'
+        '<nro>100</nro><xBairro>Centro</xBairro><cMun>4118501</cMun><xMun>Pato Branco</xMun><UF>PR</UF></enderReme></rem>'
+        f'<infCTeNorm><infCarga><vCarga>110.00</vCarga></infCarga><infDoc><infNFe><chave>{chave_nfe}</chave></infNFe></infDoc>'
+        f'</infCTeNorm></infCte>{gerar_assinatura("CTe" + chave)}</CTe>'
+        f'<protCTe versao="4.00"><infProt><tpAmb>1</tpAmb><chCTe>{chave}</chCTe><dhRecbto>2024-01-15T11:00:05-03:00</dhRecbto>'
+        '<nProt>341240000000001</nProt><cStat>100</cStat></infProt></protCTe></cteProc>'
+    )
+
+
+# Inutilização de uma faixa de numeração (procInutNFe)
+def gerar_inutilizacao(inicio, fim, cnpj='11222333000181'):
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?><procInutNFe xmlns="{NS["nfe"]}" versao="4.00"><inutNFe versao="4.00">'
+        f'<infInut Id="ID4124{cnpj}55001{inicio:09d}{fim:09d}"><tpAmb>1</tpAmb><xServ>INUTILIZAR</xServ><cUF>41</cUF>'
+        f'<ano>24</ano><CNPJ>{cnpj}</CNPJ><mod>55</mod><serie>1</serie><nNFIni>{inicio}</nNFIni><nNFFin>{fim}</nNFFin>'
+        f'<xJust>Quebra de sequencia na numeracao</xJust></infInut>{gerar_assinatura(f"ID{inicio}")}</inutNFe>'
+        '<retInutNFe versao="4.00"><infInut><tpAmb>1</tpAmb><cStat>102</cStat>'
+        '<dhRecbto>2024-01-17T10:00:00-03:00</dhRecbto></infInut></retInutNFe></procInutNFe>'
+    )
+
+
+# Um cenário completo, com as mesmas cadeias que a renomeação reconhece:
+# remessa -> retorno da remessa, venda -> devolução / insucesso / remessa simbólica,
+# cancelamento da venda, CT-e da venda e, a cada 10 cenários, uma inutilização.
+# Retorna a lista de (nome do arquivo, conteúdo).
+def gerar_cenario(indice, rng, itens=1):
+    base = 10 + indice * 10
+    chave = montar_chave
+    n_itens = lambda: rng.randint(1, itens) if itens > 1 else 1  # noqa: E731
+    remessa, retorno, venda, devolucao, insucesso, simbolica, venda_cancelada = range(base, base + 7)
+    arquivos = [
+        (f'{remessa}.xml', gerar_nfe(remessa, rng.choice(REMESSAS_CFOP), 'Remessa para deposito temporario', itens=n_itens())),
+        (f'{retorno}.xml', gerar_nfe(
+            retorno, rng.choice(RETORNOS_CFOP), rng.choice((
+                'Outras Entradas - Retorno Simbolico de Deposito Temporario', 'Outras Entradas - Retorno de Deposito Temporario')),
+            ref_nfe=chave(remessa), itens=n_itens())),
+        (f'{venda}.xml', gerar_nfe(venda, rng.choice(VENDAS_CFOP), 'Venda de mercadoria', itens=n_itens())),
+        (f'{devolucao}.xml', gerar_nfe(
+            devolucao, rng.choice(DEVOLUCOES_CFOP), 'Devolucao de mercadorias', ref_nfe=chave(venda),
+            x_texto=rng.choice(('DEVOLUTION_PLACES', 'SALE_DEVOLUTION', 'DEVOLUTION_devolution')), itens=n_itens())),
+        (f'{insucesso}.xml', gerar_nfe(
+            insucesso, rng.choice(DEVOLUCOES_CFOP), 'Retorno de mercadoria nao entregue', ref_nfe=chave(venda), itens=n_itens())),
+        (f'{simbolica}.xml', gerar_nfe(
+            simbolica, rng.choice(REMESSAS_CFOP), 'Remessa simbolica', ref_nfe=chave(venda), itens=n_itens())),
+        (f'{venda_cancelada}.xml', gerar_nfe(venda_cancelada, rng.choice(VENDAS_CFOP), 'Venda de mercadoria', itens=n_itens())),
+        (f'evento_{venda_cancelada}.xml', gerar_cancelamento(chave(venda_cancelada))),
+        (f'cte_{venda}.xml', gerar_cte(venda, chave(venda))),
+    ]
+    if indice % 10 == 9:
+        arquivos.append((f'inut_{base + 7}.xml', gerar_inutilizacao(base + 7, base + 9)))
+    return arquivos
+
+
+# Grava na pasta um corpus com (aproximadamente) a quantidade de arquivos pedida
+def gerar_corpus(pasta, quantidade, itens=1, semente=42):
+    os.makedirs(pasta, exist_ok=True)
+    rng = random.Random(semente)
+    total, indice = 0, 0
+    while total < quantidade:
+        for nome, conteudo in gerar_cenario(indice, rng, itens)[:quantidade - total]:
+            with open(os.path.join(pasta, nome), 'w', encoding='utf-8') as f:
+                f.write(conteudo)
+            total += 1
+        indice += 1
+    return total
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print("Uso: python benchmarks/gerador_corpus.py <pasta> <quantidade> [itens_por_nfe]")
+        sys.exit(1)
+    gerados = gerar_corpus(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]) if len(sys.argv) > 3 else 1)
+    print(f"{gerados} XMLs gerados em {sys.argv[1]}")
@@ -5,10 +5,48 @@
 
 import os  # Operações de sistema de arquivos
 import xml.etree.ElementTree as ET  # Manipulação de XML
+import xml.parsers.expat  # Verificação do XML editado direto no texto
 from datetime import datetime  # Datas e horas
 import json  # Leitura de arquivos JSON
 import re  # Regex para manipulação de espaços entre tags
+import string  # Modelos de nome das regras de renomeação
+import argparse  # Opções de linha de comando
+import sqlite3  # Cache persistente de metadados
+import time  # Intervalo de varredura do modo de monitoramento
+import io  # Captura da saída de cada empresa em execuções simultâneas
+import sys  # Código de saída para execuções agendadas
+import traceback  # Erros inesperados de uma empresa em execução simultânea
+import heapq  # Arquivos mais lentos do relatório de métricas
+import cProfile  # Perfil opcional da execução (--cprofile)
+import zipfile  # Leitura de XMLs dentro de ZIPs e saída em ZIP
+import gzip  # Arquivos de plano compactados (--plano plano.json.gz)
+import hashlib  # Impressão digital das constantes gravada no plano
+import shutil  # Cópia de arquivos inalterados para a pasta de saída
+import urllib.parse  # Caminho do cache aberto só para leitura na simulação
+import ctypes  # renameat2 do Linux, para renomear sem substituir o destino
+import errno  # Destino já existente na renomeação
+from contextlib import redirect_stdout  # Captura da saída de cada empresa
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed  # Execução paralela e E/S em segundo plano
+from collections import deque  # Filas limitadas da leitura e da gravação em segundo plano
 from decimal import Decimal, ROUND_HALF_UP # Para cálculos financeiros precisos
+from functools import lru_cache  # Cache dos caminhos XML compilados
+from operator import mul  # Soma ponderada do DV das chaves de acesso
+try:
+    import resource  # Pico de memória no relatório de métricas (indisponível no Windows)
+except ImportError:
+    resource = None
+try:
+    import fcntl  # Reflink de arquivos inalterados na pasta de saída (indisponível no Windows)
+except ImportError:
+    fcntl = None
+try:
+    import numpy as np  # Geração e validação de chaves em lote (opcional)
+except ImportError:
+    np = None
+try:
+    from lxml import etree as lxml_etree  # Backend XML opcional, com XPath compilado (opcional)
+except ImportError:
+    lxml_etree = None
 
 
 # --- CFOPs utilizados para identificar tipos de operações ---
@@ -18,73 +56,374 @@ RETORNOS_CFOP = ['1949', '2949', '5902', '6902']
 REMESSAS_CFOP = ['5949', '5156', '6152', '6949', '6905', '5901', '6901']
 
 
+# --- Regras de renomeação e de CST ---
+# As regras de renomeação são declaradas (e podem ser substituídas por empresa no constantes.json,
+# em "regras_renomeacao" e "grupos_cfop") e compiladas uma vez por execução em uma tabela por CFOP.
+# Para cada NFe vale a primeira regra do CFOP dela cujas condições são atendidas: referência a
+# outra NFe (exige_ref), natOp exata, algum dos textos de xTexto_contem e a expressão regular
+# xTexto_regex. O nome é formatado com {nNF} (número da nota) e {ref} (número da nota referenciada).
+GRUPOS_CFOP_PADRAO = {
+    'vendas': VENDAS_CFOP,
+    'devolucoes': DEVOLUCOES_CFOP,
+    'retornos': RETORNOS_CFOP,
+    'remessas': REMESSAS_CFOP,
+}
+REGRAS_RENOMEACAO_PADRAO = [
+    {'grupo': 'devolucoes', 'exige_ref': True, 'natOp': 'Retorno de mercadoria nao entregue',
+     'nome': '{nNF} - Insucesso de entrega da venda {ref}.xml'},
+    {'grupo': 'devolucoes', 'exige_ref': True, 'natOp': 'Devolucao de mercadorias',
+     'xTexto_contem': ['DEVOLUTION_PLACES', 'SALE_DEVOLUTION'], 'nome': '{nNF} - Devoluçao pro Mercado Livre da venda - {ref}.xml'},
+    {'grupo': 'devolucoes', 'exige_ref': True, 'natOp': 'Devolucao de mercadorias',
+     'xTexto_contem': ['DEVOLUTION_devolution'], 'nome': '{nNF} - Devolucao da venda {ref}.xml'},
+    {'grupo': 'vendas', 'nome': '{nNF} - Venda.xml'},
+    {'grupo': 'retornos', 'exige_ref': True, 'natOp': 'Outras Entradas - Retorno Simbolico de Deposito Temporario',
+     'nome': '{nNF} - Retorno da remessa {ref}.xml'},
+    {'grupo': 'retornos', 'exige_ref': True, 'natOp': 'Outras Entradas - Retorno de Deposito Temporario',
+     'nome': '{nNF} - Retorno Efetivo da remessa {ref}.xml'},
+    {'grupo': 'remessas', 'exige_ref': True, 'nome': '{nNF} - Remessa simbólica da venda {ref}.xml'},
+    {'grupo': 'remessas', 'nome': '{nNF} - Remessa.xml'},
+]
+_CAMPOS_REGRA = {'grupo', 'cfop', 'exige_ref', 'natOp', 'xTexto_contem', 'xTexto_regex', 'nome'}
+_CAMPOS_NOME = ('nNF', 'ref')
+
+
+# O nome vira um modelo posicional ({0} = nNF, {1} = ref), mais rápido de formatar a cada nota
+def _compilar_nome(nome):
+    partes = []
+    try:
+        for literal, campo, especificacao, conversao in string.Formatter().parse(nome):
+            partes.append(literal.replace('{', '{{').replace('}', '}}'))
+            if campo is None:
+                continue
+            if campo not in _CAMPOS_NOME:
+                raise ValueError(f"campo {{{campo}}} desconhecido")
+            partes.append('{%d%s%s}' % (_CAMPOS_NOME.index(campo), '!' + conversao if conversao else '',
+                                        ':' + especificacao if especificacao else ''))
+        modelo = ''.join(partes)
+        modelo.format('', '')
+    except (KeyError, IndexError, ValueError) as e:
+        raise ValueError(f"nome inválido {nome!r} (use apenas {{nNF}} e {{ref}}): {e}") from None
+    return modelo
+
+
+# Uma regra compilada: (exige_ref, natOp ou None, textos de xTexto_contem, regex de xTexto_regex, modelo do nome)
+def _compilar_regra_renomeacao(regra, grupos):
+    if not isinstance(regra, dict) or 'nome' not in regra:
+        raise ValueError(f"regra de renomeação sem 'nome': {regra!r}")
+    desconhecidos = set(regra) - _CAMPOS_REGRA
+    if desconhecidos:
+        raise ValueError(f"campo(s) desconhecido(s) {sorted(desconhecidos)} na regra {regra['nome']!r}")
+    if 'grupo' in regra:
+        if regra['grupo'] not in grupos:
+            raise ValueError(f"grupo de CFOP desconhecido {regra['grupo']!r} na regra {regra['nome']!r}")
+        cfops = grupos[regra['grupo']]
+    elif 'cfop' in regra:
+        cfops = frozenset([regra['cfop']] if isinstance(regra['cfop'], str) else regra['cfop'])
+    else:
+        raise ValueError(f"a regra {regra['nome']!r} precisa de 'grupo' ou 'cfop'")
+    termos = regra.get('xTexto_contem')
+    termos = (termos,) if isinstance(termos, str) else tuple(termos or ())
+    try:
+        padrao = re.compile(regra['xTexto_regex']) if regra.get('xTexto_regex') else None
+    except re.error as e:
+        raise ValueError(f"xTexto_regex inválida na regra {regra['nome']!r}: {e}") from None
+    return cfops, (bool(regra.get('exige_ref')), regra.get('natOp'), termos, padrao, _compilar_nome(regra['nome']))
+
+
+# Compila as regras de uma empresa: tabela CFOP -> regras de renomeação (na ordem declarada),
+# CFOP -> pares (imposto, CST) do mapeamento_cst e os conjuntos de CFOP que zeram o IPI.
+# Regras inválidas levantam ValueError com a descrição do problema.
+def compilar_regras(constantes_empresa=None):
+    constantes_empresa = constantes_empresa or {}
+    grupos = {nome: frozenset(cfops) for nome, cfops in GRUPOS_CFOP_PADRAO.items()}
+    grupos.update((nome, frozenset(cfops)) for nome, cfops in constantes_empresa.get('grupos_cfop', {}).items())
+    nomes = {}
+    for regra in constantes_empresa.get('regras_renomeacao', REGRAS_RENOMEACAO_PADRAO):
+        cfops, compilada = _compilar_regra_renomeacao(regra, grupos)
+        for cfop in cfops:
+            nomes.setdefault(cfop, []).append(compilada)
+    return {
+        'nomes': {cfop: tuple(regras) for cfop, regras in nomes.items()},
+        'cst': {cfop: tuple(regras.items()) for cfop, regras in constantes_empresa.get('mapeamento_cst', {}).items()},
+        'ipi_remessa_retorno': grupos['remessas'] | grupos['retornos'],
+        'ipi_venda': grupos['vendas'],
+        'vendas': grupos['vendas'],
+    }
+
+
+# Regras padrão, para quem chama as funções de renomeação sem as regras da empresa
+@lru_cache(maxsize=None)
+def _regras_padrao():
+    return compilar_regras()
+
+
 # Namespace padrão para NFe e CTe (usado nas buscas de tags XML)
 NS = {'nfe': 'http://www.portalfiscal.inf.br/nfe', 'cte': 'http://www.portalfiscal.inf.br/cte'}
 # Namespace para a Assinatura Digital (Digital Signature)
 NS_DS = {'ds': 'http://www.w3.org/2000/09/xmldsig#'}
 
 
+# --- Backend XML ---
+# As árvores completas (edição e gravação) são lidas com o ElementTree ou, com --backend-xml lxml,
+# com o lxml (se instalado). As buscas find_element* usam o caminho de cada biblioteca conforme o
+# tipo do elemento recebido (no lxml, expressões XPath compiladas) e a serialização percorre as
+# duas árvores da mesma forma, então o XML gravado é idêntico byte a byte nos dois backends.
+# A leitura incremental dos metadados usa sempre o ElementTree. O ElementTree continua o padrão:
+# como a serialização percorre a árvore em Python, cada acesso a um nó do lxml custa mais, e na
+# edição completa o lxml fica mais lento (ver benchmarks/bench_backend.py).
+_BACKENDS_XML = ('etree', 'lxml')
+_BACKEND_XML = {'nome': 'etree'}
+_ELEMENTO_ET = ET.Element
+_COMENTARIO_LXML = lxml_etree.Comment if lxml_etree is not None else ET.Comment
+_PI_LXML = lxml_etree.ProcessingInstruction if lxml_etree is not None else ET.ProcessingInstruction
+
+
+def configurar_backend_xml(nome='etree'):
+    if nome not in _BACKENDS_XML:
+        print(f"Aviso: backend XML inválido ('{nome}'). Usando o ElementTree.")
+        nome = 'etree'
+    elif nome == 'lxml' and lxml_etree is None:
+        print("Aviso: lxml não está instalado. Usando o ElementTree.")
+        nome = 'etree'
+    _BACKEND_XML['nome'] = nome
+    return nome
+
+
+# Analisador lxml equivalente a _novo_parser: mantém comentários e descarta instruções de
+# processamento. É reaproveitado entre arquivos (um por processo).
+# Como no expat, entidades externas nunca são lidas (um XML baixado não pode trazer o conteúdo de
+# arquivos locais nem acessar a rede): no lxml 5 em diante só as internas são resolvidas; antes
+# dele nenhuma é, e _ler_arvore recusa o XML que tenha alguma.
+@lru_cache(maxsize=None)
+def _parser_lxml():
+    return lxml_etree.XMLParser(remove_pis=True, no_network=True, huge_tree=False,
+                                resolve_entities='internal' if lxml_etree.LXML_VERSION >= (5,) else False)
+
+
+# Lê a árvore completa de um arquivo (caminho ou arquivo aberto em modo binário) com o backend atual
+def _ler_arvore(arquivo):
+    if _BACKEND_XML['nome'] == 'lxml':
+        root = lxml_etree.parse(arquivo, _parser_lxml()).getroot()
+        if lxml_etree.LXML_VERSION < (5,):
+            for entidade in root.iter(lxml_etree.Entity):
+                raise ValueError(f"entidade não resolvida: {entidade.text}")
+        return root
+    return ET.parse(arquivo, _novo_parser()).getroot()
+
+
+# --- Resolução de caminhos com namespace ---
+# Cada caminho lógico ('ide/nNF') é compilado uma única vez por namespace do elemento de partida
+# e guardado em cache como tuplas de tags qualificadas ('{uri}ide', '{uri}nNF').
+# Elementos com namespace resolvem com uma única busca; elementos sem namespace mantêm a ordem
+# de tentativas nfe -> cte -> sem namespace.
+@lru_cache(maxsize=None)
+def _compilar_caminho(tag_pai, path):
+    namespace = tag_pai[1:tag_pai.index('}')] if tag_pai[:1] == '{' else ''
+    if namespace:
+        candidatos = (namespace,)
+    else:
+        candidatos = (NS['nfe'], NS['cte'], '')
+    return tuple(
+        tuple(f'{{{uri}}}{tag}' if uri else tag for tag in path.split('/'))
+        for uri in candidatos
+    )
+
+
+# Versão lxml de _compilar_caminho: para cada namespace candidato, as expressões XPath compiladas
+# do primeiro elemento, de todos os elementos e da busca profunda. Os predicados reproduzem a
+# ordem de _primeiro_por_passos: o primeiro filho de cada passo que leva ao restante do caminho.
+@lru_cache(maxsize=None)
+def _compilar_xpath(tag_pai, path):
+    expressoes = []
+    for passos in _compilar_caminho(tag_pai, path):
+        namespaces = {}
+        nomes = []
+        for tag in passos:
+            if tag[:1] == '{':
+                uri, local = tag[1:].split('}', 1)
+                namespaces['n'] = uri
+                tag = 'n:' + local
+            nomes.append(tag)
+        condicoes = [f"[{'/'.join(nomes[i + 1:])}]" if i + 1 < len(nomes) else '' for i in range(len(nomes))]
+        passos_primeiro = [f"{nome}{condicao}[1]" for nome, condicao in zip(nomes, condicoes)]
+        primeiro = '/'.join(passos_primeiro)
+        profundo = '/'.join([f"(.//{nomes[0]}{condicoes[0]})[1]"] + passos_primeiro[1:])
+        expressoes.append(tuple(lxml_etree.XPath(expressao, namespaces=namespaces)
+                                for expressao in (primeiro, '/'.join(nomes), profundo)))
+    return tuple(expressoes)
+
+
+# Avalia a expressão de índice 'tipo' (0 primeiro, 1 todos, 2 profunda) para cada namespace
+# candidato, até encontrar algum elemento
+def _buscar_xpath(parent, path, tipo):
+    for expressoes in _compilar_xpath(parent.tag, path):
+        encontrados = expressoes[tipo](parent)
+        if encontrados: return encontrados
+    return []
+
+
+# Primeiro elemento que satisfaz a sequência de tags filhas, em ordem de documento
+def _primeiro_por_passos(elemento, passos):
+    if len(passos) == 1:
+        return elemento.find(passos[0])
+    for filho in elemento.findall(passos[0]):
+        encontrado = _primeiro_por_passos(filho, passos[1:])
+        if encontrado is not None:
+            return encontrado
+    return None
+
+
+# Todos os elementos que satisfazem a sequência de tags filhas, em ordem de documento
+def _todos_por_passos(elemento, passos):
+    if len(passos) == 1:
+        return elemento.findall(passos[0])
+    return [encontrado for filho in elemento.findall(passos[0]) for encontrado in _todos_por_passos(filho, passos[1:])]
+
+
 # Função para buscar um elemento XML com ou sem namespace
 def find_element(parent, path):
     if parent is None: return None
-    # Tenta com namespace nfe
-    namespaced_path_nfe = '/'.join([f'nfe:{tag}' for tag in path.split('/')])
-    element = parent.find(namespaced_path_nfe, NS)
-    if element is not None: return element
-    # Tenta com namespace cte
-    namespaced_path_cte = '/'.join([f'cte:{tag}' for tag in path.split('/')])
-    element = parent.find(namespaced_path_cte, NS)
-    if element is not None: return element
-    # Tenta sem namespace
-    element = parent.find(path)
-    return element
+    if type(parent) is not _ELEMENTO_ET:
+        return next(iter(_buscar_xpath(parent, path, 0)), None)
+    for passos in _compilar_caminho(parent.tag, path):
+        element = _primeiro_por_passos(parent, passos)
+        if element is not None: return element
+    return None
 
 
 # Busca todos os elementos XML de um caminho, com ou sem namespace
 def find_all_elements(parent, path):
     if parent is None: return []
-    # Tenta com namespace nfe
-    namespaced_path_nfe = '/'.join([f'nfe:{tag}' for tag in path.split('/')])
-    elements = parent.findall(namespaced_path_nfe, NS)
-    if elements: return elements
-    # Tenta com namespace cte
-    namespaced_path_cte = '/'.join([f'cte:{tag}' for tag in path.split('/')])
-    elements = parent.findall(namespaced_path_cte, NS)
-    if elements: return elements
-    # Tenta sem namespace
-    elements = parent.findall(path)
-    return elements
+    if type(parent) is not _ELEMENTO_ET:
+        return _buscar_xpath(parent, path, 1)
+    for passos in _compilar_caminho(parent.tag, path):
+        elements = _todos_por_passos(parent, passos)
+        if elements: return elements
+    return []
 
 
 # Busca profunda (em qualquer nível) de um elemento XML
 def find_element_deep(parent, path):
     if parent is None: return None
-    # Tenta com namespace nfe
-    namespaced_path_nfe = './/' + '/'.join([f'nfe:{tag}' for tag in path.split('/')])
-    element = parent.find(namespaced_path_nfe, NS)
-    if element is not None: return element
-    # Tenta com namespace cte
-    namespaced_path_cte = './/' + '/'.join([f'cte:{tag}' for tag in path.split('/')])
-    element = parent.find(namespaced_path_cte, NS)
-    if element is not None: return element
-    # Tenta sem namespace
-    element = parent.find(f'.//{path}')
-    return element
+    if type(parent) is not _ELEMENTO_ET:
+        return next(iter(_buscar_xpath(parent, path, 2)), None)
+    for passos in _compilar_caminho(parent.tag, path):
+        for inicio in parent.iter(passos[0]):
+            if inicio is parent:
+                continue
+            element = inicio if len(passos) == 1 else _primeiro_por_passos(inicio, passos[1:])
+            if element is not None: return element
+    return None
+
+
+# --- Chaves de acesso ---
+# Pesos do módulo 11 para as 43 posições (2 a 9, da direita para a esquerda) e o DV de cada resto
+# da divisão por 11 (restos 0, 1 e 10 dão DV 0). A soma é feita sobre os códigos ASCII dos dígitos,
+# descontando a contribuição do '0' (48) em cada posição.
+_PESOS_DV = tuple(2 + (42 - i) % 8 for i in range(43))
+_SOMA_PESOS_ZERO = ord('0') * sum(_PESOS_DV)
+_DV_POR_RESTO = '00987654320'
+
+
+def _chave_bem_formada(chave):
+    return bool(chave) and len(chave) == 44 and chave.isascii() and chave.isdigit()
 
 
 # Calcula o dígito verificador de uma chave de acesso NFe
 def calcular_dv_chave(chave):
-    if len(chave) != 43:
+    if len(chave) != 43 or not (chave.isascii() and chave.isdigit()):
         raise ValueError("A chave para cálculo do DV deve ter 43 dígitos.")
-    soma, multiplicador = 0, 2
-    for i in range(len(chave) - 1, -1, -1):
-        soma += int(chave[i]) * multiplicador
-        multiplicador += 1
-        if multiplicador > 9:
-            multiplicador = 2
-    resto = soma % 11
-    dv = 11 - resto
-    return '0' if dv in [0, 1, 10, 11] else str(dv)
+    return _DV_POR_RESTO[(sum(map(mul, chave.encode('ascii'), _PESOS_DV)) - _SOMA_PESOS_ZERO) % 11]
+
+
+# DVs (códigos ASCII) das linhas de uma matriz uint8 de chaves, calculados em uma única passada
+def _dvs_vetorizados(matriz):
+    somas = matriz[:, :43].astype(np.int64) @ np.array(_PESOS_DV, dtype=np.int64) - _SOMA_PESOS_ZERO
+    return np.frombuffer(_DV_POR_RESTO.encode('ascii'), dtype=np.uint8)[somas % 11]
+
+
+def _matriz_de_chaves(textos, largura):
+    return np.frombuffer(''.join(textos).encode('ascii'), dtype=np.uint8).reshape(-1, largura)
+
+
+# Novas chaves de acesso (com DV) para uma lista de chaves originais bem formadas: ano_mes (AAMM)
+# e cnpj substituem as posições 2-5 e 6-19; cnpj pode ser um só para todas as chaves ou uma lista
+# com o de cada chave, e None mantém o valor da chave original. Com NumPy, as chaves são tratadas
+# como uma matriz de bytes de largura fixa; sem ele, o cálculo é feito chave a chave.
+def gerar_chaves(chaves, ano_mes=None, cnpj=None):
+    if isinstance(cnpj, str):
+        cnpj = cnpj.zfill(14)
+        if len(cnpj) != 14:
+            raise ValueError(f"CNPJ inválido para a chave de acesso: {cnpj}")
+    elif cnpj is not None:
+        cnpj = [c.zfill(14) for c in cnpj]
+        invalidos = [c for c in cnpj if len(c) != 14]
+        if invalidos:
+            raise ValueError(f"CNPJ inválido para a chave de acesso: {invalidos[0]}")
+    if not chaves:
+        return []
+
+    if np is None:
+        novas = []
+        for i, chave in enumerate(chaves):
+            cnpj_chave = chave[6:20] if cnpj is None else cnpj if isinstance(cnpj, str) else cnpj[i]
+            sem_dv = chave[:2] + (ano_mes or chave[2:6]) + cnpj_chave + chave[20:43]
+            novas.append(sem_dv + calcular_dv_chave(sem_dv))
+        return novas
+
+    matriz = _matriz_de_chaves(chaves, 44).copy()
+    if ano_mes:
+        matriz[:, 2:6] = np.frombuffer(ano_mes.encode('ascii'), dtype=np.uint8)
+    if isinstance(cnpj, str):
+        matriz[:, 6:20] = np.frombuffer(cnpj.encode('ascii'), dtype=np.uint8)
+    elif cnpj is not None:
+        matriz[:, 6:20] = _matriz_de_chaves(cnpj, 14)
+    matriz[:, 43] = _dvs_vetorizados(matriz)
+    texto = matriz.tobytes().decode('ascii')
+    return [texto[i:i + 44] for i in range(0, len(texto), 44)]
+
+
+# Para cada valor, se é uma chave de acesso válida: 44 dígitos com o DV correto
+def validar_chaves(chaves):
+    if np is None:
+        return [_chave_bem_formada(c) and calcular_dv_chave(c[:43]) == c[43] for c in chaves]
+    validas = [False] * len(chaves)
+    posicoes = [i for i, c in enumerate(chaves) if c and len(c) == 44 and c.isascii()]
+    if posicoes:
+        matriz = _matriz_de_chaves([chaves[i] for i in posicoes], 44)
+        digitos = ((matriz >= ord('0')) & (matriz <= ord('9'))).all(axis=1)
+        corretas = digitos & (_dvs_vetorizados(matriz) == matriz[:, 43])
+        for i, correta in zip(posicoes, corretas.tolist()):
+            validas[i] = correta
+    return validas
+
+
+# Chaves de acesso com formato ou DV inválido nos metadados dos documentos: Id da NFe, refNFe e
+# chNFe dos eventos. Devolve (documento, campo, valor) de cada uma.
+_CAMPOS_CHAVE = (('nfe', 'chave', 'Id'), ('nfe', 'ref_nfe', 'refNFe'), ('cancelamento', 'chave_cancelada', 'chNFe'))
+
+
+def verificar_chaves_documentos(documentos):
+    encontradas = []
+    for documento in documentos:
+        info = documento['info']
+        if not info:
+            continue
+        for tipo, campo, nome in _CAMPOS_CHAVE:
+            if info['tipo'] == tipo and info.get(campo):
+                encontradas.append((documento, nome, info[campo]))
+    return [item for item, valida in zip(encontradas, validar_chaves([valor for _, _, valor in encontradas])) if not valida]
+
+
+def _avisar_chaves_invalidas(documentos, limite=20):
+    invalidas = verificar_chaves_documentos(documentos)
+    if not invalidas:
+        return
+    print(f"[AVISO] {len(invalidas)} chave(s) de acesso com formato ou dígito verificador inválido:")
+    for documento, campo, valor in invalidas[:limite]:
+        print(f"  - {os.path.basename(documento['caminho_completo'])}: {campo} {valor}")
+    if len(invalidas) > limite:
+        print(f"  ... e mais {len(invalidas) - limite}.")
 
 
 # Carrega o arquivo de constantes (dados das empresas)
@@ -103,6 +442,10 @@ def carregar_constantes(caminho_arquivo='constantes.json'):
 
 # Pergunta ao usuário qual empresa deseja manipular
 def selecionar_empresa(constantes):
+    return constantes[_perguntar_empresa(constantes)]
+
+
+def _perguntar_empresa(constantes):
     empresas = list(constantes.keys())
     print("Empresas disponíveis:")
     for idx, nome in enumerate(empresas, 1):
@@ -110,15 +453,132 @@ def selecionar_empresa(constantes):
     while True:
         escolha = input("Digite o nome da empresa desejada: ").strip().upper()
         if escolha in empresas:
-            return constantes[escolha]
+            return escolha
         print("Empresa não encontrada. Tente novamente.")
 
-# Extrai informações relevantes de um XML de NFe para renomeação e manipulação
-def get_xml_info(file_path):
+
+# constantes.json do diretório atual ou, se não existir, o que acompanha o script
+def _caminho_constantes_padrao():
+    if os.path.exists('constantes.json'):
+        return 'constantes.json'
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'constantes.json')
+
+
+# Empresas pedidas na linha de comando (nomes sem diferenciar maiúsculas); sem opção, pergunta ao usuário
+def _resolver_empresas(constantes, nomes=None, todas=False):
+    if todas:
+        return list(constantes.keys())
+    if not nomes:
+        return [_perguntar_empresa(constantes)]
+    por_nome = {nome.upper(): nome for nome in constantes}
+    empresas = []
+    for nome in nomes:
+        empresa = por_nome.get(nome.strip().upper())
+        if empresa is None:
+            print(f"Erro: empresa '{nome}' não encontrada. Disponíveis: {', '.join(constantes)}.")
+            return None
+        if empresa not in empresas:
+            empresas.append(empresa)
+    return empresas
+
+# --- Registros compactos de documentos e metadados ---
+# Em pastas com centenas de milhares de XMLs, um dict por documento e outro por info ocupam mais
+# que os próprios dados. Os registros abaixo usam __slots__ (sem dict por instância) e mantêm o
+# acesso por chave do restante do script: registro['campo'], .get() e .pop(). dict(registro)
+# devolve os campos preenchidos.
+class _Registro:
+    __slots__ = ()
+
+    def __init__(self, **campos):
+        for campo, valor in campos.items():
+            setattr(self, campo, valor)
+
+    def __getitem__(self, campo):
+        try:
+            return getattr(self, campo)
+        except AttributeError:
+            raise KeyError(campo) from None
+
+    def __setitem__(self, campo, valor):
+        setattr(self, campo, valor)
+
+    def get(self, campo, padrao=None):
+        return getattr(self, campo, padrao)
+
+    def pop(self, campo, padrao=None):
+        valor = getattr(self, campo, padrao)
+        if hasattr(self, campo):
+            delattr(self, campo)
+        return valor
+
+    def keys(self):
+        return [campo for campo in self.__slots__ if hasattr(self, campo)]
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
+
+
+# XML carregado: a árvore só existe enquanto é necessária; tempos só com --metricas.
+# origem só é preenchida quando o XML não é lido de caminho_completo (membro de ZIP ou saída em ZIP).
+class Documento(_Registro):
+    __slots__ = ('caminho_completo', 'tipo', 'root', 'info', 'erro', 'tempos', 'origem')
+
+
+class InfoNFe(_Registro):
+    __slots__ = ('tipo', 'caminho_completo', 'nfe_number', 'cfop', 'nat_op', 'ref_nfe', 'x_texto', 'chave', 'emit_cnpj')
+
+
+class InfoCancelamento(_Registro):
+    __slots__ = ('tipo', 'caminho_completo', 'chave_cancelada')
+
+
+class InfoCTe(_Registro):
+    __slots__ = ('tipo', 'caminho_completo', 'chave_nfe')
+
+
+_REGISTROS_INFO = {'nfe': InfoNFe, 'cancelamento': InfoCancelamento, 'cte': InfoCTe}
+
+
+# Valores derivados da nova data e do novo emitente, calculados uma vez por execução (ou por lote
+# no monitoramento): todos os arquivos editados recebem o mesmo horário
+class ContextoExecucao(_Registro):
+    __slots__ = ('data', 'data_hora', 'ano', 'ano_mes', 'cnpj')
+
+
+# Info lida do cache (JSON) de volta ao registro correspondente
+def _info_de_dict(dados):
+    return _REGISTROS_INFO[dados['tipo']](**dados)
+
+
+# CFOP, natOp, xTexto e CNPJ se repetem em quase todas as notas: uma única cópia de cada texto
+def _internar(texto):
+    return sys.intern(texto) if texto else texto
+
+
+@lru_cache(maxsize=1024)
+def _somente_digitos(texto):
+    return ''.join(filter(str.isdigit, texto))
+
+
+# Analisador XML que preserva comentários (usado em todas as leituras completas)
+def _novo_parser():
+    return ET.XMLParser(target=ET.TreeBuilder(insert_comments=True))
+
+
+# Classifica o documento pela tag raiz, na mesma ordem usada pela etapa de edição
+def _classificar_raiz(root):
+    if 'procInutNFe' in root.tag:
+        return 'inutilizacao'
+    if 'cteProc' in root.tag or 'CTe' in root.tag:
+        return 'cte'
+    if 'procEventoNFe' in root.tag:
+        return 'evento'
+    return 'nfe'
+
+
+# Extrai informações relevantes de uma árvore de NFe já carregada
+def _extrair_info_nfe(root, file_path):
     try:
-        ET.register_namespace('', NS['nfe'])
-        tree = ET.parse(file_path)
-        root = tree.getroot()
         if 'procEventoNFe' in root.tag or 'cte' in root.tag.lower():
             return None
         inf_nfe = find_element_deep(root, 'infNFe')
@@ -137,27 +597,24 @@ def get_xml_info(file_path):
         nat_op = find_element(ide, 'natOp')
         ref_nfe_elem = find_element_deep(ide, 'NFref/refNFe')
         x_texto = find_element_deep(inf_nfe, 'infAdic/obsCont/xTexto')
-        return {
-            'tipo': 'nfe',
-            'caminho_completo': file_path,
-            'nfe_number': n_nf.text if n_nf is not None else '',
-            'cfop': cfop.text if cfop is not None else '',
-            'nat_op': nat_op.text if nat_op is not None else '',
-            'ref_nfe': ref_nfe_elem.text if ref_nfe_elem is not None else None,
-            'x_texto': x_texto.text if x_texto is not None else '',
-            'chave': chave,
-            'emit_cnpj': cnpj.text if cnpj is not None else ''
-        }
+        return InfoNFe(
+            tipo='nfe',
+            caminho_completo=file_path,
+            nfe_number=n_nf.text if n_nf is not None else '',
+            cfop=_internar(cfop.text) if cfop is not None else '',
+            nat_op=_internar(nat_op.text) if nat_op is not None else '',
+            ref_nfe=ref_nfe_elem.text if ref_nfe_elem is not None else None,
+            x_texto=_internar(x_texto.text) if x_texto is not None else '',
+            chave=chave,
+            emit_cnpj=_internar(cnpj.text) if cnpj is not None else ''
+        )
     except Exception:
         return None
 
 
-# Extrai informações de eventos de cancelamento de NFe
-def get_evento_info(file_path):
+# Extrai informações de eventos de cancelamento de uma árvore já carregada
+def _extrair_info_evento(root, file_path):
     try:
-        ET.register_namespace('', NS['nfe'])
-        tree = ET.parse(file_path)
-        root = tree.getroot()
         if 'procEventoNFe' not in root.tag:
             return None
         tp_evento = find_element_deep(root, 'evento/infEvento/tpEvento')
@@ -166,235 +623,1691 @@ def get_evento_info(file_path):
         chave_cancelada_elem = find_element_deep(root, 'evento/infEvento/chNFe')
         if chave_cancelada_elem is None:
             return None
-        return {
-            'tipo': 'cancelamento',
-            'caminho_completo': file_path,
-            'chave_cancelada': chave_cancelada_elem.text
-        }
+        return InfoCancelamento(
+            tipo='cancelamento',
+            caminho_completo=file_path,
+            chave_cancelada=chave_cancelada_elem.text
+        )
+    except Exception:
+        return None
+
+
+# Extrai do CT-e a chave da NFe transportada (infDoc/infNFe/chave), como _editar_cte a encontra;
+# chave_nfe é None quando o CT-e não a tem
+def _extrair_info_cte(root, file_path):
+    try:
+        inf_cte = find_element_deep(root, 'infCte')
+        inf_doc = find_element_deep(inf_cte, 'infCTeNorm/infDoc') if inf_cte is not None else None
+        chave = find_element_deep(inf_doc, 'infNFe/chave') if inf_doc is not None else None
+        return InfoCTe(tipo='cte', caminho_completo=file_path, chave_nfe=chave.text if chave is not None else None)
+    except Exception:
+        return None
+
+
+# Nome local de uma tag (sem o namespace)
+def _nome_local(tag):
+    return tag.rpartition('}')[2]
+
+
+# Marca campos ainda não encontrados durante a leitura incremental
+_AUSENTE = object()
+
+
+# Bloco <infAdic> localizado diretamente nos bytes (último grupo de infNFe, depois de todos os <det>)
+_RE_INF_ADIC = re.compile(rb'<(?:[\w.-]+:)?infAdic[\s>].*?</(?:[\w.-]+:)?infAdic\s*>', re.S)
+
+
+# Lê infAdic/obsCont/xTexto sem percorrer os itens; retorna None se a busca direta não for confiável
+def _x_texto_por_busca(dados):
+    if b'infAdic' not in dados:
+        return _AUSENTE
+    encontrado = _RE_INF_ADIC.search(dados)
+    if encontrado is None:
+        return None
+    try:
+        inf_adic = ET.fromstring(encontrado.group())
+    except ET.ParseError:
+        return None
+    for obs_cont in inf_adic:
+        if isinstance(obs_cont.tag, str) and _nome_local(obs_cont.tag) == 'obsCont':
+            for x_texto in obs_cont:
+                if isinstance(x_texto.tag, str) and _nome_local(x_texto.tag) == 'xTexto':
+                    return x_texto.text
+    return _AUSENTE
+
+
+# Leitura incremental da NFe: lê ide, emit e o primeiro <det>; infAdic é buscado direto nos bytes.
+# Se a busca direta falhar, continua a leitura incremental descartando cada <det> já lido.
+def _extrair_info_nfe_incremental(eventos, root, file_path, dados):
+    if 'procEventoNFe' in root.tag or 'cte' in root.tag.lower():
+        return None
+    campos = dict.fromkeys(('nfe_number', 'cfop', 'nat_op', 'ref_nfe', 'x_texto', 'emit_cnpj'), _AUSENTE)
+    chave, tem_ide, tem_emit = None, False, False
+    pilha, dentro = [], False  # nomes locais abaixo de infNFe
+    for evento, elem in eventos:
+        nome = _nome_local(elem.tag)
+        if evento == 'start':
+            if dentro:
+                pilha.append(nome)
+            elif nome == 'infNFe':
+                dentro, chave = True, elem.get('Id', 'NFe')[3:]
+            continue
+        if not dentro:
+            continue
+        if not pilha:  # fim do infNFe
+            break
+        n = len(pilha)
+        if n == 1:
+            tem_ide = tem_ide or nome == 'ide'
+            tem_emit = tem_emit or nome == 'emit'
+        elif n == 2:
+            if pilha[0] == 'ide' and nome == 'nNF' and campos['nfe_number'] is _AUSENTE:
+                campos['nfe_number'] = elem.text
+            elif pilha[0] == 'ide' and nome == 'natOp' and campos['nat_op'] is _AUSENTE:
+                campos['nat_op'] = elem.text
+            elif pilha[0] == 'emit' and nome == 'CNPJ' and campos['emit_cnpj'] is _AUSENTE:
+                campos['emit_cnpj'] = elem.text
+        else:
+            if nome == 'CFOP' and campos['cfop'] is _AUSENTE and pilha[-3:] == ['det', 'prod', 'CFOP']:
+                campos['cfop'] = elem.text
+                # ide e emit vêm antes dos itens: só falta o xTexto
+                x_texto = _x_texto_por_busca(dados)
+                if x_texto is not None:
+                    if x_texto is not _AUSENTE:
+                        campos['x_texto'] = x_texto
+                    break
+            elif nome == 'refNFe' and campos['ref_nfe'] is _AUSENTE and pilha[0] == 'ide' and pilha[-2] == 'NFref':
+                campos['ref_nfe'] = elem.text
+            elif nome == 'xTexto' and pilha[-3:] == ['infAdic', 'obsCont', 'xTexto']:
+                # infAdic é o último grupo lido: nada mais é necessário depois dele
+                campos['x_texto'] = elem.text
+                break
+        pilha.pop()
+        if nome == 'det':
+            elem.clear()
+    if not chave or not tem_ide or not tem_emit:
+        return None
+    valor = lambda campo, padrao='': padrao if campos[campo] is _AUSENTE else campos[campo]
+    return InfoNFe(
+        tipo='nfe',
+        caminho_completo=file_path,
+        nfe_number=valor('nfe_number'),
+        cfop=_internar(valor('cfop')),
+        nat_op=_internar(valor('nat_op')),
+        ref_nfe=valor('ref_nfe', None),
+        x_texto=_internar(valor('x_texto')),
+        chave=chave,
+        emit_cnpj=_internar(valor('emit_cnpj'))
+    )
+
+
+# Leitura incremental do evento: para assim que tpEvento e chNFe forem encontrados
+def _extrair_info_evento_incremental(eventos, root, file_path):
+    if 'procEventoNFe' not in root.tag:
+        return None
+    tp_evento, chave_cancelada = _AUSENTE, _AUSENTE
+    pilha = []  # nomes locais abaixo da raiz
+    for evento, elem in eventos:
+        if evento == 'start':
+            pilha.append(_nome_local(elem.tag))
+            continue
+        if not pilha:  # fim da raiz
+            break
+        if len(pilha) >= 3 and pilha[-3] == 'evento' and pilha[-2] == 'infEvento':
+            if pilha[-1] == 'tpEvento' and tp_evento is _AUSENTE:
+                tp_evento = elem.text
+                if tp_evento != '110111':
+                    return None
+            elif pilha[-1] == 'chNFe' and chave_cancelada is _AUSENTE:
+                chave_cancelada = elem.text
+            if tp_evento is not _AUSENTE and chave_cancelada is not _AUSENTE:
+                break
+        pilha.pop()
+    if tp_evento is _AUSENTE or chave_cancelada is _AUSENTE:
+        return None
+    return InfoCancelamento(
+        tipo='cancelamento',
+        caminho_completo=file_path,
+        chave_cancelada=chave_cancelada
+    )
+
+
+# Leitura incremental do CT-e: para na primeira infDoc/infNFe/chave de infCte/infCTeNorm.
+# Um CT-e malformado fica sem metadados; o erro é apontado na edição.
+def _extrair_info_cte_incremental(eventos, root, file_path):
+    pilha = []  # nomes locais abaixo da raiz
+    try:
+        for evento, elem in eventos:
+            if evento == 'start':
+                pilha.append(_nome_local(elem.tag))
+                continue
+            if not pilha:  # fim da raiz
+                break
+            if len(pilha) >= 5 and pilha[-1] == 'chave' and pilha[-2] == 'infNFe' and 'infDoc' in pilha:
+                i = pilha.index('infDoc')
+                if i < len(pilha) - 2 and pilha[i - 1] == 'infCTeNorm' and 'infCte' in pilha[:i - 1]:
+                    return InfoCTe(tipo='cte', caminho_completo=file_path, chave_nfe=elem.text)
+            pilha.pop()
+    except ET.ParseError:
+        return None
+    return InfoCTe(tipo='cte', caminho_completo=file_path, chave_nfe=None)
+
+
+# Tamanho dos blocos entregues ao analisador incremental
+_TAMANHO_BLOCO = 16 * 1024
+
+
+# Eventos de início/fim produzidos bloco a bloco; a análise para quando o consumidor para
+def _eventos_incrementais(dados):
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    for inicio in range(0, len(dados), _TAMANHO_BLOCO):
+        parser.feed(dados[inicio:inicio + _TAMANHO_BLOCO])
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+
+# Extração incremental dos metadados de renomeação: retorna (tipo, info).
+# Só é analisado o necessário: inutilizações param na raiz, eventos após tpEvento/chNFe, CT-e
+# após a chave da NFe e NFe após o primeiro item, sem construir a lista de <det> nem a assinatura.
+def extrair_metadados(file_path, origem=None):
+    with _abrir_origem(origem or file_path) as f:
+        dados = f.read()
+    eventos = _eventos_incrementais(memoryview(dados))
+    _, root = next(eventos)
+    tipo = _classificar_raiz(root)
+    info = None
+    if tipo == 'nfe':
+        info = _extrair_info_nfe_incremental(eventos, root, file_path, dados)
+    elif tipo == 'evento':
+        info = _extrair_info_evento_incremental(eventos, root, file_path)
+    elif tipo == 'cte':
+        info = _extrair_info_cte_incremental(eventos, root, file_path)
+    eventos.close()
+    return tipo, info
+
+
+# Extrai informações relevantes de um XML de NFe para renomeação e manipulação
+def get_xml_info(file_path):
+    try:
+        _, info = extrair_metadados(file_path)
+        return info if info and info['tipo'] == 'nfe' else None
     except Exception:
         return None
 
+
+# Extrai informações de eventos de cancelamento de NFe
+def get_evento_info(file_path):
+    try:
+        _, info = extrair_metadados(file_path)
+        return info if info and info['tipo'] == 'cancelamento' else None
+    except Exception:
+        return None
+
+
+# Carrega um XML uma única vez: árvore, tipo do documento e metadados de renomeação.
+# O mesmo documento é usado pela renomeação, pelos mapeamentos de chaves e pela edição.
+# Com manter_arvore=False os metadados vêm da leitura incremental e a edição relê o arquivo.
+def carregar_documento(origem, manter_arvore=True):
+    file_path = _caminho_da_origem(origem)
+    documento = Documento(caminho_completo=file_path, tipo=None, root=None, info=None, erro=None)
+    if file_path is not origem:
+        documento['origem'] = origem
+    if _METRICAS is not None:
+        documento['tempos'] = {}
+    inicio = time.perf_counter()
+    if not manter_arvore:
+        # Leitura incremental: parse e extração acontecem juntos
+        try:
+            documento['tipo'], documento['info'] = extrair_metadados(file_path, documento.get('origem'))
+        except Exception as e:
+            documento['erro'] = e
+        _cronometrar(documento.get('tempos'), 'extracao', inicio)
+        return documento
+    try:
+        with _abrir_origem(origem) as f:
+            root = _ler_arvore(f)
+    except Exception as e:
+        documento['erro'] = e
+        return documento
+    inicio = _cronometrar(documento.get('tempos'), 'parse', inicio)
+    documento['root'] = root
+    documento['tipo'] = _classificar_raiz(root)
+    documento['info'] = _extrair_info(root, documento['tipo'], file_path)
+    _cronometrar(documento.get('tempos'), 'extracao', inicio)
+    return documento
+
+
+# Metadados de renomeação de uma árvore já carregada, conforme o tipo do documento
+def _extrair_info(root, tipo, file_path):
+    if tipo == 'nfe':
+        return _extrair_info_nfe(root, file_path)
+    if tipo == 'evento':
+        return _extrair_info_evento(root, file_path)
+    if tipo == 'cte':
+        return _extrair_info_cte(root, file_path)
+    return None
+
+
+# Versão de carregar_documento para os processos do pool (a árvore não cruza processos)
+def _carregar_documento_em_processo(origem):
+    return carregar_documento(origem, manter_arvore=False)
+
+
+# --- Fontes de XML: pastas, subpastas e arquivos ZIP ---
+# Um XML vem de um arquivo solto (origem = caminho) ou de um membro de ZIP (origem =
+# (caminho_do_zip, membro), com caminho lógico caminho_do_zip/membro). Os membros são lidos
+# direto do ZIP, sem extração, e nunca são alterados dentro dele: só são gravados quando a
+# saída é um novo ZIP ou uma pasta de saída (--zip-saida, --pasta-saida).
+_ZIPS_ABERTOS = {}
+_MAX_ZIPS_ABERTOS = 8
+
+
+# ZIPs abertos para leitura, reaproveitados entre membros (os membros de um ZIP são lidos em sequência)
+def _zip_aberto(caminho_zip):
+    arquivo_zip = _ZIPS_ABERTOS.pop(caminho_zip, None)
+    if arquivo_zip is None:
+        if len(_ZIPS_ABERTOS) >= _MAX_ZIPS_ABERTOS:
+            _ZIPS_ABERTOS.pop(next(iter(_ZIPS_ABERTOS))).close()
+        arquivo_zip = zipfile.ZipFile(caminho_zip)
+    _ZIPS_ABERTOS[caminho_zip] = arquivo_zip  # Reinserido como o mais recente
+    return arquivo_zip
+
+
+def _fechar_zips():
+    while _ZIPS_ABERTOS:
+        _ZIPS_ABERTOS.popitem()[1].close()
+
+
+def _caminho_da_origem(origem):
+    return os.path.join(*origem) if isinstance(origem, tuple) else origem
+
+
+# Documento lido de dentro de um ZIP (origem (arquivo_zip, membro))
+def _membro_de_zip(documento):
+    return isinstance(documento.get('origem'), tuple)
+
+
+def _abrir_origem(origem):
+    if isinstance(origem, tuple):
+        return _zip_aberto(origem[0]).open(origem[1])
+    return open(origem, 'rb')
+
+
+# Membro que, juntado à pasta do ZIP ou à de saída, ficaria dentro dela: sem caminho absoluto,
+# letra de unidade nem '..'
+def _membro_seguro(nome):
+    partes = nome.replace('\\', '/').split('/')
+    return partes[0] != '' and ':' not in partes[0] and '..' not in partes
+
+
+def _membros_xml(caminho_zip):
+    try:
+        membros = [m.filename for m in _zip_aberto(caminho_zip).infolist() if m.filename.endswith('.xml') and not m.is_dir()]
+    except (OSError, zipfile.BadZipFile) as e:
+        print(f"  [ERRO] Não foi possível ler o ZIP {os.path.basename(caminho_zip)}: {e}")
+        return
+    for membro in membros:
+        if not _membro_seguro(membro):
+            print(f"  [AVISO] Membro {membro!r} do ZIP {os.path.basename(caminho_zip)} ignorado: "
+                  f"o caminho sairia da pasta do ZIP.")
+            continue
+        yield (caminho_zip, membro)
+
+
+# Percorre as origens dos XMLs de uma pasta sem montar antes a lista de todos os nomes;
+# opcionalmente desce nas subpastas (sem seguir links) e entra nos arquivos ZIP
+def _iterar_xmls(folder_path, recursivo=False, ler_zip=False):
+    subpastas = []
+    with os.scandir(folder_path) as entradas:
+        for entrada in entradas:
+            if entrada.name.endswith('.xml'):
+                yield entrada.path
+            elif ler_zip and entrada.name.lower().endswith('.zip') and entrada.is_file():
+                yield from _membros_xml(entrada.path)
+            elif recursivo and entrada.is_dir(follow_symlinks=False):
+                subpastas.append(entrada.path)
+    for subpasta in subpastas:
+        yield from _iterar_xmls(subpasta, recursivo, ler_zip)
+
+
+# Lista os XMLs de uma pasta
+def _listar_xmls(folder_path, recursivo=False, ler_zip=False):
+    return list(_iterar_xmls(folder_path, recursivo, ler_zip))
+
+
+# Árvores mantidas em memória entre a renomeação e a edição: no máximo limite_arvores_mb de XML
+# lido (cada MB de XML ocupa cerca de 8 MB como árvore). Os arquivos além do limite ficam só com os
+# metadados e são relidos na edição, então o pico de memória não cresce com o tamanho da pasta.
+# Com nfe=False (edição em texto), só as árvores dos demais documentos (CT-e, eventos, inutilizações)
+# são mantidas: a NF-e é editada nos bytes, relidos do disco, e a árvore dela não seria usada.
+_LIMITE_ARVORES_MB_PADRAO = 16
+_LIMITE_ARVORES = {'bytes': _LIMITE_ARVORES_MB_PADRAO * 1024 * 1024, 'nfe': True}
+
+
+def configurar_limite_arvores(limite_mb=_LIMITE_ARVORES_MB_PADRAO, nfe=True):
+    _LIMITE_ARVORES['nfe'] = nfe
+    try:
+        limite_mb = float(limite_mb)
+    except (TypeError, ValueError):
+        limite_mb = -1
+    if limite_mb < 0:
+        print(f"Aviso: valor de 'limite_arvores_mb' inválido. Usando {_LIMITE_ARVORES_MB_PADRAO}.")
+        limite_mb = _LIMITE_ARVORES_MB_PADRAO
+    _LIMITE_ARVORES['bytes'] = int(limite_mb * 1024 * 1024)
+
+
+def _tamanho_origem(origem):
+    try:
+        if isinstance(origem, tuple):
+            return _zip_aberto(origem[0]).getinfo(origem[1]).file_size
+        return os.path.getsize(origem)
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return 0
+
+
+# Carrega todos os XMLs de uma pasta, ou só os arquivos informados (um único parse por arquivo).
+# manter_arvores=False usa apenas a leitura incremental de metadados (renomeação sem edição); com
+# manter_arvores, as árvores são mantidas até o limite de _LIMITE_ARVORES (com a edição em texto, só
+# as dos documentos que não são NF-e).
+# Com cache, arquivos inalterados desde a última execução não são lidos: a edição os relê sob demanda.
+# recursivo inclui as subpastas e ler_zip os XMLs de dentro dos arquivos ZIP.
+def carregar_documentos(folder_path, workers=1, manter_arvores=True, cache=None, arquivos=None, recursivo=False,
+                        ler_zip=False):
+    ET.register_namespace('', NS['nfe'])
+    inicio = time.perf_counter()
+    xmls = _listar_xmls(folder_path, recursivo, ler_zip) if arquivos is None else list(arquivos)
+    _registrar_fase('listagem', inicio, len(xmls))
+    documentos = _consultar_cache(cache, folder_path, xmls) if cache is not None else [None] * len(xmls)
+    pendentes = [origem for origem, documento in zip(xmls, documentos) if documento is None]
+    if workers > 1 and len(pendentes) > 1:
+        carregados = list(_mapear_em_processos(_carregar_documento_em_processo, pendentes, workers))
+    else:
+        carregados, restante = [], _LIMITE_ARVORES['bytes'] if manter_arvores else 0
+        for origem in pendentes:
+            documento = carregar_documento(origem, restante > 0)
+            if documento['root'] is not None and documento['tipo'] == 'nfe' and not _LIMITE_ARVORES['nfe']:
+                documento['root'] = None
+            elif documento['root'] is not None:
+                restante -= _tamanho_origem(origem)
+            carregados.append(documento)
+    for documento in carregados:
+        _registrar_tempos(documento.pop('tempos', None), documento['caminho_completo'])
+    if cache is not None:
+        _gravar_cache(cache, carregados)
+    carregados = iter(carregados)
+    return [documento if documento is not None else next(carregados) for documento in documentos]
+
+
+# --- Cache persistente de metadados ---
+# Guarda (tipo, info) de cada XML em SQLite, validado pelo tamanho e mtime do arquivo.
+# Reexecuções sobre a mesma pasta reaproveitam os metadados sem abrir os XMLs.
+def _pasta_cache_padrao():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'manipuladorXML')
+
+
+# Abre (ou cria) o cache; retorna None se não for possível usá-lo.
+# somente_leitura (simulação e plano) só consulta um cache existente: nada é criado, gravado nem limpo.
+def abrir_cache_metadados(pasta_cache=None, limpar=False, somente_leitura=False):
+    pasta_cache = pasta_cache or _pasta_cache_padrao()
+    if somente_leitura:
+        caminho = os.path.join(pasta_cache, 'metadados.sqlite')
+        if limpar or not os.path.exists(caminho):
+            return None
+        try:
+            conexao = sqlite3.connect(f'file:{urllib.parse.quote(os.path.abspath(caminho))}?mode=ro', uri=True, timeout=60)
+            conexao.execute('SELECT 1 FROM metadados LIMIT 1')
+        except sqlite3.Error as e:
+            print(f"Aviso: cache de metadados indisponível ({e}). Continuando sem cache.")
+            return None
+        return {'conexao': conexao, 'acertos': 0, 'falhas': 0, 'somente_leitura': True}
+    try:
+        os.makedirs(pasta_cache, exist_ok=True)
+        # Várias empresas podem usar o mesmo cache ao mesmo tempo: espera o lock em vez de falhar
+        conexao = sqlite3.connect(os.path.join(pasta_cache, 'metadados.sqlite'), timeout=60)
+        conexao.execute(
+            'CREATE TABLE IF NOT EXISTS metadados ('
+            'caminho TEXT PRIMARY KEY, tamanho INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, tipo TEXT, info TEXT)'
+        )
+        if limpar:
+            conexao.execute('DELETE FROM metadados')
+            print("Cache de metadados limpo.")
+        conexao.commit()
+    except (OSError, sqlite3.Error) as e:
+        print(f"Aviso: cache de metadados indisponível ({e}). Continuando sem cache.")
+        return None
+    return {'conexao': conexao, 'acertos': 0, 'falhas': 0}
+
+
+def fechar_cache_metadados(cache):
+    if cache is not None:
+        cache['conexao'].close()
+
+
+# Assinatura usada para validar uma entrada do cache
+def _assinatura_arquivo(file_path):
+    st = os.stat(file_path)
+    return st.st_size, st.st_mtime_ns
+
+
+# Devolve, na ordem de xmls, o documento em cache (sem árvore) ou None quando é preciso ler o arquivo.
+# As linhas são percorridas direto do cursor, sem guardar o conteúdo da pasta inteira em memória.
+# Membros de ZIP não passam pelo cache (são sempre lidos).
+def _consultar_cache(cache, folder_path, xmls):
+    prefixo = os.path.join(os.path.abspath(folder_path), '')
+    posicoes = {os.path.abspath(file_path): i for i, file_path in enumerate(xmls) if isinstance(file_path, str)}
+    documentos = [None] * len(xmls)
+    linhas = cache['conexao'].execute(
+        'SELECT caminho, tamanho, mtime_ns, tipo, info FROM metadados WHERE caminho >= ? AND caminho < ?',
+        (prefixo, prefixo + '\uffff')
+    )
+    acertos = 0
+    for caminho, tamanho, mtime_ns, tipo, info in linhas:
+        i = posicoes.get(caminho)
+        if i is None:
+            continue
+        file_path = xmls[i]
+        try:
+            if (tamanho, mtime_ns) != _assinatura_arquivo(file_path):
+                continue
+        except OSError:
+            continue
+        if tipo == 'cte' and not info:
+            continue  # CT-e gravado sem metadados por uma versão anterior: é relido
+        if info:
+            info = _info_de_dict(json.loads(info))
+            info['caminho_completo'] = file_path
+        documentos[i] = Documento(caminho_completo=file_path, tipo=tipo, root=None, info=info or None, erro=None)
+        acertos += 1
+    cache['acertos'] += acertos
+    cache['falhas'] += len(posicoes) - acertos
+    return documentos
+
+
+# Grava (ou atualiza) os metadados dos documentos lidos sem erro (só arquivos soltos, lidos do próprio caminho)
+def _gravar_cache(cache, documentos):
+    if cache.get('somente_leitura'):
+        return
+    registros = []
+    for documento in documentos:
+        if documento['erro'] is not None or documento.get('origem') is not None:
+            continue
+        try:
+            tamanho, mtime_ns = _assinatura_arquivo(documento['caminho_completo'])
+        except OSError:
+            continue
+        info = json.dumps(dict(documento['info']), ensure_ascii=False) if documento['info'] else None
+        registros.append((os.path.abspath(documento['caminho_completo']), tamanho, mtime_ns, documento['tipo'], info))
+    if registros:
+        with cache['conexao']:
+            cache['conexao'].executemany('INSERT OR REPLACE INTO metadados VALUES (?, ?, ?, ?, ?)', registros)
+
+
+# Move as entradas de arquivos renomeados para o novo caminho
+def _renomear_no_cache(cache, renomeados):
+    if not renomeados or cache.get('somente_leitura'):
+        return
+    with cache['conexao']:
+        cache['conexao'].executemany(
+            'DELETE FROM metadados WHERE caminho = ?', [(os.path.abspath(antigo),) for antigo, _ in renomeados]
+        )
+    _gravar_cache(cache, [documento for _, documento in renomeados])
+
+
+# Linha de resumo do cache (contadores zerados a cada etapa)
+def _resumir_cache(cache):
+    if cache is None or not (cache['acertos'] or cache['falhas']):
+        return
+    print(f"Cache de metadados: {cache['acertos']} acertos, {cache['falhas']} falhas.")
+    cache['acertos'], cache['falhas'] = 0, 0
+
+
+# --- Gravação atômica e diário de execução ---
+# Cada XML editado é gravado em um temporário ao lado do original e só substitui o original via os.replace, então
+# uma interrupção nunca deixa um XML truncado. As substituições são confirmadas em lotes: a cada
+# lote a pasta e o diário são sincronizados com o disco uma única vez. O diário (JSONL na própria
+# pasta) registra os arquivos já confirmados; se a execução for interrompida, a próxima pula esses
+# arquivos. Ao fim de uma etapa concluída o diário é removido. Os arquivos são registrados pelo
+# caminho relativo à pasta (em subpastas, com --recursivo).
+_SUFIXO_TEMPORARIO = '.manipuladorXML.tmp'
+_TAMANHO_LOTE_GRAVACAO = 200
+
+
+def _caminho_temporario(file_path):
+    return file_path + _SUFIXO_TEMPORARIO
+
+
+def abrir_diario(folder_path, etapa, sincronizar=True, recursivo=False):
+    caminho = os.path.join(folder_path, f".manipuladorXML-{etapa}.jsonl")
+    concluidos = {}
+    if os.path.exists(caminho):
+        with open(caminho, encoding='utf-8') as f:
+            for linha in f:
+                try:
+                    registro = json.loads(linha)
+                except json.JSONDecodeError:
+                    continue  # Última linha incompleta de uma gravação interrompida
+                concluidos[registro['arquivo']] = (registro.get('tamanho'), registro.get('mtime_ns'))
+        print(f"Diário de execução interrompida encontrado: {len(concluidos)} arquivos já concluídos serão mantidos.")
+    # Temporários de um lote não confirmado são descartados
+    _remover_temporarios(folder_path, recursivo)
+    return {
+        'pasta': folder_path,
+        'caminho': caminho,
+        'arquivo': open(caminho, 'a', encoding='utf-8'),
+        'concluidos': concluidos,
+        'pendentes': [],
+        'registros': [],
+        'pastas_alteradas': set(),
+        'sincronizar': sincronizar,
+    }
+
+
+def _remover_temporarios(folder_path, recursivo=False):
+    subpastas = []
+    with os.scandir(folder_path) as entradas:
+        for entrada in entradas:
+            if entrada.name.endswith(_SUFIXO_TEMPORARIO):
+                os.remove(entrada.path)
+            elif recursivo and entrada.is_dir(follow_symlinks=False):
+                subpastas.append(entrada.path)
+    for subpasta in subpastas:
+        _remover_temporarios(subpasta, recursivo)
+
+
+def _nome_no_diario(diario, file_path):
+    return os.path.relpath(file_path, diario['pasta'])
+
+
+def fechar_diario(diario, concluido=True):
+    if diario is None:
+        return
+    _confirmar_lote(diario)
+    diario['arquivo'].close()
+    if concluido:
+        os.remove(diario['caminho'])
+
+
+# Arquivo já gravado por uma execução anterior e não modificado desde então
+def _ja_concluido(diario, file_path):
+    if diario is None:
+        return False
+    registrado = diario['concluidos'].get(_nome_no_diario(diario, file_path))
+    if registrado is None:
+        return False
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return False
+    return registrado == (st.st_size, st.st_mtime_ns)
+
+
+# Agenda a substituição do original pelo temporário; sem diário, substitui na hora
+def _agendar_gravacao(diario, file_path):
+    if diario is None:
+        inicio = time.perf_counter()
+        os.replace(_caminho_temporario(file_path), file_path)
+        _registrar_fase('confirmacao', inicio, 1)
+        return
+    diario['pendentes'].append(file_path)
+    diario['pastas_alteradas'].add(os.path.dirname(file_path))
+    if len(diario['pendentes']) + len(diario['registros']) >= _TAMANHO_LOTE_GRAVACAO:
+        _confirmar_lote(diario)
+
+
+# Registra uma renomeação (já atômica via os.rename) para ser sincronizada no próximo lote
+def _registrar_renomeacao(diario, caminho_antigo, caminho_novo):
+    if diario is None:
+        return
+    diario['registros'].append({'arquivo': _nome_no_diario(diario, caminho_novo), 'de': _nome_no_diario(diario, caminho_antigo)})
+    diario['pastas_alteradas'].add(os.path.dirname(caminho_novo))
+    if len(diario['pendentes']) + len(diario['registros']) >= _TAMANHO_LOTE_GRAVACAO:
+        _confirmar_lote(diario)
+
+
+def _confirmar_lote(diario):
+    inicio, confirmados = time.perf_counter(), len(diario['pendentes'])
+    for file_path in diario['pendentes']:
+        os.replace(_caminho_temporario(file_path), file_path)
+        st = os.stat(file_path)
+        diario['registros'].append({'arquivo': _nome_no_diario(diario, file_path), 'tamanho': st.st_size, 'mtime_ns': st.st_mtime_ns})
+    diario['pendentes'] = []
+    if not diario['registros']:
+        return
+    # Os nomes só entram no diário depois que as pastas (substituições/renomeações) estão no disco
+    if diario['sincronizar']:
+        for pasta in diario['pastas_alteradas']:
+            _sincronizar_pasta(pasta)
+    diario['pastas_alteradas'] = set()
+    arquivo = diario['arquivo']
+    arquivo.write(''.join(json.dumps(registro, ensure_ascii=False) + '\n' for registro in diario['registros']))
+    arquivo.flush()
+    if diario['sincronizar']:
+        os.fsync(arquivo.fileno())
+    diario['registros'] = []
+    _registrar_fase('confirmacao', inicio, confirmados)
+
+
+def _sincronizar_pasta(folder_path):
+    if not hasattr(os, 'O_DIRECTORY'):
+        return  # No Windows não é possível sincronizar a entrada da pasta
+    fd = os.open(folder_path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# --- Saída e registro de alterações ---
+# Nível de detalhe do console: 0 mostra apenas resumos e erros, 1 uma linha por arquivo renomeado
+# ou editado e 2 também cada alteração. O registro JSONL opcional (--log-alteracoes) recebe todas
+# as alterações, gravado em buffer para não pesar no laço de edição.
+_SAIDA = {'verbosidade': 0, 'log': None}
+_BUFFER_LOG = 1024 * 1024
+
+
+def configurar_saida(verbosidade=0, caminho_log=None):
+    fechar_saida()
+    _SAIDA['verbosidade'] = verbosidade
+    if caminho_log:
+        _SAIDA['log'] = open(caminho_log, 'a', encoding='utf-8', buffering=_BUFFER_LOG)
+
+
+def fechar_saida():
+    if _SAIDA['log'] is not None:
+        _SAIDA['log'].close()
+        _SAIDA['log'] = None
+
+
+def _detalhar(nivel):
+    return _SAIDA['verbosidade'] >= nivel
+
+
+def _registrar_log(registro):
+    if _SAIDA['log'] is not None:
+        _SAIDA['log'].write(json.dumps(registro, ensure_ascii=False) + '\n')
+
+
+# As alterações são pares (regra, detalhe): a regra é fixa e alimenta os contadores,
+# o detalhe (nova chave, nova data) só é formatado quando exibido ou registrado
+def _mensagem_alteracao(regra, detalhe):
+    return f"{regra} {detalhe}" if detalhe else regra
+
+
+# Regras por campo, formatadas uma única vez em vez de a cada item <det>
+@lru_cache(maxsize=None)
+def _regra_campo(grupo, campo):
+    return (f"{grupo}: <{campo}> alterado", '')
+
+
+@lru_cache(maxsize=None)
+def _regra_cst(imposto):
+    return (f"CST do {imposto} alterado", '')
+
+
+def _resumir_regras(contadores):
+    if not contadores:
+        return
+    print("Alterações por regra (arquivos):")
+    for regra, arquivos in sorted(contadores.items(), key=lambda item: (-item[1], item[0])):
+        print(f"  {arquivos:8d}  {regra}")
+
+
+# --- Métricas de execução ---
+# Instrumentação opcional (--metricas): tempo e arquivos por fase, arquivos mais lentos e pico
+# de memória. Desligada, _METRICAS é None e os registros abaixo retornam de imediato.
+# Nos processos do pool, os tempos de cada arquivo voltam junto com o resultado e são somados aqui.
+_METRICAS = None
+
+
+def iniciar_metricas():
+    global _METRICAS
+    _METRICAS = {'inicio': time.perf_counter(), 'fases': {}, 'por_arquivo': {}}
+
+
+# Acumula o tempo desde 'inicio' em tempos[fase] (quando há métricas); retorna o instante atual
+def _cronometrar(tempos, fase, inicio):
+    agora = time.perf_counter()
+    if tempos is not None:
+        tempos[fase] = tempos.get(fase, 0.0) + agora - inicio
+    return agora
+
+
+# Soma os tempos de um arquivo às fases (um arquivo por fase) e ao total do arquivo
+def _registrar_tempos(tempos, file_path):
+    if _METRICAS is None or not tempos:
+        return
+    for fase, segundos in tempos.items():
+        acumulado = _METRICAS['fases'].setdefault(fase, [0.0, 0])
+        acumulado[0] += segundos
+        acumulado[1] += 1
+    por_arquivo = _METRICAS['por_arquivo']
+    por_arquivo[file_path] = por_arquivo.get(file_path, 0.0) + sum(tempos.values())
+
+
+# Fase medida de uma vez para vários arquivos (listagem, mapeamentos, gravação em lote)
+def _registrar_fase(fase, inicio, arquivos):
+    if _METRICAS is None:
+        return
+    acumulado = _METRICAS['fases'].setdefault(fase, [0.0, 0])
+    acumulado[0] += time.perf_counter() - inicio
+    acumulado[1] += arquivos
+
+
+# Mantém o total por arquivo associado ao nome novo após a renomeação
+def _renomear_nas_metricas(caminho_antigo, caminho_novo):
+    if _METRICAS is not None and caminho_antigo in _METRICAS['por_arquivo']:
+        _METRICAS['por_arquivo'][caminho_novo] = _METRICAS['por_arquivo'].pop(caminho_antigo)
+
+
+# Pico de memória residente em MB: deste processo e do maior processo filho (pool)
+def _pico_memoria_mb():
+    if resource is None:
+        return None
+    escala = 1024 * 1024 if sys.platform == 'darwin' else 1024  # ru_maxrss: bytes no macOS, KB no Linux
+    return {
+        'processo': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / escala, 1),
+        'maior_filho': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / escala, 1),
+    }
+
+
+def relatorio_metricas(mais_lentos=10):
+    if _METRICAS is None:
+        return None
+    fases = {}
+    for fase, (segundos, arquivos) in _METRICAS['fases'].items():
+        fases[fase] = {
+            'segundos': round(segundos, 4),
+            'arquivos': arquivos,
+            'arquivos_por_segundo': round(arquivos / segundos, 1) if segundos else None,
+        }
+    lentos = heapq.nlargest(mais_lentos, _METRICAS['por_arquivo'].items(), key=lambda item: item[1])
+    return {
+        'segundos_total': round(time.perf_counter() - _METRICAS['inicio'], 4),
+        'fases': fases,
+        'arquivos_mais_lentos': [{'arquivo': caminho, 'segundos': round(segundos, 4)} for caminho, segundos in lentos],
+        'pico_memoria_mb': _pico_memoria_mb(),
+    }
+
+
+def imprimir_metricas(relatorio):
+    print("\n---------------------- MÉTRICAS DE EXECUÇÃO ----------------------")
+    print(f"Tempo total: {relatorio['segundos_total']:.2f}s")
+    for fase, dados in relatorio['fases'].items():
+        taxa = f"{dados['arquivos_por_segundo']:.1f} arq/s" if dados['arquivos_por_segundo'] else "-"
+        print(f"  {fase:22s} {dados['segundos']:9.3f}s  {dados['arquivos']:8d} arquivos  {taxa}")
+    if relatorio['arquivos_mais_lentos']:
+        print("Arquivos mais lentos:")
+        for item in relatorio['arquivos_mais_lentos']:
+            print(f"  {item['segundos'] * 1000:9.1f} ms  {os.path.basename(item['arquivo'])}")
+    if relatorio['pico_memoria_mb']:
+        memoria = relatorio['pico_memoria_mb']
+        print(f"Pico de memória: {memoria['processo']} MB (maior processo filho: {memoria['maior_filho']} MB)")
+
+
+# --- Execução paralela ---
+# Contexto de edição somente leitura, instalado em cada processo do pool
+_CONTEXTO_PROCESSO = None
+
+
+def _inicializar_processo(contexto=None, metricas=False, backend_xml=None):
+    global _CONTEXTO_PROCESSO
+    _CONTEXTO_PROCESSO = contexto
+    # Mesmo backend do processo pai (que já conferiu se o lxml está disponível)
+    if backend_xml:
+        _BACKEND_XML['nome'] = backend_xml
+    # Um ZIP herdado do processo pai compartilharia a posição de leitura com ele
+    _ZIPS_ABERTOS.clear()
+    # Nos processos do pool as métricas só sinalizam que os tempos devem ser devolvidos
+    if metricas:
+        iniciar_metricas()
+    ET.register_namespace('', NS['nfe'])
+    ET.register_namespace('ds', NS_DS['ds'])
+
+
+# Aplica func aos itens em um pool de processos, devolvendo os resultados na ordem original
+def _mapear_em_processos(func, itens, workers, contexto=None):
+    chunksize = max(1, len(itens) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_inicializar_processo,
+                             initargs=(contexto, _METRICAS is not None, _BACKEND_XML['nome'])) as executor:
+        yield from executor.map(func, itens, chunksize=chunksize)
+
+
+# Número de processos: linha de comando > configuracao_execucao.workers > 1 (0 = todos os núcleos)
+def _resolver_workers(workers_cli, configs):
+    workers = workers_cli if workers_cli is not None else configs.get('workers', 1)
+    try:
+        workers = int(workers)
+    except (TypeError, ValueError):
+        print(f"Aviso: valor de 'workers' inválido ('{workers}'). Usando execução sequencial.")
+        return 1
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+# --- Leitura e gravação em segundo plano ---
+# Na edição sequencial, cada arquivo é lido, editado e gravado em série, e a CPU fica parada
+# enquanto o disco lê ou grava (e sincroniza) o arquivo. Em pastas de rede ou discos lentos essa
+# espera domina. Com threads_io > 0, essa quantidade de threads busca os bytes dos próximos arquivos
+# (no máximo fila_leitura à frente) enquanto o processo principal faz o parse e a edição, e outras
+# tantas gravam os temporários (no máximo fila_gravacao conteúdos em memória). Os resultados
+# continuam na ordem dos arquivos, e cada temporário já está gravado quando entra no diário.
+# Membros de ZIP são lidos pelo processo principal. Com workers > 1, cada processo lê e grava os
+# próprios arquivos.
+_PIPELINE_IO_PADRAO = {'threads_io': 0, 'fila_leitura': 64, 'fila_gravacao': 64}
+_PIPELINE_IO = dict(_PIPELINE_IO_PADRAO)
+
+
+# Valores inválidos são avisados e substituídos pelo padrão
+def configurar_pipeline_io(threads_io=0, fila_leitura=64, fila_gravacao=64):
+    valores = {'threads_io': threads_io, 'fila_leitura': fila_leitura, 'fila_gravacao': fila_gravacao}
+    for nome, valor in valores.items():
+        minimo = 0 if nome == 'threads_io' else 1
+        try:
+            numero = int(valor)
+        except (TypeError, ValueError):
+            numero = minimo - 1
+        if numero < minimo:
+            numero = _PIPELINE_IO_PADRAO[nome]
+            print(f"Aviso: valor de '{nome}' inválido ('{valor}'). Usando {numero}.")
+        _PIPELINE_IO[nome] = numero
+
+
+def _ler_bytes(caminho):
+    with open(caminho, 'rb') as f:
+        return f.read()
+
+
+# Só arquivos soltos sem árvore em memória são lidos pelas threads
+def _agendar_leitura(executor, documento):
+    if documento['root'] is not None or documento['erro'] is not None or _membro_de_zip(documento):
+        return None
+    return executor.submit(_ler_bytes, documento.get('origem') or documento['caminho_completo'])
+
+
+# Os bytes lidos, ou None (lidos depois, pelo próprio _editar_documento); uma falha de leitura
+# vira o erro do documento, como uma falha do carregamento
+def _leitura_concluida(documento, futuro):
+    if futuro is None:
+        return documento, None
+    try:
+        return documento, futuro.result()
+    except OSError as e:
+        documento['erro'] = e
+        return documento, None
+
+
+# Percorre os documentos com a leitura dos próximos já em andamento: (documento, bytes ou None)
+def _pre_carregar(documentos, threads, profundidade):
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        fila = deque()
+        for documento in documentos:
+            fila.append((documento, _agendar_leitura(executor, documento)))
+            if len(fila) > profundidade:
+                yield _leitura_concluida(*fila.popleft())
+        while fila:
+            yield _leitura_concluida(*fila.popleft())
+
+
+def _gravar_temporario(file_path, conteudo, sincronizar, tempos):
+    inicio = time.perf_counter()
+    _gravar_texto(_caminho_temporario(file_path), conteudo, sincronizar)
+    _cronometrar(tempos, 'gravacao', inicio)
+
+
+# Resultado de _editar_documento depois da gravação do temporário; uma falha de gravação vira
+# o erro do documento, e o temporário incompleto é removido
+def _gravacao_concluida(documento, resultado, futuro):
+    if futuro is None:
+        return resultado
+    msg, alteracoes, _, info, tempos, _ = resultado
+    try:
+        futuro.result()
+    except OSError as e:
+        temporario = _caminho_temporario(documento['caminho_completo'])
+        if os.path.exists(temporario):
+            os.remove(temporario)
+        return msg, alteracoes, f"Falha ao editar {os.path.basename(documento['caminho_completo'])}: {e}", None, tempos, None
+    return msg, alteracoes, None, info, tempos, None
+
+
+# Edição sequencial com leitura antecipada e gravação em segundo plano; devolve os resultados de
+# _editar_documento na ordem dos documentos, já com os temporários gravados
+def _editar_com_pipeline_io(documentos, contexto):
+    gravar_depois = not contexto['simular'] and not contexto['saida_externa']
+    lidos = _pre_carregar(documentos, _PIPELINE_IO['threads_io'], _PIPELINE_IO['fila_leitura'])
+    if not gravar_depois:
+        for documento, dados in lidos:
+            yield _editar_documento(documento, contexto, dados)
+        return
+    with ThreadPoolExecutor(max_workers=_PIPELINE_IO['threads_io']) as gravador:
+        fila = deque()
+        for documento, dados in lidos:
+            resultado = _editar_documento(documento, contexto, dados, gravar=False)
+            futuro = None
+            if resultado[5] is not None:
+                futuro = gravador.submit(_gravar_temporario, documento['caminho_completo'], resultado[5],
+                                         contexto['sincronizar'], resultado[4])
+            fila.append((documento, resultado, futuro))
+            if len(fila) > _PIPELINE_IO['fila_gravacao']:
+                yield _gravacao_concluida(*fila.popleft())
+        while fila:
+            yield _gravacao_concluida(*fila.popleft())
+
+
 # --- Função principal de processamento e manipulação dos arquivos XML ---
-def processar_arquivos(folder_path):
+# Retorna os documentos carregados (com caminhos já atualizados) para reaproveitamento na edição.
+# Sem manter_arvores, apenas os metadados são lidos (extração incremental).
+# Com saida (ZIP ou pasta de saída), os originais não são renomeados: os novos nomes valem apenas no destino.
+# regras são as regras compiladas da empresa (compilar_regras); sem elas, valem as regras padrão.
+def processar_arquivos(folder_path, documentos=None, workers=1, manter_arvores=False, cache=None, sincronizar=True,
+                       simular=False, recursivo=False, ler_zip=False, saida=None, regras=None):
     print("\n========== ETAPA 1: ORGANIZAÇÃO E RENOMEAÇÃO DOS ARQUIVOS ==========")
-    xmls = [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith('.xml')]
-    if not xmls:
+    if documentos is None:
+        documentos = carregar_documentos(folder_path, workers, manter_arvores, cache, recursivo=recursivo, ler_zip=ler_zip)
+    if not documentos:
         print("Nenhum arquivo XML encontrado na pasta para processar.")
-        return
+        return documentos
 
     print("Buscando arquivos XML para renomear...")
 
-    nfe_infos, eventos_info = _extrair_infos_xmls(xmls)
-    total_renomeados, total_puladas, total_erros = 0, 0, 0
-
-    resultado_nfe = _renomear_nfe(nfe_infos, folder_path)
-    total_renomeados += resultado_nfe['renomeados']
-    total_puladas += resultado_nfe['pulados']
-    total_erros += resultado_nfe['erros']
-
-    resultado_eventos = _renomear_eventos(eventos_info, nfe_infos, folder_path)
-    total_renomeados += resultado_eventos['renomeados']
-    total_erros += resultado_eventos['erros']
+    if simular:
+        print("Simulação (--dry-run): nenhum arquivo será renomeado.")
+    diario = abrir_diario(folder_path, 'renomear', sincronizar, recursivo) if not simular and saida is None else None
+    total_renomeados, total_puladas, total_erros = _renomear_documentos(
+        documentos, folder_path, cache=cache, diario=diario, simular=simular, saida=saida, regras=regras
+    )
+    fechar_diario(diario)
 
+    _resumir_cache(cache)
     _resumir_renomeacao(total_renomeados, total_puladas, total_erros)
-
-def _extrair_infos_xmls(xmls):
-    nfe_infos = {}
+    return documentos
+
+
+# Renomeia NFes e eventos e sincroniza os documentos com os novos nomes.
+# grafo (ver novo_grafo) permite resolver eventos de notas de lotes anteriores e recebe as
+# NFes e referências deste lote. Cada arquivo é renomeado na própria pasta.
+# Membros de ZIP só são renomeados com saída em ZIP; sem ela, servem apenas de referência.
+def _renomear_documentos(documentos, folder_path, grafo=None, cache=None, diario=None, simular=False,
+                         saida=None, regras=None):
+    grafo = novo_grafo() if grafo is None else grafo
+    nfe_infos, eventos_info = _extrair_infos_xmls(documentos, grafo)
+    # No plano, como no disco, os membros de ZIP não são renomeados; os nomes novos são virtuais
+    fixos = set()
+    if saida is None or saida['tipo'] == 'plano':
+        fixos = {d['caminho_completo'] for d in documentos if d.get('origem') is not None}
+    ocupados = None if saida is None else {d['caminho_completo'] for d in documentos}
+
+    inicio = time.perf_counter()
+    # Os pedidos e os nomes em uso só vivem durante o planejamento (em pastas muito grandes, são
+    # o pico de memória da etapa)
+    renomeacoes, com_sufixo = _planejar_renomeacoes(
+        _pedidos_de_renomeacao(nfe_infos, eventos_info, grafo, regras or _regras_padrao(), fixos), ocupados)
+    total_renomeados, total_puladas, total_erros = len(renomeacoes), 0, 0
+    if ocupados is not None:
+        # Saída externa: só o nome com que cada arquivo será gravado muda
+        for info, caminho_novo in renomeacoes:
+            _registrar_log({'etapa': 'renomear', 'de': info['caminho_completo'], 'para': caminho_novo})
+            info['caminho_completo'] = caminho_novo
+    else:
+        por_origem = {info['caminho_completo']: info for info, _ in renomeacoes}
+        passos, ciclos = _ordenar_renomeacoes([(info['caminho_completo'], caminho_novo)
+                                               for info, caminho_novo in renomeacoes])
+        if simular:
+            if _detalhar(1):
+                for _, para, origem in passos:
+                    if origem is not None:
+                        print(f"  [SIMULAÇÃO] {os.path.basename(origem)} -> {os.path.basename(para)}")
+        else:
+            feitos, total_puladas, total_erros = _executar_renomeacoes(passos, diario)
+            for origem, caminho_novo in feitos.items():
+                por_origem[origem]['caminho_completo'] = caminho_novo
+            total_renomeados = len(feitos)
+        if ciclos:
+            print(f"{ciclos} ciclo(s) de nomes (A -> B e B -> A) resolvido(s) com um nome temporário.")
+    if com_sufixo:
+        print(f"{com_sufixo} arquivo(s) com destino já em uso renomeado(s) com sufixo numérico ('nome (2).xml').")
+    _registrar_fase('renomeacao', inicio, total_renomeados)
+    if _detalhar(1):
+        _resumir_referencias(grafo)
+
+    # Sincroniza os documentos com os novos nomes dos arquivos
+    renomeados = []
+    for documento in documentos:
+        if documento['info'] and documento['caminho_completo'] != documento['info']['caminho_completo']:
+            renomeados.append((documento['caminho_completo'], documento))
+            _renomear_nas_metricas(documento['caminho_completo'], documento['info']['caminho_completo'])
+            if saida is not None and documento.get('origem') is None:
+                documento['origem'] = documento['caminho_completo']  # O original continua onde estava
+                if saida['tipo'] == 'plano':
+                    saida['renomeacoes'].append((documento['origem'], documento['info']['caminho_completo']))
+            documento['caminho_completo'] = documento['info']['caminho_completo']
+    if cache is not None and saida is None:
+        _renomear_no_cache(cache, renomeados)
+    return total_renomeados, total_puladas, total_erros
+
+# --- Grafo de relacionamentos entre documentos ---
+# As NFes ficam indexadas pela chave de acesso completa, e cada referência (refNFe de devoluções,
+# retornos e remessas simbólicas, chNFe dos cancelamentos, infDoc/infNFe/chave do CT-e) liga o
+# documento à nota referenciada. Notas de emitentes ou séries diferentes com o mesmo número não se
+# sobrepõem. Uma chave que não está na pasta (por exemplo, já remapeada em uma execução anterior)
+# é resolvida pelo identificador da nota, desde que uma única nota o tenha. O mesmo grafo serve a
+# renomeação (nomes dos cancelamentos e das notas com refNFe), os mapeamentos de chaves e a edição
+# (_resolver_chave).
+def novo_grafo():
+    return {'notas': {}, 'por_identificador': None, 'referencias': []}
+
+
+# por_identificador só é montado na primeira chave que não está em notas (em geral todas estão) e
+# guarda a única chave com cada identificador, ou '' quando há mais de uma: em pastas muito grandes,
+# um índice completo custaria quase tanto quanto as próprias infos.
+def _indexar_nota(grafo, info):
+    grafo['notas'][info['chave']] = info
+    if grafo['por_identificador'] is not None:
+        _indexar_identificador(grafo['por_identificador'], info['chave'])
+
+
+def _indexar_identificador(por_identificador, chave):
+    identificador = _identificador_nota(chave)
+    if por_identificador.setdefault(identificador, chave) != chave:
+        por_identificador[identificador] = ''
+
+
+# Acrescenta ao grafo as NFes e os documentos com referência, em uma única passada.
+# Retorna as NFes e os eventos de cancelamento destes documentos.
+def _extrair_infos_xmls(documentos, grafo=None):
+    grafo = novo_grafo() if grafo is None else grafo
+    referencias = grafo['referencias']
+    nfe_infos = []
     eventos_info = []
-    for file_path in xmls:
-        info = get_xml_info(file_path)
-        if info:
-            nfe_infos[info['nfe_number']] = info
+    for documento in documentos:
+        info = documento['info']
+        if not info:
             continue
-        evento = get_evento_info(file_path)
-        if evento:
-            eventos_info.append(evento)
+        if info['tipo'] == 'nfe':
+            nfe_infos.append(info)
+            if info['chave']:
+                _indexar_nota(grafo, info)
+        elif info['tipo'] == 'cancelamento':
+            eventos_info.append(info)
+        if _chave_referenciada(info):
+            referencias.append(info)
     return nfe_infos, eventos_info
 
-def _renomear_nfe(nfe_infos, folder_path):
-    total_renomeados, total_puladas, total_erros = 0, 0, 0
-    for nfe_number, info in nfe_infos.items():
-        novo_nome = _gerar_novo_nome_nfe(info)
-        if novo_nome:
-            caminho_novo_nome = os.path.join(folder_path, novo_nome)
-            if not os.path.exists(caminho_novo_nome):
-                try:
-                    os.rename(info['caminho_completo'], caminho_novo_nome)
-                    print(f"  [OK] {os.path.basename(info['caminho_completo'])} -> {novo_nome}")
-                    total_renomeados += 1
-                except Exception as e:
-                    print(f"  [ERRO] Falha ao renomear {os.path.basename(info['caminho_completo'])}: {e}")
-                    total_erros += 1
-            elif os.path.basename(info['caminho_completo']) != novo_nome:
-                print(f"  [PULADO] '{os.path.basename(info['caminho_completo'])}' já possui destino '{novo_nome}'.")
-                total_puladas += 1
-    return {'renomeados': total_renomeados, 'pulados': total_puladas, 'erros': total_erros}
 
-def _gerar_novo_nome_nfe(info):
-    cfop = info.get('cfop')
-    nat_op = info.get('nat_op', '')
+# Chave da nota referenciada por um documento (refNFe, chNFe do cancelamento, chave do CT-e)
+_CAMPO_REFERENCIA = {'nfe': 'ref_nfe', 'cancelamento': 'chave_cancelada', 'cte': 'chave_nfe'}
+
+
+def _chave_referenciada(info):
+    return info.get(_CAMPO_REFERENCIA[info['tipo']])
+
+
+# Nota (info) referenciada por uma chave, ou None se ela não estiver no grafo
+def nota_referenciada(grafo, chave):
+    if not chave:
+        return None
+    info = grafo['notas'].get(chave)
+    if info is None and len(chave) >= 43:
+        if grafo['por_identificador'] is None:
+            grafo['por_identificador'] = {}
+            for chave_nota in grafo['notas']:
+                _indexar_identificador(grafo['por_identificador'], chave_nota)
+        unica = grafo['por_identificador'].get(_identificador_nota(chave))
+        if unica:
+            info = grafo['notas'][unica]
+    return info
+
+
+# Nova chave da nota referenciada por uma chave (antiga ou já remapeada), ou None se a nota não
+# está no grafo ou não foi remapeada
+def _resolver_chave(chave, grafo, chave_mapping):
+    info = nota_referenciada(grafo, chave)
+    return chave_mapping.get(info['chave']) if info is not None else None
+
+
+def _resumir_referencias(grafo):
+    fora = sum(1 for info in grafo['referencias'] if nota_referenciada(grafo, _chave_referenciada(info)) is None)
+    print(f"Referências entre documentos: {len(grafo['referencias']) - fora} ligadas a notas da pasta, "
+          f"{fora} a notas fora dela.")
+
+# --- Planejamento das renomeações ---
+# Os destinos de todas as NFes e eventos são calculados de uma vez, sobre uma fotografia de cada
+# pasta (um único os.scandir), sem consultar o disco arquivo a arquivo. Um destino em uso (por um
+# arquivo que fica onde está ou por outro já planejado, na ordem dos caminhos) recebe o primeiro
+# sufixo livre: "123 - Venda (2).xml", "123 - Venda (3).xml"... Um arquivo que já tem o nome, com
+# ou sem sufixo, é mantido. As renomeações são feitas em lote, em uma ordem em que nenhum destino
+# está ocupado: em uma cadeia (A -> B enquanto B -> C) o fim vai primeiro, e um ciclo (A -> B,
+# B -> A) passa por um nome temporário.
+_SUFIXO_CICLO = '.manipuladorXML-ciclo.xml'
+
+
+# Novos nomes pedidos pelas regras (NFes) e pela regra CAN- (cancelamentos): [(info, novo_nome)]
+def _pedidos_de_renomeacao(nfe_infos, eventos_info, grafo, regras, fixos=()):
+    pedidos = []
+    for info in nfe_infos:
+        novo_nome = _gerar_novo_nome_nfe(info, regras, grafo)
+        if novo_nome and info['caminho_completo'] not in fixos:
+            pedidos.append((info, novo_nome))
+    for evento in eventos_info:
+        nota_cancelada = nota_referenciada(grafo, evento['chave_cancelada'])
+        if nota_cancelada is not None and nota_cancelada['nfe_number'] and evento['caminho_completo'] not in fixos:
+            pedidos.append((evento, f"CAN-{nota_cancelada['nfe_number']}.xml"))
+    return pedidos
+
+
+def _nome_com_sufixo(nome, numero):
+    base, extensao = os.path.splitext(nome)
+    return f"{base} ({numero}){extensao}"
+
+
+# O arquivo já tem o novo nome, com ou sem o sufixo de destino em uso
+def _ja_nomeado(nome_atual, novo_nome):
+    if nome_atual == novo_nome:
+        return True
+    base, extensao = os.path.splitext(novo_nome)
+    return re.fullmatch(re.escape(base) + r' \(\d+\)' + re.escape(extensao), nome_atual) is not None
+
+
+# Nomes em uso em cada pasta: no disco (uma varredura por pasta) ou, com saída externa, entre os
+# nomes de saída (ocupados)
+def _nomes_em_uso(pastas, ocupados=None):
+    if ocupados is None:
+        nomes = {}
+        for pasta in pastas:
+            with os.scandir(pasta) as entradas:
+                nomes[pasta] = {entrada.name for entrada in entradas}
+        return nomes
+    nomes = {pasta: set() for pasta in pastas}
+    for caminho in ocupados:
+        pasta = os.path.dirname(caminho)
+        if pasta in nomes:
+            nomes[pasta].add(os.path.basename(caminho))
+    return nomes
+
+
+# Destino final de cada pedido: [(info, caminho_novo)], em ordem de caminho, e quantos
+# receberam sufixo por o destino estar em uso
+def _planejar_renomeacoes(pedidos, ocupados=None):
+    pedidos = sorted(((info, novo_nome) for info, novo_nome in pedidos
+                      if not _ja_nomeado(os.path.basename(info['caminho_completo']), novo_nome)),
+                     key=lambda pedido: pedido[0]['caminho_completo'])
+    em_uso = _nomes_em_uso({os.path.dirname(info['caminho_completo']) for info, _ in pedidos}, ocupados)
+    # Os nomes atuais dos arquivos renomeados ficam livres para os demais
+    for info, _ in pedidos:
+        em_uso[os.path.dirname(info['caminho_completo'])].discard(os.path.basename(info['caminho_completo']))
+    renomeacoes, com_sufixo = [], 0
+    for info, novo_nome in pedidos:
+        pasta = os.path.dirname(info['caminho_completo'])
+        nomes, destino, numero = em_uso[pasta], novo_nome, 1
+        while destino in nomes:
+            numero += 1
+            destino = _nome_com_sufixo(novo_nome, numero)
+        nomes.add(destino)
+        com_sufixo += numero > 1
+        renomeacoes.append((info, os.path.join(pasta, destino)))
+    return renomeacoes, com_sufixo
+
+
+# Ordena as renomeações [(de, para)] em passos (de, para, origem) executáveis em sequência: cada
+# destino já está livre quando o seu passo chega (em uma cadeia, o fim vai primeiro). O passo
+# intermediário de um ciclo (para o nome temporário) tem origem None. Os passos ficam em uma única
+# lista, sem uma por cadeia: quase toda cadeia tem um só passo. Retorna os passos e quantos ciclos havia.
+def _ordenar_renomeacoes(pares):
+    pendentes = dict(pares)
+    passos, ciclos = [], 0
+    for inicio, _ in pares:
+        if inicio not in pendentes:
+            continue
+        cadeia, destino = [inicio], pendentes[inicio]
+        while destino in pendentes and destino != inicio:
+            cadeia.append(destino)
+            destino = pendentes[destino]
+        if destino == inicio:
+            temporario = inicio + _SUFIXO_CICLO
+            passos.append((inicio, temporario, None))
+            passos.extend((de, pendentes.pop(de), de) for de in reversed(cadeia[1:]))
+            passos.append((temporario, pendentes.pop(inicio), inicio))
+            ciclos += 1
+        else:
+            passos.extend((de, pendentes.pop(de), de) for de in reversed(cadeia))
+    return passos, ciclos
+
+
+# renameat2 da libc do Linux, ou None (outro sistema ou libc antiga)
+_AT_FDCWD = -100
+_RENAME_NOREPLACE = 1
+
+
+@lru_cache(maxsize=None)
+def _renameat2():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        funcao = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return None
+    funcao.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint)
+    return funcao
+
+
+# Renomeia sem nunca substituir o destino (o rename do POSIX substitui sem avisar): renameat2 com
+# RENAME_NOREPLACE no Linux e, sem ele, hardlink no novo nome seguido da remoção do antigo. Só em
+# sistemas de arquivos sem hardlinks resta conferir o destino antes do rename. No Windows o próprio
+# os.rename recusa um destino existente. Levanta FileExistsError quando o destino já existe.
+def _renomear_sem_substituir(de, para):
+    if os.name == 'nt':
+        os.rename(de, para)
+        return
+    renameat2 = _renameat2()
+    if renameat2 is not None:
+        if renameat2(_AT_FDCWD, os.fsencode(de), _AT_FDCWD, os.fsencode(para), _RENAME_NOREPLACE) == 0:
+            return
+        codigo = ctypes.get_errno()
+        if codigo not in (errno.ENOSYS, errno.EINVAL):  # EINVAL: sistema de arquivos sem suporte
+            raise OSError(codigo, os.strerror(codigo), de, None, para)
+    try:
+        os.link(de, para)
+    except FileExistsError:
+        raise
+    except OSError:
+        if os.path.lexists(para):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), de, None, para)
+        os.rename(de, para)
+        return
+    os.unlink(de)
+
+
+# Executa os passos no disco, em ordem. Um passo cujo destino continua ocupado (o arquivo de lá não
+# saiu por um erro, por estar em presos ou por ter surgido depois da listagem) não é feito, para
+# nunca sobrescrever um arquivo. Um nome que só muda maiúsculas e minúsculas em um disco que não as
+# diferencia aponta para o próprio arquivo e é renomeado normalmente.
+# Retorna {origem: caminho_novo} das renomeações feitas e a quantidade de puladas e de erros.
+def _executar_renomeacoes(passos, diario=None, presos=()):
+    presos = set(presos)
+    feitos, total_puladas, total_erros = {}, 0, 0
+    for de, para, origem in passos:
+        if para in presos:
+            presos.add(de)
+            if origem is not None:
+                if _detalhar(1):
+                    print(f"  [PULADO] '{os.path.basename(origem)}': o destino '{os.path.basename(para)}' continua ocupado.")
+                total_puladas += 1
+            continue
+        try:
+            try:
+                _renomear_sem_substituir(de, para)
+            except FileExistsError:
+                if not os.path.samefile(de, para):
+                    raise
+                os.rename(de, para)
+        except FileExistsError:
+            presos.add(de)
+            if origem is not None:
+                if _detalhar(1):
+                    print(f"  [PULADO] '{os.path.basename(origem)}': o destino '{os.path.basename(para)}' já existe.")
+                total_puladas += 1
+            continue
+        except OSError as e:
+            print(f"  [ERRO] Falha ao renomear {os.path.basename(origem or de)}: {e}")
+            presos.add(de)
+            total_erros += 1
+            continue
+        _registrar_renomeacao(diario, de, para)
+        if origem is not None:
+            _registrar_log({'etapa': 'renomear', 'de': origem, 'para': para})
+            if _detalhar(1):
+                print(f"  [OK] {os.path.basename(origem)} -> {os.path.basename(para)}")
+            feitos[origem] = para
+    return feitos, total_puladas, total_erros
+
+
+# O número da nota referenciada vem dela própria quando está no grafo e, senão, da chave do refNFe
+def _gerar_novo_nome_nfe(info, regras=None, grafo=None):
+    candidatas = (regras or _regras_padrao())['nomes'].get(info.get('cfop'))
+    if not candidatas:
+        return ''
     ref_nfe = info.get('ref_nfe')
-    x_texto = info.get('x_texto', '')
-    nfe_number = info.get('nfe_number', '')
-    if cfop in DEVOLUCOES_CFOP and ref_nfe:
-        ref_nfe_num = ref_nfe[25:34].lstrip('0')
-        if nat_op == "Retorno de mercadoria nao entregue":
-            return f"{nfe_number} - Insucesso de entrega da venda {ref_nfe_num}.xml"
-        elif nat_op == "Devolucao de mercadorias":
-            if x_texto and ("DEVOLUTION_PLACES" in x_texto or "SALE_DEVOLUTION" in x_texto):
-                return f"{nfe_number} - Devoluçao pro Mercado Livre da venda - {ref_nfe_num}.xml"
-            elif x_texto and "DEVOLUTION_devolution" in x_texto:
-                return f"{nfe_number} - Devolucao da venda {ref_nfe_num}.xml"
-    elif cfop in VENDAS_CFOP:
-        return f"{nfe_number} - Venda.xml"
-    elif cfop in RETORNOS_CFOP and ref_nfe:
-        ref_nfe_num = ref_nfe[25:34].lstrip('0')
-        if nat_op == "Outras Entradas - Retorno Simbolico de Deposito Temporario":
-            return f"{nfe_number} - Retorno da remessa {ref_nfe_num}.xml"
-        elif nat_op == "Outras Entradas - Retorno de Deposito Temporario":
-            return f"{nfe_number} - Retorno Efetivo da remessa {ref_nfe_num}.xml"
-    elif cfop in REMESSAS_CFOP:
+    nat_op = x_texto = None
+    for exige_ref, nat_op_regra, termos, padrao_x_texto, modelo in candidatas:
+        if exige_ref and not ref_nfe:
+            continue
+        if nat_op_regra is not None:
+            if nat_op is None:
+                nat_op = info.get('nat_op', '')
+            if nat_op != nat_op_regra:
+                continue
+        if termos or padrao_x_texto is not None:
+            if x_texto is None:
+                x_texto = info.get('x_texto', '') or ''
+            if termos:
+                for termo in termos:
+                    if termo in x_texto:
+                        break
+                else:
+                    continue
+            if padrao_x_texto is not None and not padrao_x_texto.search(x_texto):
+                continue
+        numero_referenciado = ''
         if ref_nfe:
-            return f"{nfe_number} - Remessa simbólica da venda {ref_nfe[25:34].lstrip('0')}.xml"
-        else:
-            return f"{nfe_number} - Remessa.xml"
+            referenciada = nota_referenciada(grafo, ref_nfe) if grafo is not None else None
+            numero_referenciado = (referenciada['nfe_number'] if referenciada is not None and referenciada['nfe_number']
+                                   else ref_nfe[25:34].lstrip('0'))
+        return modelo.format(info.get('nfe_number', ''), numero_referenciado)
     return ''
 
-def _renomear_eventos(eventos_info, nfe_infos, folder_path):
-    total_renomeados, total_erros = 0, 0
-    chave_to_nfe_map = {info['chave']: info['nfe_number'] for info in nfe_infos.values()}
-    for evento in eventos_info:
-        chave_cancelada = evento['chave_cancelada']
-        nfe_number_cancelado = chave_to_nfe_map.get(chave_cancelada)
-        if nfe_number_cancelado:
-            novo_nome = f"CAN-{nfe_number_cancelado}.xml"
-            caminho_novo_nome = os.path.join(folder_path, novo_nome)
-            if not os.path.exists(caminho_novo_nome):
-                try:
-                    os.rename(evento['caminho_completo'], caminho_novo_nome)
-                    print(f"  [OK] Evento {os.path.basename(evento['caminho_completo'])} -> {novo_nome}")
-                    total_renomeados += 1
-                except Exception as e:
-                    print(f"  [ERRO] Falha ao renomear evento {os.path.basename(evento['caminho_completo'])}: {e}")
-                    total_erros += 1
-    return {'renomeados': total_renomeados, 'erros': total_erros}
-
 def _resumir_renomeacao(total_renomeados, total_puladas, total_erros):
     print(f"\nResumo: {total_renomeados} renomeados, {total_puladas} pulados, {total_erros} erros.")
     print("====================================================================\n")
 
 
-def editar_arquivos(folder_path, constantes_empresa):
+# Recebe opcionalmente os documentos já carregados pela etapa 1 (mesma pasta).
+# Sem manter_arvores, só os metadados ficam em memória e cada XML é relido no momento da edição.
+# Com saida (ZIP ou pasta de saída), todos os documentos são gravados nela e nenhum original é alterado.
+def editar_arquivos(folder_path, constantes_empresa, documentos=None, workers=1, cache=None, sincronizar=True,
+                    simular=False, manter_arvores=True, recursivo=False, ler_zip=False, saida=None):
     print("\n========== ETAPA 2: MANIPULAÇÃO E EDIÇÃO DOS ARQUIVOS ==========")
-    arquivos = [os.path.join(folder_path, f) for f in os.listdir(folder_path) if f.endswith('.xml')]
-    if not arquivos:
+    if documentos is None:
+        documentos = carregar_documentos(folder_path, workers, manter_arvores, cache, recursivo=recursivo, ler_zip=ler_zip)
+    if not documentos:
         print("Nenhum arquivo XML encontrado na pasta para edição.")
         return
 
     ET.register_namespace('', NS['nfe'])
     ET.register_namespace('ds', NS_DS['ds'])
 
+    contexto = _montar_contexto_edicao(constantes_empresa, sincronizar, simular, saida is not None)
+    if simular:
+        print("Simulação (--dry-run): as alterações são calculadas e listadas, mas nenhum arquivo é gravado.")
+
+    # Fase 1: mapeamentos globais de chaves, construídos antes de qualquer edição
+    inicio = time.perf_counter()
+    chave_mapping, grafo, chave_da_venda_nova = _prepara_mapeamentos(
+        documentos, contexto['alterar_emitente'], contexto['alterar_data'], contexto['execucao'],
+        contexto['regras']['vendas'], zip_somente_leitura=saida is None or saida['tipo'] == 'plano'
+    )
+    _registrar_fase('mapeamentos', inicio, len(documentos))
+    contexto.update(chave_mapping=chave_mapping, grafo=grafo, chave_da_venda_nova=chave_da_venda_nova)
+    _avisar_chaves_invalidas(documentos)
+
+    # Fase 2: edição por arquivo, com gravação atômica e retomada pelo diário
+    diario = abrir_diario(folder_path, 'editar', sincronizar, recursivo) if not simular and saida is None else None
+    total_editados, total_erros, contadores = _executar_edicao(documentos, contexto, workers, cache, diario, saida)
+    fechar_diario(diario)
+    if saida is not None and saida['tipo'] == 'plano':
+        saida.update(chaves=chave_mapping, chave_da_venda_nova=chave_da_venda_nova, contadores=contadores,
+                     erros=total_erros)
+
+    _resumir_cache(cache)
+    print(f"\nResumo: {total_editados} arquivos editados, {total_erros} erros.")
+    _resumir_regras(contadores)
+    print("====================================================================\n")
+
+
+# data_hora é o valor de dhEmi/dhSaiEnt/dhRecbto/dhEvento: a nova data com o horário de início da
+# execução; ano e ano_mes entram nas chaves de acesso e cnpj (só dígitos) é o do novo emitente
+def criar_contexto_execucao(nova_data_str=None, novo_emitente=None, agora=None):
+    data = datetime.strptime(nova_data_str, "%d/%m/%Y") if nova_data_str else None
+    horario = (agora or datetime.now()).strftime("%H:%M:%S")
+    cnpj = (novo_emitente or {}).get('CNPJ')
+    return ContextoExecucao(
+        data=data,
+        data_hora=data.strftime(f'%Y-%m-%dT{horario}-03:00') if data else None,
+        ano=data.strftime('%y') if data else None,
+        ano_mes=data.strftime('%y%m') if data else None,
+        cnpj=_somente_digitos(cnpj) if cnpj is not None else None,
+    )
+
+
+# Flags e valores de edição da empresa (os mapeamentos de chaves são acrescentados depois)
+def _montar_contexto_edicao(constantes_empresa, sincronizar=True, simular=False, saida_externa=False):
     cfg = constantes_empresa.get('alterar', {})
-    alterar_emitente = cfg.get('emitente', False)
-    alterar_produtos = cfg.get('produtos', False)
-    alterar_impostos = cfg.get('impostos', False)
-    alterar_data = cfg.get('data', False)
-    alterar_ref_nfe = cfg.get('refNFe', False)
-    alterar_cst = cfg.get('cst', False)
-    zerar_ipi_remessa_retorno = cfg.get('zerar_ipi_remessa_retorno', False)
-    zerar_ipi_venda = cfg.get('zerar_ipi_venda', False)  # Nova flag
-
-    novo_emitente = constantes_empresa.get('emitente')
-    novo_produto = constantes_empresa.get('produto')
-    novos_impostos = constantes_empresa.get('impostos')
-    nova_data_str = constantes_empresa.get('data', {}).get('nova_data')
-    mapeamento_cst = constantes_empresa.get('mapeamento_cst', {})
-
-    chave_mapping, reference_map, chave_da_venda_nova = _prepara_mapeamentos(arquivos, alterar_emitente, alterar_data, novo_emitente, nova_data_str)
+    return {
+        'alterar_emitente': cfg.get('emitente', False),
+        'alterar_produtos': cfg.get('produtos', False),
+        'alterar_impostos': cfg.get('impostos', False),
+        'alterar_data': cfg.get('data', False),
+        'alterar_ref_nfe': cfg.get('refNFe', False),
+        'alterar_cst': cfg.get('cst', False),
+        'zerar_ipi_remessa_retorno': cfg.get('zerar_ipi_remessa_retorno', False),
+        'zerar_ipi_venda': cfg.get('zerar_ipi_venda', False),
+        'novo_emitente': constantes_empresa.get('emitente'),
+        'novo_produto': constantes_empresa.get('produto'),
+        'novos_impostos': constantes_empresa.get('impostos'),
+        'execucao': criar_contexto_execucao(constantes_empresa.get('data', {}).get('nova_data'),
+                                            constantes_empresa.get('emitente')),
+        'regras': compilar_regras(constantes_empresa),
+        'sincronizar': sincronizar,
+        'simular': simular,
+        'saida_externa': saida_externa,
+        'edicao_em_texto': _edicao_em_texto(constantes_empresa),
+    }
+
+
+# Edita e grava os documentos, contando as alterações por regra (arquivos afetados);
+# retorna (editados, erros, contadores).
+# Em paralelo, cada processo recebe o contexto (com os mapeamentos) somente leitura.
+# Com saida, o conteúdo editado volta ao processo principal, que grava todos os documentos no ZIP.
+def _executar_edicao(documentos, contexto, workers=1, cache=None, diario=None, saida=None):
+    if saida is None or saida['tipo'] == 'plano':
+        # Membros de ZIP sem saída externa: entram nos mapeamentos com a chave atual, mas não são editados
+        editaveis = [documento for documento in documentos if not _membro_de_zip(documento)]
+        if len(editaveis) < len(documentos):
+            print(f"{len(documentos) - len(editaveis)} XMLs de arquivos ZIP usados apenas como referência, com as "
+                  f"chaves atuais (use --zip-saida ou --pasta-saida para gravá-los editados).")
+        documentos = editaveis
+    if diario is not None:
+        pendentes = [documento for documento in documentos if not _ja_concluido(diario, documento['caminho_completo'])]
+        if len(pendentes) < len(documentos):
+            print(f"{len(documentos) - len(pendentes)} arquivos já editados na execução interrompida foram pulados.")
+        documentos = pendentes
+    if workers > 1 and len(documentos) > 1:
+        for documento in documentos:
+            documento['root'] = None
+        resultados = _mapear_em_processos(_editar_documento_em_processo, documentos, workers, contexto)
+    elif _PIPELINE_IO['threads_io'] > 0 and len(documentos) > 1:
+        resultados = _editar_com_pipeline_io(documentos, contexto)
+    else:
+        resultados = (_editar_documento(documento, contexto) for documento in documentos)
 
     total_editados, total_erros = 0, 0
-    for file_path in arquivos:
-        try:
-            parser = ET.XMLParser(target=ET.TreeBuilder(insert_comments=True))
-            tree = ET.parse(file_path, parser)
-            root = tree.getroot()
-            alteracoes, msg = [], ""
-
-            if 'procInutNFe' in root.tag:
-                msg, alteracoes = _editar_inutilizacao(root, alterar_emitente, novo_emitente, alterar_data, nova_data_str)
-            elif 'cteProc' in root.tag or 'CTe' in root.tag:
+    gravados, contadores = [], {}
+    for documento, (msg, alteracoes, erro, info, tempos, conteudo) in zip(documentos, resultados):
+        _registrar_tempos(tempos, documento['caminho_completo'])
+        if saida is not None and not contexto['simular']:
+            _gravar_na_saida(saida, documento, conteudo)
+        if alteracoes:
+            unicas = set(alteracoes)
+            for regra, _ in unicas:
+                contadores[regra] = contadores.get(regra, 0) + 1
+            if _detalhar(1):
+                print(f"\n[OK] {msg}")
+            if _detalhar(2) or _SAIDA['log'] is not None:
+                mensagens = [_mensagem_alteracao(regra, detalhe) for regra, detalhe in sorted(unicas)]
+                if _detalhar(2):
+                    for mensagem in mensagens:
+                        print(f"   - {mensagem}")
+                _registrar_log({'etapa': 'editar', 'arquivo': documento['caminho_completo'], 'alteracoes': mensagens})
+            total_editados += 1
+            if not erro and saida is not None and saida['tipo'] == 'plano':
+                saida['edicoes'].append((documento['caminho_completo'], documento['tipo'], documento.get('origem')))
+            if not erro and not contexto['simular'] and saida is None:
+                _agendar_gravacao(diario, documento['caminho_completo'])
+                documento['info'] = info
+                gravados.append(documento)
+        if erro:
+            print(f"\n[ERRO] {erro}")
+            _registrar_log({'etapa': 'editar', 'arquivo': documento['caminho_completo'], 'erro': erro})
+            total_erros += 1
+    if diario is not None:
+        _confirmar_lote(diario)
+    # Os metadados dos arquivos gravados já refletem as novas chaves na próxima execução
+    if cache is not None:
+        _gravar_cache(cache, gravados)
+    return total_editados, total_erros, contadores
+
+
+# Edita um documento e grava o resultado; retorna (msg, alteracoes, erro, info do arquivo gravado,
+# tempos por fase ou None sem métricas, conteúdo editado quando a saída é um ZIP ou None).
+# dados são os bytes do arquivo já lidos (leitura antecipada); sem gravar, o conteúdo editado é
+# devolvido para ser gravado em segundo plano.
+def _editar_documento(documento, contexto, dados=None, gravar=True):
+    file_path = documento['caminho_completo']
+    msg, alteracoes, conteudo = "", [], None
+    c = contexto
+    tempos = {} if _METRICAS is not None else None
+    inicio = time.perf_counter()
+    try:
+        if documento['erro'] is not None:
+            raise documento['erro']
+        root, tipo = documento['root'], documento['tipo']
+        editado = None
+        # NF-e que só tem textos trocados: edição direto nos bytes, sem montar a árvore
+        if root is None and tipo == 'nfe' and c['edicao_em_texto']:
+            if dados is None:
+                with _abrir_origem(documento.get('origem') or file_path) as f:
+                    dados = f.read()
+            editado = _editar_nfe_em_texto(dados, documento['info'], file_path, c)
+        if editado is not None:
+            msg, alteracoes, info, conteudo = editado
+            inicio = _cronometrar(tempos, 'edicao:nfe-texto', inicio)
+        else:
+            if root is None:
+                if dados is not None:
+                    root = _ler_arvore(io.BytesIO(dados))
+                else:
+                    with _abrir_origem(documento.get('origem') or file_path) as f:
+                        root = _ler_arvore(f)
+                inicio = _cronometrar(tempos, 'parse', inicio)
+            # A árvore não é mais necessária depois da edição deste arquivo
+            documento['root'] = None
+
+            if tipo == 'inutilizacao':
+                msg, alteracoes = _editar_inutilizacao(root, c['alterar_emitente'], c['novo_emitente'], c['alterar_data'], c['execucao'])
+            elif tipo == 'cte':
                 msg, alteracoes = _editar_cte(
-                    root, file_path, chave_mapping,
-                    chave_da_venda_nova=chave_da_venda_nova,
-                    alterar_remetente=cfg.get('emitente', False),
-                    novo_remetente=constantes_empresa.get('emitente'),
-                    alterar_data=alterar_data,
-                    nova_data_str=nova_data_str
+                    root, file_path, c['chave_mapping'],
+                    chave_da_venda_nova=c['chave_da_venda_nova'],
+                    grafo=c['grafo'],
+                    alterar_remetente=c['alterar_emitente'],
+                    novo_remetente=c['novo_emitente'],
+                    alterar_data=c['alterar_data'],
+                    execucao=c['execucao']
                 )
-            elif 'procEventoNFe' in root.tag:
-                alteracoes = _editar_cancelamento(root, chave_mapping, alterar_data, nova_data_str)
-                if alteracoes:
-                    print(f"\n[OK] Evento de Cancelamento: {os.path.basename(file_path)}")
-                    for a in sorted(set(alteracoes)):
-                        print(f"   - {a}")
-                    total_editados += 1
-                    _salvar_xml(root, file_path)
-                continue
+            elif tipo == 'evento':
+                alteracoes = _editar_cancelamento(root, c['chave_mapping'], c['grafo'], c['alterar_data'], c['execucao'])
+                msg = f"Evento de Cancelamento: {os.path.basename(file_path)}"
             else:
                 msg, alteracoes = _editar_nfe(
-                    root, alterar_emitente, novo_emitente, alterar_produtos, novo_produto,
-                    alterar_impostos, novos_impostos, alterar_cst, mapeamento_cst,
-                    zerar_ipi_remessa_retorno, zerar_ipi_venda, alterar_data, nova_data_str,  # Adicionada a nova flag
-                    chave_mapping, alterar_ref_nfe, reference_map
+                    root, c['alterar_emitente'], c['novo_emitente'], c['alterar_produtos'], c['novo_produto'],
+                    c['alterar_impostos'], c['novos_impostos'], c['alterar_cst'], c['regras'],
+                    c['zerar_ipi_remessa_retorno'], c['zerar_ipi_venda'], c['alterar_data'], c['execucao'],
+                    c['chave_mapping'], c['alterar_ref_nfe'], c['grafo']
                 )
 
+            inicio = _cronometrar(tempos, f'edicao:{tipo}', inicio)
+
+            info = documento['info']
             if alteracoes:
-                print(f"\n[OK] {msg}")
-                for a in sorted(set(alteracoes)):
-                    print(f"   - {a}")
-                total_editados += 1
-                _salvar_xml(root, file_path)
+                info = _extrair_info(root, tipo, file_path)
+                inicio = _cronometrar(tempos, 'extracao', inicio)
+                if not c['simular']:
+                    conteudo = _serializar_xml(root)
+                    inicio = _cronometrar(tempos, 'serializacao', inicio)
+        # O original só é substituído quando o lote for confirmado (_agendar_gravacao);
+        # com saída em ZIP, o conteúdo volta para ser gravado pelo processo principal
+        if conteudo is not None and not c['saida_externa'] and gravar:
+            _gravar_texto(_caminho_temporario(file_path), conteudo, c['sincronizar'])
+            _cronometrar(tempos, 'gravacao', inicio)
+            conteudo = None
+    except Exception as e:
+        if not c['saida_externa'] and os.path.exists(_caminho_temporario(file_path)):
+            os.remove(_caminho_temporario(file_path))
+        return msg, alteracoes, f"Falha ao editar {os.path.basename(file_path)}: {e}", None, tempos, None
+    return msg, alteracoes, None, info, tempos, conteudo
 
-        except Exception as e:
-            print(f"\n[ERRO] Falha ao editar {os.path.basename(file_path)}: {e}")
-            total_erros += 1
 
-    print(f"\nResumo: {total_editados} arquivos editados, {total_erros} erros.")
-    print("====================================================================\n")
+# Versão de _editar_documento para os processos do pool
+def _editar_documento_em_processo(documento):
+    return _editar_documento(documento, _CONTEXTO_PROCESSO)
 
 
-def _prepara_mapeamentos(arquivos, alterar_emitente, alterar_data, novo_emitente, nova_data_str):
-    chave_mapping, reference_map = {}, {}
-    chave_da_venda_nova = None
-
-    all_nfe_infos = [get_xml_info(f) for f in arquivos]
-    all_nfe_infos = [info for info in all_nfe_infos if info]
-    nNF_to_key_map = {info['nfe_number']: info['chave'] for info in all_nfe_infos}
-
-    for info in all_nfe_infos:
-        original_key = info['chave']
-        if info['ref_nfe']:
-            referenced_nNF = info['ref_nfe'][25:34].lstrip('0')
-            if referenced_nNF in nNF_to_key_map:
-                reference_map[original_key] = nNF_to_key_map[referenced_nNF]
-        if alterar_emitente or alterar_data:
-            cnpj_original = info.get('emit_cnpj', '')
-            novo_cnpj = novo_emitente.get('CNPJ', cnpj_original) if alterar_emitente else cnpj_original
-            novo_cnpj_num = ''.join(filter(str.isdigit, novo_cnpj))
-            novo_ano_mes = datetime.strptime(nova_data_str, "%d/%m/%Y").strftime('%y%m') if (alterar_data and nova_data_str) else original_key[2:6]
-            
-            resto_da_chave = original_key[20:43]
-            nova_chave_sem_dv = original_key[:2] + novo_ano_mes + novo_cnpj_num.zfill(14) + resto_da_chave
-            nova_chave_com_dv = nova_chave_sem_dv + calcular_dv_chave(nova_chave_sem_dv)
-            chave_mapping[original_key] = nova_chave_com_dv
-
-            if "Venda.xml" in info['caminho_completo']:
-                chave_da_venda_nova = nova_chave_com_dv
-    
-    return chave_mapping, reference_map, chave_da_venda_nova
+# Identifica a nota dentro da chave de acesso: modelo, série, número, tipo de emissão e código
+# numérico (posições 20 a 43). Esses campos não mudam no remapeamento, então chave original e
+# chave nova têm o mesmo identificador (UF, ano/mês, CNPJ e DV ficam de fora).
+def _identificador_nota(chave):
+    return chave[20:43]
+
+
+# Mapeamentos de chaves da edição; o grafo é o mesmo da renomeação quando já existe (monitoramento)
+def _novos_mapeamentos(grafo=None):
+    return {'chave_mapping': {}, 'grafo': novo_grafo() if grafo is None else grafo,
+            'chave_da_venda_nova': None, 'chaves_de_venda': set()}
+
 
+# Monta o grafo dos documentos e o mapeamento chave antiga -> chave nova usados pelos eventos,
+# CT-e e refNFe. chave_da_venda_nova só é definida quando há uma única venda (CFOP do grupo
+# vendas): é a nota referenciada pelos CT-e cuja NFe não está na pasta.
+# Com zip_somente_leitura (sem saída em ZIP ou pasta), as NFes de dentro dos ZIPs, que não são
+# regravadas, mantêm a chave: os eventos, CT-e e refNFe que as citam continuam apontando para ela.
+def _prepara_mapeamentos(documentos, alterar_emitente, alterar_data, execucao, vendas=None,
+                         zip_somente_leitura=False):
+    mapeamentos = _novos_mapeamentos()
+    _extrair_infos_xmls(documentos, mapeamentos['grafo'])
+    _acumular_mapeamentos(mapeamentos, documentos, alterar_emitente, alterar_data, execucao, vendas,
+                          zip_somente_leitura)
+    return mapeamentos['chave_mapping'], mapeamentos['grafo'], mapeamentos['chave_da_venda_nova']
 
-def _editar_inutilizacao(root, alterar_emitente, novo_emitente, alterar_data, nova_data_str):
+
+# Acrescenta aos mapeamentos existentes as NFes dos documentos informados, já incluídos no grafo
+# (usado também pelo modo de monitoramento, que mantém grafo e mapeamentos entre lotes)
+def _acumular_mapeamentos(mapeamentos, documentos, alterar_emitente, alterar_data, execucao, vendas=None,
+                          zip_somente_leitura=False):
+    if not (alterar_emitente or alterar_data):
+        return
+    vendas = _regras_padrao()['vendas'] if vendas is None else vendas
+    chave_mapping = mapeamentos['chave_mapping']
+    # Chaves fora do formato (não numéricas ou com outro tamanho) não são remapeadas; o aviso de
+    # chaves inválidas da etapa de edição aponta os arquivos. NFes que não serão regravadas (fixas)
+    # ficam mapeadas para a própria chave.
+    infos, fixas = [], []
+    for documento in documentos:
+        info = documento['info']
+        if info and info['tipo'] == 'nfe' and _chave_bem_formada(info['chave']):
+            (fixas if zip_somente_leitura and _membro_de_zip(documento) else infos).append(info)
+    # CNPJ e ano/mês novos são os mesmos para todas as notas; sem eles, cada nota mantém os seus
+    novo_cnpj_num = execucao['cnpj'] if alterar_emitente else None
+    if novo_cnpj_num is None:
+        cnpjs = [_somente_digitos(info.get('emit_cnpj', '') or '').zfill(14) for info in infos]
+        # Um CNPJ que não cabe na chave (mais de 14 dígitos) só impede o remapeamento da própria nota
+        invalidos = [info for info, cnpj in zip(infos, cnpjs) if len(cnpj) != 14 or not cnpj.isascii()]
+        if invalidos:
+            print(f"[AVISO] {len(invalidos)} NFe(s) com CNPJ do emitente inválido; a chave de acesso não será alterada:")
+            for info in invalidos[:20]:
+                print(f"  - {os.path.basename(info['caminho_completo'])}: CNPJ {info['emit_cnpj']}")
+            if len(invalidos) > 20:
+                print(f"  ... e mais {len(invalidos) - 20}.")
+            validos = [(info, cnpj) for info, cnpj in zip(infos, cnpjs) if len(cnpj) == 14 and cnpj.isascii()]
+            infos, cnpjs = [info for info, _ in validos], [cnpj for _, cnpj in validos]
+        novo_cnpj_num = cnpjs
+    novas_chaves = gerar_chaves([info['chave'] for info in infos],
+                                execucao['ano_mes'] if alterar_data else None, novo_cnpj_num)
+
+    chaves_de_venda = mapeamentos['chaves_de_venda']
+    for info, nova_chave in zip(infos, novas_chaves):
+        chave_mapping[info['chave']] = nova_chave
+        if info.get('cfop') in vendas:
+            chaves_de_venda.add(nova_chave)
+    for info in fixas:
+        chave_mapping[info['chave']] = info['chave']
+        if info.get('cfop') in vendas:
+            chaves_de_venda.add(info['chave'])
+    mapeamentos['chave_da_venda_nova'] = next(iter(chaves_de_venda)) if len(chaves_de_venda) == 1 else None
+
+
+def _editar_inutilizacao(root, alterar_emitente, novo_emitente, alterar_data, execucao):
     alteracoes, msg = [], f"Inutilização: {root.tag}"
     ano_novo, cnpj_novo = None, None
     if alterar_emitente and novo_emitente:
@@ -402,19 +2315,17 @@ def _editar_inutilizacao(root, alterar_emitente, novo_emitente, alterar_data, no
         if cnpj_tag is not None:
             cnpj_novo = novo_emitente.get('CNPJ')
             cnpj_tag.text = cnpj_novo
-            alteracoes.append("Inutilização: <CNPJ> alterado")
-    if alterar_data and nova_data_str:
-        nova_data_obj = datetime.strptime(nova_data_str, "%d/%m/%Y")
+            alteracoes.append(("Inutilização: <CNPJ> alterado", ''))
+    if alterar_data and execucao and execucao['data']:
         ano_tag = find_element_deep(root, 'inutNFe/infInut/ano')
         if ano_tag is not None:
-            ano_novo = nova_data_obj.strftime('%y')
+            ano_novo = execucao['ano']
             ano_tag.text = ano_novo
-            alteracoes.append("Inutilização: <ano> alterado")
+            alteracoes.append(("Inutilização: <ano> alterado", ''))
         dh_recbto_tag = find_element_deep(root, 'retInutNFe/infInut/dhRecbto')
         if dh_recbto_tag is not None:
-            nova_data_fmt = nova_data_obj.strftime(f'%Y-%m-%dT{datetime.now().strftime("%H:%M:%S")}-03:00')
-            dh_recbto_tag.text = nova_data_fmt
-            alteracoes.append("Inutilização: <dhRecbto> alterado")
+            dh_recbto_tag.text = execucao['data_hora']
+            alteracoes.append(("Inutilização: <dhRecbto> alterado", ''))
 
     inf_inut = find_element_deep(root, 'inutNFe/infInut')
     if inf_inut is not None:
@@ -422,54 +2333,62 @@ def _editar_inutilizacao(root, alterar_emitente, novo_emitente, alterar_data, no
         if id_atual and (ano_novo or cnpj_novo):
             uf = id_atual[2:4]
             ano = ano_novo if ano_novo else id_atual[4:6]
-            cnpj = ''.join(filter(str.isdigit, cnpj_novo)) if cnpj_novo else id_atual[6:20]
+            cnpj = _somente_digitos(cnpj_novo) if cnpj_novo else id_atual[6:20]
             mod, serie = id_atual[20:22], id_atual[22:25]
             nNFIni, nNFFin = id_atual[25:34], id_atual[34:43]
             nova_chave = f"ID{uf}{ano}{cnpj.zfill(14)}{mod}{serie}{nNFIni}{nNFFin}"
             inf_inut.set('Id', nova_chave)
-            alteracoes.append(f"Inutilização: <Id> alterado para {nova_chave}")
+            alteracoes.append(("Inutilização: <Id> alterado para", nova_chave))
     return msg, alteracoes
 
 
-def _editar_cte(root, file_path, chave_mapping, chave_da_venda_nova=None, alterar_remetente=False, novo_remetente=None, alterar_data=False, nova_data_str=None):
+def _editar_cte(root, file_path, chave_mapping, chave_da_venda_nova=None, alterar_remetente=False, novo_remetente=None, alterar_data=False, execucao=None, grafo=None):
     alteracoes, msg = [], f"CTe: {os.path.basename(file_path)}"
     inf_cte = find_element_deep(root, 'infCte')
     if inf_cte is None: return msg, alteracoes
     alterou = False
+    nova_data_fmt = execucao['data_hora'] if alterar_data and execucao else None
     
     id_atual = inf_cte.get('Id')
-    if alterar_data and nova_data_str and id_atual:
+    if nova_data_fmt and id_atual:
         try:
-            uf, ano_novo = id_atual[3:5], datetime.strptime(nova_data_str, "%d/%m/%Y").strftime('%y')
+            uf, ano_novo = id_atual[3:5], execucao['ano']
             cnpj, resto_chave = id_atual[5:19], id_atual[19:43]
             dv_original = id_atual[43]
             nova_chave_sem_dv = f"{uf}{ano_novo}{cnpj}{resto_chave}"
             nova_chave_com_dv = "CTe" + nova_chave_sem_dv + dv_original
             inf_cte.set('Id', nova_chave_com_dv)
-            alteracoes.append(f"Chave de acesso do CTe alterada para: {nova_chave_com_dv}")
+            alteracoes.append(("Chave de acesso do CTe alterada para:", nova_chave_com_dv))
             alterou = True
         except IndexError:
-            alteracoes.append(f"[AVISO] Formato da chave de acesso do CT-e '{id_atual}' inesperado. Chave não alterada.")
+            alteracoes.append(("[AVISO] Formato inesperado da chave de acesso do CT-e, chave não alterada:", id_atual))
 
     ide = find_element(inf_cte, 'ide')
-    if ide is not None and alterar_data and nova_data_str:
+    if ide is not None and nova_data_fmt:
         dh_emi_tag = find_element(ide, 'dhEmi')
         if dh_emi_tag is not None:
-            nova_data_fmt = datetime.strptime(nova_data_str, "%d/%m/%Y").strftime(f'%Y-%m-%dT{datetime.now().strftime("%H:%M:%S")}-03:00')
             dh_emi_tag.text = nova_data_fmt
-            alteracoes.append(f"Data de Emissão <dhEmi> alterada para {nova_data_fmt}")
+            alteracoes.append(("Data de Emissão <dhEmi> alterada para", nova_data_fmt))
             alterou = True
 
     inf_doc = find_element_deep(inf_cte, 'infCTeNorm/infDoc')
     if inf_doc is not None:
         chave_tag = find_element_deep(inf_doc, 'infNFe/chave')
-        if chave_tag is not None and chave_da_venda_nova:
+        # A nota referenciada presente na pasta tem prioridade sobre a chave da venda
+        chave_referenciada = (_resolver_chave(chave_tag.text, grafo, chave_mapping)
+                              if chave_tag is not None and grafo is not None else None)
+        if chave_referenciada:
+            if chave_tag.text != chave_referenciada:
+                chave_tag.text = chave_referenciada
+                alteracoes.append(("Referência de NFe <chave> alterada para:", chave_referenciada))
+                alterou = True
+        elif chave_tag is not None and chave_da_venda_nova:
             if chave_tag.text != chave_da_venda_nova:
                 chave_tag.text = chave_da_venda_nova
-                alteracoes.append(f"Referência de NFe <chave> FORÇADA para a chave da venda: {chave_da_venda_nova}")
+                alteracoes.append(("Referência de NFe <chave> FORÇADA para a chave da venda:", chave_da_venda_nova))
                 alterou = True
         elif not chave_da_venda_nova:
-             alteracoes.append("[AVISO] Nova chave da nota de venda não foi encontrada para referenciar no CT-e.")
+             alteracoes.append(("[AVISO] A NFe referenciada pelo CT-e não está na pasta e não há uma única venda para referenciar.", ''))
 
     if alterar_remetente and novo_remetente:
         rem = find_element(inf_cte, 'rem')
@@ -481,7 +2400,7 @@ def _editar_cte(root, file_path, chave_mapping, chave_da_venda_nova=None, altera
                     tag = find_element(target_element, campo)
                     if tag is not None:
                         tag.text, alterou = str(valor), True
-                        alteracoes.append(f"Remetente: <{campo}> alterado")
+                        alteracoes.append(_regra_campo('Remetente', campo))
     
     # Sincronizar chave do protCTe/infProt/chCTe com a chave do infCte/Id
     prot_cte = find_element_deep(root, 'protCTe/infProt')
@@ -491,79 +2410,69 @@ def _editar_cte(root, file_path, chave_mapping, chave_da_venda_nova=None, altera
             id_sem_prefixo = inf_cte.get('Id')
             if id_sem_prefixo and id_sem_prefixo.startswith('CTe'):
                 chcte_tag.text = id_sem_prefixo[3:]
-                alteracoes.append(f"protCTe/infProt/chCTe sincronizado com infCte/Id: {chcte_tag.text}")
+                alteracoes.append(("protCTe/infProt/chCTe sincronizado com infCte/Id:", chcte_tag.text))
                 alterou = True
 
     # Atualizar dhRecbto do protCTe/infProt para a nova data
-    if prot_cte is not None and alterar_data and nova_data_str:
+    if prot_cte is not None and nova_data_fmt:
         dhrecbto_tag = find_element(prot_cte, 'dhRecbto')
         if dhrecbto_tag is not None:
-            nova_data_fmt = datetime.strptime(nova_data_str, "%d/%m/%Y").strftime(f'%Y-%m-%dT{datetime.now().strftime("%H:%M:%S")}-03:00')
             dhrecbto_tag.text = nova_data_fmt
-            alteracoes.append(f"protCTe/infProt/dhRecbto alterado para {nova_data_fmt}")
+            alteracoes.append(("protCTe/infProt/dhRecbto alterado para", nova_data_fmt))
             alterou = True
 
     return msg, alteracoes if alterou else []
 
 
-def _editar_cancelamento(root, chave_mapping, alterar_data=False, nova_data_str=None):
+def _editar_cancelamento(root, chave_mapping, grafo, alterar_data=False, execucao=None):
     alteracoes = []
     # Atualizar chave de referência chNFe
     chnfe_tag = find_element_deep(root, 'evento/infEvento/chNFe')
     if chnfe_tag is not None and chnfe_tag.text in chave_mapping:
         chnfe_tag.text = chave_mapping[chnfe_tag.text]
-        alteracoes.append(f"chNFe alterado para nova chave: {chnfe_tag.text}")
+        alteracoes.append(("chNFe alterado para nova chave:", chnfe_tag.text))
     # Atualizar data do evento dhEvento
-    if alterar_data and nova_data_str:
+    nova_data_fmt = execucao['data_hora'] if alterar_data and execucao else None
+    if nova_data_fmt:
         dh_evento_tag = find_element_deep(root, 'evento/infEvento/dhEvento')
         if dh_evento_tag is not None:
-            nova_data_fmt = datetime.strptime(nova_data_str, "%d/%m/%Y").strftime(f'%Y-%m-%dT{datetime.now().strftime("%H:%M:%S")}-03:00')
             dh_evento_tag.text = nova_data_fmt
-            alteracoes.append(f"dhEvento alterado para {nova_data_fmt}")
+            alteracoes.append(("dhEvento alterado para", nova_data_fmt))
         # Atualizar data de recebimento dhRecbto (caso exista)
         dhrecbto_tag = find_element_deep(root, 'retEvento/infEvento/dhRecbto')
         if dhrecbto_tag is not None:
             dhrecbto_tag.text = nova_data_fmt
-            alteracoes.append(f"dhRecbto alterado para {nova_data_fmt}")
+            alteracoes.append(("dhRecbto alterado para", nova_data_fmt))
         # Atualizar dhRegEvento do evento de cancelamento
         dhreg_tag = find_element_deep(root, 'retEvento/infEvento/dhRegEvento')
-        if dhreg_tag is not None and alterar_data and nova_data_str:
+        if dhreg_tag is not None:
             dhreg_tag.text = nova_data_fmt
-            alteracoes.append(f"dhRegEvento alterado para {nova_data_fmt}")
+            alteracoes.append(("dhRegEvento alterado para", nova_data_fmt))
     # Garante que chNFe sempre será a nova chave da nota cancelada
     if chnfe_tag is not None:
-        chave_antiga = chnfe_tag.text
-        numero_nota = chave_antiga[25:34]  # Posição do número da nota na chave
-        chave_correta = None
-        for nova_chave in chave_mapping.values():
-            if nova_chave[25:34] == numero_nota:
-                chave_correta = nova_chave
-                break
+        chave_correta = _resolver_chave(chnfe_tag.text, grafo, chave_mapping)
         if chave_correta:
             chnfe_tag.text = chave_correta
-            alteracoes.append(f"chNFe alterado para nova chave encontrada pelo número: {chave_correta}")
+            alteracoes.append(("chNFe alterado para nova chave encontrada pelo número:", chave_correta))
     # Atualiza todas as tags <chNFe> em qualquer nível do evento de cancelamento
     for tag in root.iter():
-        if tag.tag.endswith('chNFe'):
-            chave_antiga = tag.text
-            numero_nota = chave_antiga[25:34] if chave_antiga else None
-            chave_correta = None
-            for nova_chave in chave_mapping.values():
-                if numero_nota and nova_chave[25:34] == numero_nota:
-                    chave_correta = nova_chave
-                    break
+        if isinstance(tag.tag, str) and tag.tag.endswith('chNFe'):
+            chave_correta = _resolver_chave(tag.text, grafo, chave_mapping)
             if chave_correta and tag.text != chave_correta:
                 tag.text = chave_correta
-                alteracoes.append(f"<chNFe> alterado para nova chave encontrada pelo número: {chave_correta}")
+                alteracoes.append(("<chNFe> alterado para nova chave encontrada pelo número:", chave_correta))
     return alteracoes
 
+_CAMPOS_ENDERECO_EMITENTE = ('xLgr', 'nro', 'xCpl', 'xBairro', 'xMun', 'UF', 'fone')
+
+
 def _editar_nfe(
     root, alterar_emitente, novo_emitente, alterar_produtos, novo_produto,
-    alterar_impostos, novos_impostos, alterar_cst, mapeamento_cst,
-    zerar_ipi_remessa_retorno, zerar_ipi_venda, alterar_data, nova_data_str,
-    chave_mapping, alterar_ref_nfe, reference_map
+    alterar_impostos, novos_impostos, alterar_cst, regras,
+    zerar_ipi_remessa_retorno, zerar_ipi_venda, alterar_data, execucao,
+    chave_mapping, alterar_ref_nfe, grafo
 ):
-    alteracoes = []
+    alteracoes, impostos_alterados = [], set()
     inf_nfe = find_element_deep(root, 'infNFe')
     if inf_nfe is None: return "", alteracoes
     msg = f"NFe: {find_element(find_element(inf_nfe, 'ide'), 'nNF').text}"
@@ -574,12 +2483,12 @@ def _editar_nfe(
         if emit is not None:
             ender = find_element(emit, 'enderEmit')
             for campo, valor in novo_emitente.items():
-                target_element = ender if campo in ['xLgr', 'nro', 'xCpl', 'xBairro', 'xMun', 'UF', 'fone'] else emit
+                target_element = ender if campo in _CAMPOS_ENDERECO_EMITENTE else emit
                 if target_element is not None:
                     tag = find_element(target_element, campo)
                     if tag is not None:
                         tag.text = valor
-                        alteracoes.append(f"Emitente: <{campo}> alterado")
+                        alteracoes.append(_regra_campo('Emitente', campo))
 
     for det in find_all_elements(inf_nfe, 'det'):
         prod, imposto = find_element(det, 'prod'), find_element(det, 'imposto')
@@ -588,85 +2497,85 @@ def _editar_nfe(
                 tag = find_element(prod, campo)
                 if tag is not None:
                     tag.text = valor
-                    alteracoes.append(f"Produto: <{campo}> alterado")
+                    alteracoes.append(_regra_campo('Produto', campo))
         if imposto is None: continue
 
         if alterar_impostos and novos_impostos:
             for campo_json, valor in novos_impostos.items():
                 tag = find_element_deep(imposto, campo_json)
-                if tag is not None and f"Imposto: <{campo_json}> alterado" not in alteracoes:
+                # Cada alíquota é aplicada apenas no primeiro item que a possui
+                if tag is not None and campo_json not in impostos_alterados:
                     tag.text = valor
-                    alteracoes.append(f"Imposto: <{campo_json}> alterado")
+                    impostos_alterados.add(campo_json)
+                    alteracoes.append(_regra_campo('Imposto', campo_json))
         
-        cfop_tag = find_element(prod, 'CFOP') if prod else None
+        cfop_tag = find_element(prod, 'CFOP') if prod is not None else None
         if cfop_tag is not None and cfop_tag.text:
             cfop = cfop_tag.text
-            if alterar_cst and cfop in mapeamento_cst:
-                regras_cst = mapeamento_cst[cfop]
-                for imposto_nome, cst_valor in regras_cst.items():
+            regras_cst = regras['cst'].get(cfop) if alterar_cst else None
+            if regras_cst:
+                for imposto_nome, cst_valor in regras_cst:
                     imposto_tag = find_element(imposto, imposto_nome)
-                    if imposto_tag:
+                    if imposto_tag is not None:
                         cst_tag = find_element_deep(imposto_tag, 'CST')
                         if cst_tag is not None:
                             cst_tag.text = cst_valor
-                            alteracoes.append(f"CST do {imposto_nome} alterado")
+                            alteracoes.append(_regra_cst(imposto_nome))
 
             ipi_tag = find_element(imposto, 'IPI')
             if ipi_tag is not None:
-                if zerar_ipi_remessa_retorno and cfop in REMESSAS_CFOP + RETORNOS_CFOP:
+                if zerar_ipi_remessa_retorno and cfop in regras['ipi_remessa_retorno']:
                     for tag_ipi in ['vIPI', 'vBC']:
                         tag = find_element_deep(ipi_tag, tag_ipi)
                         if tag is not None: tag.text = "0.00"
                     tag_pIPI = find_element_deep(ipi_tag, 'pIPI')
                     if tag_pIPI is not None: tag_pIPI.text = "0.0000"
-                    alteracoes.append("Valores de IPI zerados para remessa/retorno")
+                    alteracoes.append(("Valores de IPI zerados para remessa/retorno", ''))
                 
-                if zerar_ipi_venda and cfop in VENDAS_CFOP:
+                if zerar_ipi_venda and cfop in regras['ipi_venda']:
                     for tag_ipi in ['vIPI', 'vBC']:
                         tag = find_element_deep(ipi_tag, tag_ipi)
                         if tag is not None: tag.text = "0.00"
                     tag_pIPI = find_element_deep(ipi_tag, 'pIPI')
                     if tag_pIPI is not None: tag_pIPI.text = "0.0000"
-                    alteracoes.append("Valores de IPI zerados para venda")
+                    alteracoes.append(("Valores de IPI zerados para venda", ''))
 
     if zerar_ipi_remessa_retorno or zerar_ipi_venda:
         _recalcula_totais_ipi(inf_nfe, alteracoes)
 
-    if alterar_data and nova_data_str:
-        nova_data_fmt = datetime.strptime(nova_data_str, "%d/%m/%Y").strftime(f'%Y-%m-%dT{datetime.now().strftime("%H:%M:%S")}-03:00')
+    if alterar_data and execucao and execucao['data_hora']:
+        nova_data_fmt = execucao['data_hora']
         ide = find_element(inf_nfe, 'ide')
-        if ide:
+        if ide is not None:
             for tag_data in ['dhEmi', 'dhSaiEnt']:
                 tag = find_element(ide, tag_data)
                 if tag is not None:
                     tag.text = nova_data_fmt
-                    alteracoes.append(f"Data: <{tag_data}> alterada")
+                    alteracoes.append((f"Data: <{tag_data}> alterada", ''))
         prot_nfe = find_element_deep(root, 'protNFe/infProt')
-        if prot_nfe:
+        if prot_nfe is not None:
             tag_recbto = find_element(prot_nfe, 'dhRecbto')
             if tag_recbto is not None:
                 tag_recbto.text = nova_data_fmt
-                alteracoes.append("Protocolo: <dhRecbto> alterado")
+                alteracoes.append(("Protocolo: <dhRecbto> alterado", ''))
 
     if original_key in chave_mapping:
         nova_chave = chave_mapping[original_key]
         inf_nfe.set('Id', 'NFe' + nova_chave)
-        alteracoes.append(f"Chave de Acesso ID alterada para: {nova_chave}")
+        alteracoes.append(("Chave de Acesso ID alterada para:", nova_chave))
         prot_nfe = find_element_deep(root, 'protNFe/infProt')
-        if prot_nfe:
+        if prot_nfe is not None:
             ch_nfe = find_element(prot_nfe, 'chNFe')
             if ch_nfe is not None:
                 ch_nfe.text = nova_chave
-                alteracoes.append("Chave de Acesso do Protocolo alterada")
+                alteracoes.append(("Chave de Acesso do Protocolo alterada", ''))
 
-    if alterar_ref_nfe and original_key in reference_map:
-        original_referenced_key = reference_map[original_key]
-        if original_referenced_key in chave_mapping:
-            new_referenced_key = chave_mapping[original_referenced_key]
-            ref_nfe_tag = find_element_deep(inf_nfe, 'ide/NFref/refNFe')
-            if ref_nfe_tag is not None:
-                ref_nfe_tag.text = new_referenced_key
-                alteracoes.append(f"Chave de Referência alterada para: {new_referenced_key}")
+    if alterar_ref_nfe:
+        ref_nfe_tag = find_element_deep(inf_nfe, 'ide/NFref/refNFe')
+        new_referenced_key = _resolver_chave(ref_nfe_tag.text, grafo, chave_mapping) if ref_nfe_tag is not None else None
+        if new_referenced_key:
+            ref_nfe_tag.text = new_referenced_key
+            alteracoes.append(("Chave de Referência alterada para:", new_referenced_key))
 
     return msg, alteracoes
 
@@ -697,57 +2606,1225 @@ def _recalcula_totais_ipi(inf_nfe, alteracoes):
 
     if vipi_total_tag is not None:
         vipi_total_tag.text = f"{somas['vIPI']:.2f}"
-        alteracoes.append("Total vIPI recalculado")
+        alteracoes.append(("Total vIPI recalculado", ''))
     if vnf_total_tag is not None:
         vnf_total_tag.text = f"{novo_vnf:.2f}"
-        alteracoes.append("Total vNF recalculado")
+        alteracoes.append(("Total vNF recalculado", ''))
+
+
+# --- Serialização ---
+_TAG_ASSINATURA = f"{{{NS_DS['ds']}}}Signature"
+_DECLARACAO_XML = "<?xml version='1.0' encoding='utf-8'?>"
+_RE_ENTRE_TAGS = re.compile(r'>\s+<')
+_RE_PREFIXO_NS0 = re.compile(r'<(/?)(ns0:)')
+
+
+# Nome serializado de um qname; prefixos novos são atribuídos na ordem de aparição, como no ElementTree
+def _qname_saida(qname, namespaces):
+    if qname[:1] != '{':
+        return qname
+    uri, local = qname[1:].rsplit('}', 1)
+    prefixo = namespaces.get(uri)
+    if prefixo is None:
+        prefixo = ET._namespace_map.get(uri)
+        if prefixo is None:
+            prefixo = f"ns{len(namespaces)}"
+        if prefixo != 'xml':
+            namespaces[uri] = prefixo
+    return f"{prefixo}:{local}" if prefixo else local
+
+
+# Nome final de uma tag: sem os prefixos ds: e ns0: (Signature e CT-e ficam sem prefixo)
+def _nome_tag_saida(tag, namespaces):
+    nome = _qname_saida(tag, namespaces)
+    if nome.startswith('ds:'):
+        return nome[3:]
+    if nome.startswith('ns0:'):
+        return nome[4:]
+    return nome
+
+
+# Declarações de namespace da raiz: xmlns:ds é omitido e xmlns:ns0 do CT-e é removido
+def _declaracoes_namespace(namespaces):
+    partes = []
+    for uri, prefixo in sorted(namespaces.items(), key=lambda item: item[1]):
+        if prefixo == 'ds' and uri == NS_DS['ds']:
+            continue
+        if prefixo == 'ns0' and uri == NS['cte']:
+            partes.append(' ')
+            continue
+        prefixo = ':' + prefixo if prefixo else ''
+        partes.append(f' xmlns{prefixo}="{ET._escape_attrib(uri)}"')
+    return ''.join(partes)
+
+
+# Comentários e instruções de processamento recebem as mesmas regras das tags
+def _texto_especial(texto):
+    texto = texto.replace('<ds:', '<').replace('</ds:', '</')
+    texto = _RE_ENTRE_TAGS.sub('><', texto)
+    return _RE_PREFIXO_NS0.sub(r'<\1', texto)
+
+
+# Acrescenta um elemento já na forma final, descartando textos e tails só com espaços.
+# A abertura da tag ('<nome') é sempre uma parte isolada, para a raiz receber as declarações depois.
+def _serializar_elemento(partes, elem, nomes, namespaces):
+    tag = elem.tag
+    if tag is ET.Comment or tag is _COMENTARIO_LXML:
+        partes.append(_texto_especial(f"<!--{elem.text}-->"))
+    elif tag is ET.ProcessingInstruction:
+        partes.append(_texto_especial(f"<?{elem.text}?>"))
+    elif tag is _PI_LXML:
+        partes.append(_texto_especial(f"<?{elem.target} {elem.text}?>" if elem.text else f"<?{elem.target}?>"))
+    else:
+        nome = nomes.get(tag)
+        if nome is None:
+            nome = nomes[tag] = _nome_tag_saida(tag, namespaces)
+        partes.append('<' + nome)
+        text = elem.text
+        if text and text.isspace():
+            text = ''
+        aberta = elem.text or len(elem)
+        if elem.attrib:
+            partes.append(''.join(f' {_qname_saida(chave, namespaces)}="{ET._escape_attrib(valor)}"'
+                                  for chave, valor in elem.items()))
+        elif aberta and tag == _TAG_ASSINATURA:
+            partes.append(f' xmlns="{NS_DS["ds"]}"')
+        if not len(elem):
+            partes.append(f">{ET._escape_cdata(text)}</{nome}>" if aberta else ' />')
+        else:
+            partes.append('>' + ET._escape_cdata(text) if text else '>')
+            for filho in elem:
+                _serializar_elemento(partes, filho, nomes, namespaces)
+            partes.append(f'</{nome}>')
+    tail = elem.tail
+    if tail and not tail.isspace():
+        partes.append(ET._escape_cdata(tail))
 
 
-def _salvar_xml(root, file_path):
-    main_ns = ''
-    if find_element_deep(root, 'infNFe'):
-        main_ns = NS['nfe']
-        ET.register_namespace('', main_ns)
-    elif find_element_deep(root, 'infCte'):
-        # Para CTe, não registra namespace padrão para evitar ns0:
-        pass
+# Gera o XML final em uma única passada pela árvore, sem pós-processar o texto gerado
+def _serializar_xml(root):
+    ET.register_namespace('', NS['nfe'])
     ET.register_namespace('ds', NS_DS['ds'])
-    xml_str = ET.tostring(root, encoding='utf-8', method='xml', xml_declaration=True).decode('utf-8')
-    xml_str = xml_str.replace(f' xmlns:ds="{NS_DS["ds"]}"', '')
-    xml_str = xml_str.replace('<ds:Signature>', f'<Signature xmlns="{NS_DS["ds"]}">')
-    xml_str = xml_str.replace('</ds:Signature>', '</Signature>')
-    xml_str = xml_str.replace('<ds:', '<').replace('</ds:', '</')
-    xml_str = re.sub(r'>\s+<', '><', xml_str.strip())
-    # Remove ns0: das tags e xmlns:ns0 do root
-    xml_str = re.sub(r'<(/?)(ns0:)', r'<\1', xml_str)
-    xml_str = xml_str.replace('xmlns:ns0="http://www.portalfiscal.inf.br/cte"', '')
+    namespaces = {}
+    partes = [_DECLARACAO_XML]
+    _serializar_elemento(partes, root, {}, namespaces)
+    partes[1] += _declaracoes_namespace(namespaces)
+    return ''.join(partes)
+
+
+def _gravar_texto(file_path, conteudo, sincronizar=False):
     with open(file_path, 'w', encoding='utf-8') as f:
-        f.write(xml_str)
+        f.write(conteudo)
+        if sincronizar:
+            f.flush()
+            os.fsync(f.fileno())
 
-# --- Loop Principal do Programa ---
-if __name__ == "__main__":
-    print("\n==================== INICIANDO GERENCIADOR DE XMLs ====================\n")
-    constantes = carregar_constantes('constantes.json')
-    if constantes:
-        constantes_empresa = selecionar_empresa(constantes)
-        configs = constantes_empresa.get('configuracao_execucao', {})
-        caminhos = constantes_empresa.get('caminhos', {})
-        run_rename = configs.get('processar_e_renomear', False)
-        run_edit = configs.get('editar_arquivos', False)
-        pasta_origem = caminhos.get('pasta_origem')
-        pasta_edicao = caminhos.get('pasta_edicao')
 
+def _escrever_xml(root, file_path, sincronizar=False):
+    _gravar_texto(file_path, _serializar_xml(root), sincronizar)
+
+
+# Grava o XML de forma atômica: temporário na mesma pasta + os.replace
+def _salvar_xml(root, file_path):
+    _escrever_xml(root, _caminho_temporario(file_path))
+    os.replace(_caminho_temporario(file_path), file_path)
+
+# --- Edição da NF-e direto no texto ---
+# Com alterações só de data, emitente, chaves e refNFe (sem produtos, impostos, CST nem IPI zerado),
+# a edição da NF-e troca apenas textos de folhas e o atributo Id do infNFe. Nesses casos o XML não
+# vira árvore: o texto é levado à forma que _serializar_xml produziria (declaração, espaços entre
+# tags e xmlns repetidos), as tags são localizadas com as mesmas regras de find_element e
+# find_element_deep e os novos valores são trocados no lugar. O resultado é idêntico byte a byte
+# ao da edição pela árvore; qualquer XML fora dessa forma (comentários, CDATA, prefixos, outros
+# namespaces, referências numéricas, aspas simples...) é editado pela árvore.
+_ABERTURA_ASSINATURA = f'<Signature xmlns="{NS_DS["ds"]}">'
+_DECLARACAO_NS_NFE = f' xmlns="{NS["nfe"]}"'
+_NOME_XML = r'[A-Za-z_][\w.\-]*'
+_RE_NOME_XML = re.compile(_NOME_XML)
+_RE_DECLARACAO_CODIFICACAO = re.compile(r'encoding\s*=\s*["\']([^"\']*)')
+# Abertura com atributos como _serializar_elemento a escreve: um espaço antes de cada atributo,
+# aspas duplas e nenhum espaço que o parser normalizaria
+_RE_ABERTURA_CANONICA = re.compile(r'<' + _NOME_XML + r'(?: ' + _NOME_XML + r'="[^"\t\n]*")+(?: /)?>')
+_RE_ABERTURA = re.compile(r'<([^\s/>]+)[^>]*>')
+_RE_ID = re.compile(r' Id="([^"]*)"')
+
+
+class _ForaDaFormaCanonica(Exception):
+    pass
+
+
+# Edição em texto ligada na configuração e possível para as alterações da empresa
+def _edicao_em_texto(constantes_empresa):
+    if not constantes_empresa.get('configuracao_execucao', {}).get('edicao_em_texto', False):
+        return False
+    cfg = constantes_empresa.get('alterar', {})
+    return not ((cfg.get('produtos') and constantes_empresa.get('produto'))
+                or (cfg.get('impostos') and constantes_empresa.get('impostos'))
+                or cfg.get('cst') or cfg.get('zerar_ipi_remessa_retorno') or cfg.get('zerar_ipi_venda'))
+
+
+# <x></x> sem nada dentro vira <x /> na serialização (com espaços dentro, vira <x></x>)
+def _tem_elemento_vazio(texto):
+    posicao = texto.find('></')
+    while posicao >= 0:
+        if texto[posicao - 1] != '/' and texto[texto.rfind('<', 0, posicao) + 1] != '/':
+            return True
+        posicao = texto.find('></', posicao + 3)
+    return False
+
+
+# Texto do XML na forma gerada por _serializar_xml, sem a declaração; None se o XML não puder
+# chegar a ela só com as trocas feitas aqui. Como '<' e '>' só aparecem nas tags, boa parte das
+# verificações é uma busca simples no texto inteiro.
+def _xml_canonico(dados):
+    try:
+        texto = dados.decode('utf-8')
+        xml.parsers.expat.ParserCreate(namespace_separator='}').Parse(dados, True)
+    except (UnicodeDecodeError, xml.parsers.expat.ExpatError):
+        return None
+    if texto.startswith('\ufeff'):
+        texto = texto[1:]
+    if texto.startswith('<?xml'):
+        fim = texto.find('?>')
+        codificacao = _RE_DECLARACAO_CODIFICACAO.search(texto, 0, fim)
+        if codificacao and codificacao.group(1).lower() != 'utf-8':
+            return None
+        texto = texto[fim + 2:]
+    if _tem_elemento_vazio(texto):
+        return None
+    texto = _RE_ENTRE_TAGS.sub('><', texto).strip()
+    if ('<!' in texto or '<?' in texto or '<xml:' in texto or '\r' in texto
+            or texto.count('<') != texto.count('>')
+            or texto.count('&') != texto.count('&amp;') + texto.count('&lt;') + texto.count('&gt;')
+            or ' >' in texto or '\n>' in texto or '\t>' in texto
+            or texto.count('/>') != texto.count(' />') or '  />' in texto or '\n />' in texto or '\t />' in texto):
+        return None
+    # O namespace da NF-e é declarado só na raiz, como primeiro atributo; a Signature mantém o seu
+    partes = texto.split(_DECLARACAO_NS_NFE)
+    if len(partes) < 2 or '>' in partes[0] or any(parte.rfind('<') < parte.rfind('>') for parte in partes[:-1]):
+        return None
+    texto = ''.join(partes)
+    if texto.count('xmlns') != texto.count(_ABERTURA_ASSINATURA):
+        return None
+    nome_raiz = _RE_ABERTURA.match(texto).group(1)
+    texto = f'<{nome_raiz}{_DECLARACAO_NS_NFE}{texto[len(nome_raiz) + 1:]}'
+    # Aberturas com atributos (um '=' depois do último '<' está dentro de uma tag)
+    posicao = texto.find('=')
+    while posicao >= 0:
+        inicio = texto.rfind('<', 0, posicao)
+        if inicio > texto.rfind('>', 0, posicao):
+            posicao = texto.find('>', posicao) + 1
+            if not _RE_ABERTURA_CANONICA.fullmatch(texto, inicio, posicao):
+                return None
+        posicao = texto.find('=', posicao + 1)
+    return texto
+
+
+# Elemento que começa em 'inicio': (nome, início, fim da abertura, fim do conteúdo, fim)
+def _elemento_no_texto(texto, inicio):
+    abertura = _RE_ABERTURA.match(texto, inicio)
+    nome, fim_abertura = abertura.group(1), abertura.end()
+    if texto[fim_abertura - 2] == '/':
+        return nome, inicio, fim_abertura, fim_abertura, fim_abertura
+    fechamento = f'</{nome}>'
+    fim_conteudo = texto.find('<', fim_abertura)
+    if not texto.startswith(fechamento, fim_conteudo):
+        fim_conteudo = texto.find(fechamento, fim_conteudo)
+        if _padrao_tag(nome).search(texto, fim_abertura, fim_conteudo):
+            # Outro elemento de mesmo nome dentro deste: o fechamento é achado pela profundidade
+            profundidade = 0
+            for tag in _padrao_tag(nome).finditer(texto, fim_abertura):
+                if not tag.group(1):
+                    profundidade += texto[tag.end() - 2] != '/'
+                elif profundidade:
+                    profundidade -= 1
+                else:
+                    fim_conteudo = tag.start()
+                    break
+    return nome, inicio, fim_abertura, fim_conteudo, fim_conteudo + len(fechamento)
+
+
+@lru_cache(maxsize=None)
+def _padrao_tag(nome):
+    return re.compile(r'<(/?)' + re.escape(nome) + r'(?=[ />])[^>]*>')
+
+
+# Variação de profundidade em um trecho que começa e termina entre tags: '<' só aparece nas tags,
+# '</' só nos fechamentos e '/>' só nas tags vazias
+def _profundidade(texto, inicio, fim):
+    return texto.count('<', inicio, fim) - 2 * texto.count('</', inicio, fim) - texto.count('/>', inicio, fim)
+
+
+# Ocorrências de '<nome' seguidas de espaço, '>' ou '/' (aberturas da tag), em ordem de documento
+def _aberturas_no_texto(texto, nome, inicio, fim):
+    abertura = '<' + nome
+    posicao = texto.find(abertura, inicio, fim)
+    while posicao >= 0:
+        if texto[posicao + len(abertura)] in ' />':
+            yield posicao
+        posicao = texto.find(abertura, posicao + 1, fim)
+
+
+# Filhos diretos com o nome dado, em ordem de documento (a Signature tem outro namespace e nunca é
+# encontrada pelas buscas da NF-e)
+def _filhos_no_texto(texto, elemento, nome):
+    inicio, fim = elemento[2], elemento[3]
+    profundidade = 0
+    for posicao in _aberturas_no_texto(texto, nome, inicio, fim):
+        if posicao < inicio:
+            continue
+        profundidade += _profundidade(texto, inicio, posicao)
+        inicio = posicao
+        if not profundidade and not texto.startswith(_ABERTURA_ASSINATURA, posicao):
+            filho = _elemento_no_texto(texto, posicao)
+            yield filho
+            inicio = filho[4]
+
+
+# Equivalente de _primeiro_por_passos (e de find_element) sobre o texto
+def _primeiro_no_texto(texto, elemento, passos):
+    if elemento is None:
+        return None
+    for filho in _filhos_no_texto(texto, elemento, passos[0]):
+        encontrado = filho if len(passos) == 1 else _primeiro_no_texto(texto, filho, passos[1:])
+        if encontrado is not None:
+            return encontrado
+    return None
+
+
+# Equivalente de find_element_deep sobre o texto: descendentes fora das Signatures
+def _primeiro_profundo_no_texto(texto, elemento, passos, assinaturas):
+    if elemento is None:
+        return None
+    for posicao in _aberturas_no_texto(texto, passos[0], elemento[2], elemento[3]):
+        if any(inicio <= posicao < fim for inicio, fim in assinaturas):
+            continue
+        inicio = _elemento_no_texto(texto, posicao)
+        encontrado = inicio if len(passos) == 1 else _primeiro_no_texto(texto, inicio, passos[1:])
+        if encontrado is not None:
+            return encontrado
+    return None
+
+
+def _desescapar(texto):
+    return texto.replace('&lt;', '<').replace('&gt;', '>').replace('&amp;', '&')
+
+
+# .text de uma folha; o texto só com espaços já foi descartado e não pode ser recuperado
+def _texto_da_folha(texto, elemento):
+    _, _, fim_abertura, fim_conteudo, fim = elemento
+    if fim == fim_abertura:
+        return None
+    conteudo = texto[fim_abertura:fim_conteudo]
+    if not conteudo or '<' in conteudo:
+        raise _ForaDaFormaCanonica()
+    return _desescapar(conteudo)
+
+
+# Folha serializada com o novo texto, como _serializar_elemento a escreveria
+def _folha_com_texto(texto, elemento, valor):
+    nome, inicio, fim_abertura, fim_conteudo, fim = elemento
+    if not isinstance(valor, str) or '<' in texto[fim_abertura:fim_conteudo]:
+        raise _ForaDaFormaCanonica()
+    atributos = texto[inicio + len(nome) + 1:fim_abertura - (3 if fim == fim_abertura else 1)]
+    if not valor:
+        return f'<{nome}{atributos} />'
+    return f'<{nome}{atributos}>{"" if valor.isspace() else ET._escape_cdata(valor)}</{nome}>'
+
+
+# Edita a NF-e sem montar a árvore, com as mesmas regras de _editar_nfe; retorna (msg, alteracoes,
+# info, conteúdo editado ou None) ou None quando o XML precisa ser editado pela árvore
+def _editar_nfe_em_texto(dados, info, file_path, contexto):
+    if info is None:
+        return None
+    texto = _xml_canonico(dados)
+    if texto is None:
+        return None
+    try:
+        return _editar_texto_canonico(texto, info, file_path, contexto)
+    except _ForaDaFormaCanonica:
+        return None
+
+
+def _editar_texto_canonico(texto, info, file_path, c):
+    assinaturas = []
+    posicao = texto.find(_ABERTURA_ASSINATURA)
+    while posicao >= 0:
+        assinaturas.append((posicao, _elemento_no_texto(texto, posicao)[4]))
+        posicao = texto.find(_ABERTURA_ASSINATURA, assinaturas[-1][1])
+    raiz = _elemento_no_texto(texto, 0)
+    inf_nfe = _primeiro_profundo_no_texto(texto, raiz, ('infNFe',), assinaturas)
+    ide = _primeiro_no_texto(texto, inf_nfe, ('ide',))
+    n_nf = _primeiro_no_texto(texto, ide, ('nNF',))
+    id_nfe = _RE_ID.search(texto, inf_nfe[1], inf_nfe[2]) if inf_nfe is not None else None
+    if n_nf is None or id_nfe is None:
+        raise _ForaDaFormaCanonica()
+    msg = f"NFe: {_texto_da_folha(texto, n_nf)}"
+    original_key = _desescapar(id_nfe.group(1))[3:]
+    if info['chave'] != original_key:
+        raise _ForaDaFormaCanonica()
+    # Novo texto de cada folha, pela posição da tag (a última alteração de uma folha prevalece)
+    alteracoes, novos_textos, nova_chave, emit = [], {}, None, None
+
+    if c['alterar_emitente'] and c['novo_emitente']:
+        emit = _primeiro_no_texto(texto, inf_nfe, ('emit',))
+        if emit is not None:
+            ender = _primeiro_no_texto(texto, emit, ('enderEmit',))
+            for campo, valor in c['novo_emitente'].items():
+                target_element = ender if campo in _CAMPOS_ENDERECO_EMITENTE else emit
+                passos = campo.split('/')
+                if not all(_RE_NOME_XML.fullmatch(passo) for passo in passos):
+                    raise _ForaDaFormaCanonica()
+                tag = _primeiro_no_texto(texto, target_element, passos)
+                if tag is not None:
+                    novos_textos[tag[1]] = (tag, valor)
+                    alteracoes.append(_regra_campo('Emitente', campo))
+
+    execucao = c['execucao']
+    alterar_data = c['alterar_data'] and execucao and execucao['data_hora']
+    prot_nfe = None
+    if alterar_data or original_key in c['chave_mapping']:
+        prot_nfe = _primeiro_profundo_no_texto(texto, raiz, ('protNFe', 'infProt'), assinaturas)
+    if alterar_data:
+        for tag_data in ['dhEmi', 'dhSaiEnt']:
+            tag = _primeiro_no_texto(texto, ide, (tag_data,))
+            if tag is not None:
+                novos_textos[tag[1]] = (tag, execucao['data_hora'])
+                alteracoes.append((f"Data: <{tag_data}> alterada", ''))
+        tag_recbto = _primeiro_no_texto(texto, prot_nfe, ('dhRecbto',))
+        if tag_recbto is not None:
+            novos_textos[tag_recbto[1]] = (tag_recbto, execucao['data_hora'])
+            alteracoes.append(("Protocolo: <dhRecbto> alterado", ''))
+
+    if original_key in c['chave_mapping']:
+        nova_chave = c['chave_mapping'][original_key]
+        alteracoes.append(("Chave de Acesso ID alterada para:", nova_chave))
+        ch_nfe = _primeiro_no_texto(texto, prot_nfe, ('chNFe',))
+        if ch_nfe is not None:
+            novos_textos[ch_nfe[1]] = (ch_nfe, nova_chave)
+            alteracoes.append(("Chave de Acesso do Protocolo alterada", ''))
+
+    if c['alterar_ref_nfe']:
+        ref_nfe_tag = _primeiro_profundo_no_texto(texto, inf_nfe, ('ide', 'NFref', 'refNFe'), assinaturas)
+        new_referenced_key = (_resolver_chave(_texto_da_folha(texto, ref_nfe_tag), c['grafo'], c['chave_mapping'])
+                              if ref_nfe_tag is not None else None)
+        if new_referenced_key:
+            novos_textos[ref_nfe_tag[1]] = (ref_nfe_tag, new_referenced_key)
+            alteracoes.append(("Chave de Referência alterada para:", new_referenced_key))
+
+    if not alteracoes:
+        return msg, alteracoes, info, None
+
+    # Trocas em ordem de posição: o Id fica dentro da abertura do infNFe, antes de qualquer folha
+    trocas = [(elemento[1], elemento[4], _folha_com_texto(texto, elemento, valor))
+              for elemento, valor in novos_textos.values()]
+    if nova_chave is not None:
+        trocas.append((id_nfe.start(1), id_nfe.end(1), ET._escape_attrib('NFe' + nova_chave)))
+    partes, posicao = [_DECLARACAO_XML], 0
+    for inicio, fim, novo in sorted(trocas):
+        if inicio < posicao:
+            raise _ForaDaFormaCanonica()
+        partes += [texto[posicao:inicio], novo]
+        posicao = fim
+    partes.append(texto[posicao:])
+
+    # Metadados como _extrair_info_nfe os leria da árvore editada
+    info = InfoNFe(**dict(info))
+    info['caminho_completo'] = file_path
+    if nova_chave is not None:
+        info['chave'] = nova_chave
+    cnpj = _primeiro_no_texto(texto, emit, ('CNPJ',))
+    if cnpj is not None and cnpj[1] in novos_textos:
+        info['emit_cnpj'] = _internar(novos_textos[cnpj[1]][1])
+    ref_nfe_info = _primeiro_profundo_no_texto(texto, ide, ('NFref', 'refNFe'), assinaturas)
+    if ref_nfe_info is not None and ref_nfe_info[1] in novos_textos:
+        info['ref_nfe'] = novos_textos[ref_nfe_info[1]][1]
+    return msg, alteracoes, info, None if c['simular'] else ''.join(partes)
+
+
+# --- Saída externa: ZIP ou pasta de saída ---
+# Com --zip-saida ou --pasta-saida nenhum original é alterado: todos os documentos (editados ou não,
+# já com os nomes da renomeação) são gravados no destino, com os caminhos relativos à pasta
+# processada; os XMLs de cada ZIP de entrada ficam em uma subpasta com o nome dele.
+# O ZIP é montado em um temporário e só substitui o destino ao final, então uma execução
+# interrompida não deixa um ZIP pela metade.
+def abrir_saida_zip(caminho_zip, folder_path):
+    temporario = caminho_zip + _SUFIXO_TEMPORARIO
+    return {
+        'tipo': 'zip',
+        'caminho': caminho_zip,
+        'temporario': temporario,
+        'pasta': folder_path,
+        'zip': zipfile.ZipFile(temporario, 'w', zipfile.ZIP_DEFLATED),
+        'gravados': 0,
+    }
+
+
+# Na pasta de saída cada arquivo é gravado de forma atômica (temporário + os.replace), então uma
+# execução interrompida só deixa arquivos completos. Os XMLs sem alteração não são copiados:
+# viram hardlinks dos originais (ou reflinks/cópias, ver _vincular_arquivo), e repetir a execução
+# com outras constantes sobre a mesma pasta de saída custa só os arquivos editados.
+def abrir_saida_pasta(destino, folder_path, copiar=False, sincronizar=True):
+    os.makedirs(destino, exist_ok=True)
+    _remover_temporarios(destino, recursivo=True)  # Sobras de uma execução interrompida
+    return {
+        'tipo': 'pasta',
+        'caminho': destino,
+        'pasta': folder_path,
+        'copiar': copiar,
+        'sincronizar': sincronizar,
+        'subpastas': set(),
+        'gravados': 0,
+        'vinculos': {'hardlink': 0, 'reflink': 0, 'copia': 0},
+    }
+
+
+def fechar_saida_externa(saida, concluido=True):
+    if saida is None:
+        return
+    if saida['tipo'] == 'plano':
+        if concluido:
+            _gravar_plano(saida)
+        return
+    if saida['tipo'] == 'pasta':
+        vinculos = ', '.join(f"{quantidade} {modo}" for modo, quantidade in saida['vinculos'].items() if quantidade)
+        print(f"{saida['gravados']} XMLs editados gravados em {saida['caminho']}"
+              + (f"; inalterados: {vinculos}." if vinculos else "."))
+        return
+    saida['zip'].close()
+    if not concluido:
+        os.remove(saida['temporario'])
+        return
+    os.replace(saida['temporario'], saida['caminho'])
+    print(f"{saida['gravados']} XMLs gravados em {saida['caminho']}.")
+
+
+# A pasta de saída não pode ficar dentro da pasta processada quando as subpastas são lidas
+# (a próxima execução leria os próprios resultados); retorna a mensagem de erro ou None
+def _validar_pasta_saida(destino, folder_path, recursivo):
+    destino, pasta = os.path.abspath(destino), os.path.abspath(folder_path)
+    if destino == pasta:
+        return "a pasta de saída não pode ser a própria pasta processada."
+    if recursivo and os.path.commonpath([destino, pasta]) == pasta:
+        return "com --recursivo, a pasta de saída não pode ficar dentro da pasta processada."
+    return None
+
+
+def _nome_na_saida(saida, documento):
+    caminho, origem = documento['caminho_completo'], documento.get('origem')
+    if isinstance(origem, tuple):
+        pasta_zip = os.path.splitext(origem[0])[0]
+        relativo = os.path.join(os.path.relpath(pasta_zip, saida['pasta']), os.path.relpath(caminho, origem[0]))
+    else:
+        relativo = os.path.relpath(caminho, saida['pasta'])
+    return relativo.replace(os.sep, '/')
+
+
+_FICLONE = 0x40049409  # ioctl do Linux para reflink
+
+
+# Clona o arquivo por reflink (cópia sob demanda: Btrfs, XFS) quando o sistema de arquivos permite
+def _clonar_arquivo(origem, destino):
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        with open(origem, 'rb') as f_origem, open(destino, 'wb') as f_destino:
+            fcntl.ioctl(f_destino.fileno(), _FICLONE, f_origem.fileno())
+        return True
+    except OSError:
+        return False
+
+
+# Coloca um XML inalterado no destino sem copiar os dados, quando possível: hardlink (mesmo disco),
+# reflink ou, por fim, cópia. Com copiar=True o hardlink não é usado, para que programas que editem
+# o destino no próprio arquivo não alterem também o original. Retorna o modo usado.
+def _vincular_arquivo(origem, destino, copiar=False):
+    if os.path.exists(destino) and os.path.samefile(origem, destino):
+        return 'hardlink'  # Já vinculado por uma execução anterior
+    temporario = _caminho_temporario(destino)
+    modo = None
+    if not copiar:
+        try:
+            os.link(origem, temporario)
+            modo = 'hardlink'
+        except OSError:
+            pass  # Outro disco ou sistema de arquivos sem hardlinks
+    if modo is None:
+        modo = 'reflink' if _clonar_arquivo(origem, temporario) else 'copia'
+        if modo == 'copia':
+            shutil.copyfile(origem, temporario)
+    os.replace(temporario, destino)
+    return modo
+
+
+def _gravar_na_pasta_saida(saida, documento, conteudo):
+    raiz = os.path.abspath(saida['caminho'])
+    destino = os.path.abspath(os.path.join(raiz, *_nome_na_saida(saida, documento).split('/')))
+    if os.path.commonpath([raiz, destino]) != raiz:
+        raise OSError(f"o destino {destino} fica fora da pasta de saída")
+    subpasta = os.path.dirname(destino)
+    if subpasta not in saida['subpastas']:
+        os.makedirs(subpasta, exist_ok=True)
+        saida['subpastas'].add(subpasta)
+    origem = documento.get('origem') or documento['caminho_completo']
+    if conteudo is None and not isinstance(origem, tuple):
+        saida['vinculos'][_vincular_arquivo(origem, destino, saida['copiar'])] += 1
+        return
+    temporario = _caminho_temporario(destino)
+    if conteudo is None:
+        with _abrir_origem(origem) as f_origem, open(temporario, 'wb') as f_destino:
+            shutil.copyfileobj(f_origem, f_destino)
+        saida['vinculos']['copia'] += 1
+    else:
+        _gravar_texto(temporario, conteudo, saida['sincronizar'])
+        saida['gravados'] += 1
+    os.replace(temporario, destino)
+
+
+# Grava um documento no destino: o conteúdo editado ou, sem alterações, o XML original
+def _gravar_na_saida(saida, documento, conteudo=None):
+    inicio = time.perf_counter()
+    try:
+        if saida['tipo'] == 'pasta':
+            _gravar_na_pasta_saida(saida, documento, conteudo)
+        else:
+            if conteudo is None:
+                with _abrir_origem(documento.get('origem') or documento['caminho_completo']) as f:
+                    conteudo = f.read()
+            saida['zip'].writestr(_nome_na_saida(saida, documento), conteudo)
+            saida['gravados'] += 1
+    except (OSError, KeyError, zipfile.BadZipFile) as e:
+        print(f"\n[ERRO] Falha ao gravar {os.path.basename(documento['caminho_completo'])} na saída: {e}")
+        return
+    _registrar_fase('gravacao_saida', inicio, 1)
+
+
+# --- Plano de execução ---
+# Com --plano, renomeação e edição são calculadas em memória (como no --dry-run) e o resultado vai
+# para um arquivo de plano: cada renomeação, cada chave antiga -> nova, os arquivos que serão
+# editados e a contagem de alterações por regra. --aplicar-plano executa o plano depois, sem
+# reler os metadados nem refazer os mapeamentos: as renomeações vêm prontas e só os XMLs que o
+# plano marca como editados são abertos. Arquivos alterados desde o plano (tamanho ou data de
+# modificação diferentes) são recusados. Com extensão .gz o plano é gravado compactado.
+_VERSAO_PLANO = 1
+
+
+def _abrir_arquivo_plano(caminho, modo, compactado):
+    if compactado:
+        return gzip.open(caminho, modo + 't', encoding='utf-8')
+    return open(caminho, modo, encoding='utf-8')
+
+
+# Impressão digital das constantes da empresa: o plano só é aplicado com as mesmas constantes
+def _impressao_constantes(constantes_empresa):
+    return hashlib.sha256(json.dumps(constantes_empresa, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def abrir_plano(caminho_plano, folder_path, constantes_empresa, renomear, editar, recursivo=False, ler_zip=False):
+    return {
+        'tipo': 'plano',
+        'caminho': caminho_plano,
+        'pasta': folder_path,
+        'constantes': _impressao_constantes(constantes_empresa),
+        'etapas': {'renomear': renomear, 'editar': editar},
+        'recursivo': recursivo,
+        'ler_zip': ler_zip,
+        'renomeacoes': [],
+        'edicoes': [],
+        'chaves': {},
+        'chave_da_venda_nova': None,
+        'contadores': {},
+        'erros': 0,
+    }
+
+
+# Caminho relativo à pasta do plano, com o tamanho e a data de modificação do arquivo atual
+def _entrada_do_plano(caminho_atual, *campos):
+    st = os.stat(caminho_atual)
+    return [*campos, st.st_size, st.st_mtime_ns]
+
+
+def _gravar_plano(plano):
+    relativo = lambda caminho: os.path.relpath(caminho, plano['pasta'])  # noqa: E731
+    conteudo = {
+        'versao': _VERSAO_PLANO,
+        'criado_em': datetime.now().isoformat(timespec='seconds'),
+        'pasta': os.path.abspath(plano['pasta']),
+        'constantes': plano['constantes'],
+        'etapas': plano['etapas'],
+        'recursivo': plano['recursivo'],
+        'ler_zip': plano['ler_zip'],
+        'renomeacoes': [_entrada_do_plano(de, relativo(de), relativo(para)) for de, para in plano['renomeacoes']],
+        'edicoes': [_entrada_do_plano(origem or caminho, relativo(caminho), tipo)
+                    for caminho, tipo, origem in plano['edicoes']],
+        'chaves': plano['chaves'],
+        'chave_da_venda_nova': plano['chave_da_venda_nova'],
+        'contadores': plano['contadores'],
+        'erros': plano['erros'],
+    }
+    temporario = _caminho_temporario(plano['caminho'])
+    with _abrir_arquivo_plano(temporario, 'w', plano['caminho'].endswith('.gz')) as f:
+        json.dump(conteudo, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(temporario, plano['caminho'])
+    print(f"Plano gravado em {plano['caminho']}: {len(conteudo['renomeacoes'])} renomeações, "
+          f"{len(conteudo['edicoes'])} arquivos a editar, {len(conteudo['chaves'])} chaves remapeadas.")
+
+
+# Lê e confere um plano; retorna o plano ou None (com a mensagem de erro já impressa)
+def carregar_plano(caminho_plano, constantes_empresa):
+    try:
+        with _abrir_arquivo_plano(caminho_plano, 'r', caminho_plano.endswith('.gz')) as f:
+            plano = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Erro: não foi possível ler o plano '{caminho_plano}': {e}")
+        return None
+    if plano.get('versao') != _VERSAO_PLANO:
+        print(f"Erro: o plano '{caminho_plano}' é de uma versão incompatível ({plano.get('versao')}).")
+        return None
+    if plano.get('constantes') != _impressao_constantes(constantes_empresa):
+        print("Erro: o constantes.json da empresa mudou depois que o plano foi gerado; gere o plano novamente.")
+        return None
+    if not os.path.isdir(plano['pasta']):
+        print(f"Erro: a pasta do plano ('{plano['pasta']}') não existe.")
+        return None
+    return plano
+
+
+def _inalterado_desde_o_plano(caminho, tamanho, mtime_ns):
+    try:
+        st = os.stat(caminho)
+    except OSError:
+        return False
+    return (st.st_size, st.st_mtime_ns) == (tamanho, mtime_ns)
+
+
+# Executa as renomeações do plano, na ordem de _ordenar_renomeacoes; uma renomeação já feita
+# (retomada) é reconhecida e mantida
+def _aplicar_renomeacoes_do_plano(plano, sincronizar=True):
+    print("\n========== ETAPA 1: ORGANIZAÇÃO E RENOMEAÇÃO DOS ARQUIVOS (PLANO) ==========")
+    pasta = plano['pasta']
+    diario = abrir_diario(pasta, 'renomear', sincronizar, plano['recursivo'])
+    total_mantidos, total_erros = 0, 0
+    inicio = time.perf_counter()
+    validas, presos = [], set()
+    for de, para, tamanho, mtime_ns in plano['renomeacoes']:
+        caminho_de, caminho_para = os.path.join(pasta, de), os.path.join(pasta, para)
+        if _inalterado_desde_o_plano(caminho_de, tamanho, mtime_ns):
+            validas.append((caminho_de, caminho_para))
+        # Já renomeado (e talvez editado) por uma aplicação interrompida; a renomeação mantém tamanho e data
+        elif (not os.path.exists(caminho_de) and os.path.exists(caminho_para)) or \
+                _inalterado_desde_o_plano(caminho_para, tamanho, mtime_ns):
+            total_mantidos += 1
+        else:
+            print(f"  [ERRO] {de} não existe mais ou foi alterado depois do plano.")
+            presos.add(caminho_de)
+            total_erros += 1
+    # Um destino ocupado por um arquivo que não sai da pasta neste plano não é sobrescrito
+    saindo = {caminho_de for caminho_de, _ in validas}
+    pares = []
+    for caminho_de, caminho_para in validas:
+        if caminho_para not in saindo and os.path.exists(caminho_para):
+            print(f"  [ERRO] {os.path.relpath(caminho_de, pasta)}: o destino '{os.path.relpath(caminho_para, pasta)}' já existe.")
+            presos.add(caminho_de)
+            total_erros += 1
+        else:
+            pares.append((caminho_de, caminho_para))
+    passos, _ = _ordenar_renomeacoes(pares)
+    feitos, total_puladas, erros = _executar_renomeacoes(passos, diario, presos)
+    fechar_diario(diario)
+    _registrar_fase('renomeacao', inicio, len(feitos))
+    if total_mantidos:
+        print(f"{total_mantidos} renomeações já aplicadas em uma execução interrompida.")
+    _resumir_renomeacao(len(feitos), total_puladas, total_erros + erros)
+
+
+# Edita só os arquivos marcados no plano, com os mapeamentos de chaves gravados nele
+def _aplicar_edicoes_do_plano(plano, constantes_empresa, workers=1, cache=None, sincronizar=True):
+    print("\n========== ETAPA 2: MANIPULAÇÃO E EDIÇÃO DOS ARQUIVOS (PLANO) ==========")
+    ET.register_namespace('', NS['nfe'])
+    ET.register_namespace('ds', NS_DS['ds'])
+    pasta = plano['pasta']
+    contexto = _montar_contexto_edicao(constantes_empresa, sincronizar)
+    # O plano guarda só as chaves: o grafo tem uma nota por chave remapeada
+    grafo = novo_grafo()
+    for antiga in plano['chaves']:
+        _indexar_nota(grafo, InfoNFe(tipo='nfe', caminho_completo=None, chave=antiga))
+    contexto.update(chave_mapping=plano['chaves'], grafo=grafo,
+                    chave_da_venda_nova=plano['chave_da_venda_nova'])
+
+    diario = abrir_diario(pasta, 'editar', sincronizar, plano['recursivo'])
+    documentos, recusados = [], 0
+    for arquivo, tipo, tamanho, mtime_ns in plano['edicoes']:
+        caminho = os.path.join(pasta, arquivo)
+        # Os já gravados por uma aplicação interrompida são pulados por _executar_edicao
+        if not _ja_concluido(diario, caminho) and not _inalterado_desde_o_plano(caminho, tamanho, mtime_ns):
+            print(f"  [ERRO] {arquivo} não existe mais ou foi alterado depois do plano.")
+            recusados += 1
+            continue
+        documentos.append(Documento(caminho_completo=caminho, tipo=tipo, root=None, info=None, erro=None))
+    total_editados, total_erros, contadores = _executar_edicao(documentos, contexto, workers, cache, diario)
+    fechar_diario(diario)
+
+    _resumir_cache(cache)
+    print(f"\nResumo: {total_editados} arquivos editados, {total_erros + recusados} erros "
+          f"(plano: {len(plano['edicoes'])} arquivos).")
+    _resumir_regras(contadores)
+    print("====================================================================\n")
+
+
+def aplicar_plano(caminho_plano, constantes_empresa, workers=1, cache=None, sincronizar=True):
+    plano = carregar_plano(caminho_plano, constantes_empresa)
+    if plano is None:
+        return False
+    print(f"Aplicando o plano {caminho_plano} (gerado em {plano['criado_em']}) na pasta {plano['pasta']}.")
+    if plano['etapas']['renomear']:
+        _aplicar_renomeacoes_do_plano(plano, sincronizar)
+    if plano['etapas']['editar']:
+        _aplicar_edicoes_do_plano(plano, constantes_empresa, workers, cache, sincronizar)
+    return True
+
+
+# --- Modo de monitoramento ---
+# Fotografia (tamanho, mtime) dos XMLs da pasta, obtida com uma única varredura
+def _fotografar_pasta(folder_path):
+    fotografia = {}
+    with os.scandir(folder_path) as entradas:
+        for entrada in entradas:
+            if not entrada.name.endswith('.xml'):
+                continue
+            try:
+                st = entrada.stat()
+            except OSError:
+                continue
+            fotografia[entrada.path] = (st.st_size, st.st_mtime_ns)
+    return fotografia
+
+
+# Monitora a pasta por varredura periódica e processa apenas XMLs novos ou alterados.
+# Um arquivo entra no lote quando tamanho e mtime se repetem entre duas varreduras (escrita
+# concluída); o lote é processado quando não há mais arquivos chegando ou ao atingir max_lote.
+# Os XMLs já presentes no início só alimentam o estado (NFes conhecidas e mapeamentos de chaves),
+# para que eventos e CT-e que cheguem depois ainda sejam resolvidos.
+def monitorar_pasta(folder_path, constantes_empresa, renomear=True, editar=True, intervalo=2.0,
+                    workers=1, cache=None, max_lote=500, max_ciclos=None, sincronizar=True):
+    print("\n========== MONITORAMENTO DA PASTA ==========")
+    print(f"Pasta: {folder_path} (varredura a cada {intervalo}s, Ctrl+C para encerrar)")
+    ET.register_namespace('', NS['nfe'])
+    ET.register_namespace('ds', NS_DS['ds'])
+    contexto = _montar_contexto_edicao(constantes_empresa, sincronizar)
+    grafo = novo_grafo()
+    mapeamentos = _novos_mapeamentos(grafo)
+    args_mapeamento = (contexto['alterar_emitente'], contexto['alterar_data'], contexto['execucao'],
+                       contexto['regras']['vendas'])
+
+    conhecidos = _fotografar_pasta(folder_path)
+    iniciais = carregar_documentos(folder_path, workers, manter_arvores=False, cache=cache, arquivos=conhecidos)
+    _extrair_infos_xmls(iniciais, grafo)
+    _acumular_mapeamentos(mapeamentos, iniciais, *args_mapeamento)
+    print(f"{len(conhecidos)} XMLs existentes registrados; aguardando novos arquivos...")
+
+    totais = {'lotes': 0, 'arquivos': 0, 'renomeados': 0, 'editados': 0, 'erros': 0}
+    aguardando, lote, ciclos = {}, [], 0
+    try:
+        while max_ciclos is None or ciclos < max_ciclos:
+            ciclos += 1
+            time.sleep(intervalo)
+            atual = _fotografar_pasta(folder_path)
+            for caminho in set(conhecidos) - set(atual):
+                del conhecidos[caminho]
+            alterados = {caminho: assinatura for caminho, assinatura in atual.items() if conhecidos.get(caminho) != assinatura}
+            estaveis = [caminho for caminho, assinatura in alterados.items() if aguardando.get(caminho) == assinatura]
+            for caminho in estaveis:
+                conhecidos[caminho] = alterados.pop(caminho)
+            aguardando = alterados
+            lote.extend(estaveis)
+            if lote and (not aguardando or len(lote) >= max_lote):
+                # Os arquivos de cada lote recebem o horário do próprio lote, não o do início do
+                # monitoramento; data e CNPJ novos (e com eles as chaves) não mudam entre lotes
+                contexto['execucao'] = criar_contexto_execucao(constantes_empresa.get('data', {}).get('nova_data'),
+                                                               constantes_empresa.get('emitente'))
+                finais = _processar_lote(lote, folder_path, contexto, mapeamentos, args_mapeamento, grafo,
+                                         renomear, editar, workers, cache, totais)
+                # Só os arquivos do lote, com os nomes e assinaturas finais (após renomear/editar), não
+                # voltam a ser processados; os que ainda aguardam ou chegaram durante o lote ficam
+                # para as próximas varreduras
+                for caminho in finais:
+                    try:
+                        st = os.stat(caminho)
+                    except OSError:
+                        continue
+                    conhecidos[caminho] = (st.st_size, st.st_mtime_ns)
+                lote = []
+    except KeyboardInterrupt:
+        print("\nMonitoramento interrompido pelo usuário.")
+    print(f"\nResumo: {totais['lotes']} lotes, {totais['arquivos']} arquivos, {totais['renomeados']} renomeados, "
+          f"{totais['editados']} editados, {totais['erros']} erros.")
+    print("====================================================================\n")
+
+
+# Processa um lote do monitoramento: renomeia, atualiza os mapeamentos e edita.
+# Retorna os caminhos finais dos arquivos do lote.
+def _processar_lote(arquivos, folder_path, contexto, mapeamentos, args_mapeamento, grafo,
+                    renomear, editar, workers, cache, totais):
+    print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Lote com {len(arquivos)} arquivo(s) novo(s) ou alterado(s).")
+    documentos = carregar_documentos(folder_path, workers, manter_arvores=editar and workers <= 1, cache=cache, arquivos=arquivos)
+    renomeados = erros = editados = 0
+    if renomear:
+        renomeados, _, erros = _renomear_documentos(documentos, folder_path, grafo, cache, regras=contexto['regras'])
+    else:
+        _extrair_infos_xmls(documentos, grafo)
+    _acumular_mapeamentos(mapeamentos, documentos, *args_mapeamento)
+    if editar:
+        _avisar_chaves_invalidas(documentos)
+        contexto.update(mapeamentos)
+        editados, erros_edicao, _ = _executar_edicao(documentos, contexto, workers, cache)
+        erros += erros_edicao
+    totais['lotes'] += 1
+    totais['arquivos'] += len(arquivos)
+    totais['renomeados'] += renomeados
+    totais['editados'] += editados
+    totais['erros'] += erros
+    return [documento['caminho_completo'] for documento in documentos]
+
+
+# --- Execução por empresa ---
+# Etapas a executar: --stage da linha de comando ou as flags de configuracao_execucao
+def _etapas_da_execucao(etapa, configs):
+    if etapa is None:
+        return configs.get('processar_e_renomear', False), configs.get('editar_arquivos', False)
+    return etapa in ('rename', 'both'), etapa in ('edit', 'both')
+
+
+# Executa as etapas de uma empresa, com métricas e perfil opcionais
+def executar_empresa(nome, constantes_empresa, opcoes):
+    print(f"\n-------------------- EMPRESA: {nome} --------------------")
+    log = opcoes.get('log_alteracoes')
+    configurar_saida(opcoes.get('verbosidade', 0),
+                     _caminho_por_empresa(log, nome, opcoes.get('varias_empresas')) if log else None)
+    for destino in ('zip_saida', 'pasta_saida', 'plano', 'aplicar_plano'):
+        if opcoes.get(destino):
+            opcoes = dict(opcoes, **{destino: _caminho_por_empresa(opcoes[destino], nome, opcoes.get('varias_empresas'))})
+    configs = constantes_empresa.get('configuracao_execucao', {})
+    configurar_backend_xml(opcoes.get('backend_xml') or configs.get('backend_xml', 'etree'))
+    configurar_limite_arvores(opcoes['limite_arvores_mb'] if opcoes.get('limite_arvores_mb') is not None
+                              else configs.get('limite_arvores_mb', _LIMITE_ARVORES_MB_PADRAO),
+                              nfe=not _edicao_em_texto(constantes_empresa))
+    # Leitura e gravação em segundo plano: linha de comando > configuracao_execucao > padrão
+    configurar_pipeline_io(**{nome: opcoes[nome] if opcoes.get(nome) is not None else configs.get(nome, padrao)
+                              for nome, padrao in _PIPELINE_IO_PADRAO.items()})
+    if opcoes.get('metricas'):
+        iniciar_metricas()
+    perfil = cProfile.Profile() if opcoes.get('cprofile') else None
+    if perfil is not None:
+        perfil.enable()
+    try:
+        _executar_etapas_empresa(constantes_empresa, opcoes)
+    finally:
+        fechar_saida()
+        if perfil is not None:
+            perfil.disable()
+            caminho = _caminho_por_empresa(opcoes['cprofile'], nome, opcoes.get('varias_empresas'))
+            perfil.dump_stats(caminho)
+            print(f"Perfil cProfile gravado em {caminho}")
+    relatorio = relatorio_metricas(opcoes.get('mais_lentos', 10))
+    if relatorio is not None:
+        imprimir_metricas(relatorio)
+        if opcoes.get('relatorio'):
+            caminho = _caminho_por_empresa(opcoes['relatorio'], nome, opcoes.get('varias_empresas'))
+            with open(caminho, 'w', encoding='utf-8') as f:
+                json.dump(dict(relatorio, empresa=nome), f, ensure_ascii=False, indent=2)
+            print(f"Relatório de métricas gravado em {caminho}")
+
+
+# Com várias empresas, cada uma grava o próprio arquivo: relatorio.json -> relatorio-EMPRESA.json
+# (vale também para o perfil, o registro de alterações, o ZIP ou a pasta de saída e o plano)
+def _caminho_por_empresa(caminho, nome, varias_empresas):
+    if not varias_empresas:
+        return caminho
+    base, extensao = os.path.splitext(caminho)
+    return f"{base}-{nome}{extensao}"
+
+
+# Etapas configuradas de uma empresa; opcoes traz as escolhas da linha de comando
+def _executar_etapas_empresa(constantes_empresa, opcoes):
+    configs = constantes_empresa.get('configuracao_execucao', {})
+    workers = _resolver_workers(opcoes.get('workers'), configs)
+    simular = opcoes.get('simular', False)
+    usar_cache = configs.get('cache_metadados', True) and not opcoes.get('sem_cache')
+    sincronizar = configs.get('sincronizar_disco', True)
+    # Memória limitada: as árvores nunca são mantidas entre as etapas, só os metadados compactos
+    manter_arvores = not (opcoes.get('memoria_limitada') or configs.get('memoria_limitada', False))
+    recursivo = opcoes.get('recursivo') or configs.get('recursivo', False)
+    ler_zip = opcoes.get('ler_zip') or configs.get('ler_zip', False)
+    # Simulação e plano não tocam o disco: o cache só é consultado (a aplicação do plano o atualiza)
+    cache = (abrir_cache_metadados(configs.get('pasta_cache'), opcoes.get('limpar_cache'),
+                                   somente_leitura=simular or bool(opcoes.get('plano')))
+             if usar_cache else None)
+    caminhos = constantes_empresa.get('caminhos', {})
+    run_rename, run_edit = _etapas_da_execucao(opcoes.get('etapa'), configs)
+    pasta_origem = caminhos.get('pasta_origem')
+    pasta_edicao = caminhos.get('pasta_edicao')
+    # Quando as duas etapas usam a mesma pasta, os XMLs são lidos uma única vez
+    mesma_pasta = bool(pasta_origem and pasta_edicao) and os.path.abspath(pasta_origem) == os.path.abspath(pasta_edicao)
+    documentos = None
+    try:
+        regras = compilar_regras(constantes_empresa)
+    except ValueError as e:
+        print(f"Erro: regras inválidas no constantes.json: {e}")
+        fechar_cache_metadados(cache)
+        return
+
+    if opcoes.get('aplicar_plano'):
+        try:
+            aplicar_plano(opcoes['aplicar_plano'], constantes_empresa, workers, cache, sincronizar)
+        finally:
+            fechar_cache_metadados(cache)
+        return
+
+    if opcoes.get('monitorar'):
+        pasta_monitorada = pasta_edicao if run_edit else pasta_origem
+        if run_rename and run_edit and not mesma_pasta:
+            print("Erro: o modo --monitorar exige que 'pasta_origem' e 'pasta_edicao' sejam a mesma pasta.")
+        elif pasta_monitorada and os.path.isdir(pasta_monitorada):
+            monitorar_pasta(pasta_monitorada, constantes_empresa, renomear=run_rename, editar=run_edit,
+                            intervalo=opcoes.get('intervalo', 2.0), workers=workers, cache=cache, sincronizar=sincronizar)
+        else:
+            print(f"Erro: Caminho da pasta monitorada ('{pasta_monitorada}') é inválido ou não definido.")
+        run_rename = run_edit = False
+
+    saida = None
+    pasta_destino = opcoes.get('pasta_saida') or caminhos.get('pasta_saida')
+    destinos = [destino for destino in (opcoes.get('zip_saida'), pasta_destino, opcoes.get('plano')) if destino]
+    if destinos and (run_rename or run_edit) and not simular:
+        pasta_processada = pasta_edicao if run_edit else pasta_origem
+        erro_destino = None
+        if run_rename and run_edit and not mesma_pasta:
+            erro_destino = "com saída em ZIP, pasta de saída ou plano, 'pasta_origem' e 'pasta_edicao' devem ser a mesma pasta."
+        elif len(destinos) > 1:
+            erro_destino = "escolha apenas um destino: ZIP, pasta de saída ou plano."
+        elif pasta_destino and pasta_processada:
+            erro_destino = _validar_pasta_saida(pasta_destino, pasta_processada, recursivo)
+        if erro_destino:
+            print(f"Erro: {erro_destino}")
+            run_rename = run_edit = False
+        elif pasta_processada and os.path.isdir(pasta_processada):
+            if opcoes.get('plano'):
+                saida = abrir_plano(opcoes['plano'], pasta_processada, constantes_empresa, run_rename, run_edit,
+                                    recursivo, ler_zip)
+                print(f"Plano: {opcoes['plano']} (nenhum arquivo será alterado; aplique com --aplicar-plano).")
+            elif opcoes.get('zip_saida'):
+                saida = abrir_saida_zip(opcoes['zip_saida'], pasta_processada)
+                print(f"Saída em ZIP: {opcoes['zip_saida']} (os arquivos originais não serão alterados).")
+            else:
+                copiar = opcoes.get('copiar_inalterados') or configs.get('copiar_inalterados', False)
+                saida = abrir_saida_pasta(pasta_destino, pasta_processada, copiar, sincronizar)
+                print(f"Pasta de saída: {pasta_destino} (os arquivos originais não serão alterados).")
+
+    concluido = False
+    try:
         if run_rename:
             if pasta_origem and os.path.isdir(pasta_origem):
-                processar_arquivos(pasta_origem)
+                documentos = processar_arquivos(pasta_origem, workers=workers,
+                                                manter_arvores=mesma_pasta and run_edit and manter_arvores, cache=cache,
+                                                sincronizar=sincronizar, simular=simular, recursivo=recursivo,
+                                                ler_zip=ler_zip, saida=saida, regras=regras)
+                # Só a renomeação: o destino recebe os XMLs originais com os novos nomes
+                if saida is not None and saida['tipo'] != 'plano' and not run_edit:
+                    for documento in documentos or ():
+                        _gravar_na_saida(saida, documento)
             else:
                 print(f"Erro: Caminho da 'pasta_origem' ('{pasta_origem}') é inválido ou não definido.")
-        
+
         if run_edit:
             if pasta_edicao and os.path.isdir(pasta_edicao):
                 print(f"Pasta de edição selecionada: {pasta_edicao}")
-                editar_arquivos(pasta_edicao, constantes_empresa)
+                # No plano as edições são só calculadas, como na simulação
+                planejar = saida is not None and saida['tipo'] == 'plano'
+                editar_arquivos(pasta_edicao, constantes_empresa, documentos if mesma_pasta else None, workers=workers,
+                                cache=cache, sincronizar=sincronizar, simular=simular or planejar,
+                                manter_arvores=manter_arvores, recursivo=recursivo, ler_zip=ler_zip, saida=saida)
             else:
                 print(f"Erro: Caminho da 'pasta_edicao' ('{pasta_edicao}') é inválido ou não definido.")
-            
-    print("\n==================== PROCESSAMENTO FINALIZADO ====================\n")
\ No newline at end of file
+        concluido = True
+    finally:
+        fechar_saida_externa(saida, concluido)
+        _fechar_zips()
+        fechar_cache_metadados(cache)
+
+
+# Agrupa empresas que compartilham alguma pasta: cada grupo roda em sequência,
+# grupos diferentes podem rodar ao mesmo tempo
+def _agrupar_por_pasta(empresas, constantes):
+    grupos = []
+    for nome in empresas:
+        caminhos = constantes[nome].get('caminhos', {})
+        pastas = {os.path.abspath(p) for p in (caminhos.get('pasta_origem'), caminhos.get('pasta_edicao')) if p}
+        nomes = [nome]
+        for grupo in [g for g in grupos if g[0] & pastas]:
+            grupos.remove(grupo)
+            pastas |= grupo[0]
+            nomes += grupo[1]
+        grupos.append((pastas, sorted(nomes, key=empresas.index)))
+    return [nomes for _, nomes in grupos]
+
+
+# Executa um grupo de empresas em um processo próprio. A saída é devolvida para ser impressa
+# de uma vez, sem misturar linhas de empresas diferentes; retorna (saida, houve_falha).
+def _executar_grupo_em_processo(nomes, constantes, opcoes):
+    saida, falhou = io.StringIO(), False
+    with redirect_stdout(saida):
+        for nome in nomes:
+            try:
+                executar_empresa(nome, constantes[nome], opcoes)
+            except Exception:
+                print(f"\n[ERRO] Falha inesperada na empresa {nome}:\n{traceback.format_exc()}")
+                falhou = True
+    return saida.getvalue(), falhou
+
+
+# Executa as empresas escolhidas; com mais de uma, os grupos de pastas independentes
+# rodam em processos simultâneos. Retorna False se alguma empresa falhou.
+def executar_empresas(empresas, constantes, opcoes):
+    if len(empresas) == 1:
+        executar_empresa(empresas[0], constantes[empresas[0]], opcoes)
+        return True
+    grupos = _agrupar_por_pasta(empresas, constantes)
+    print(f"{len(empresas)} empresas em {len(grupos)} grupo(s) de pastas independentes.")
+    if opcoes.get('limpar_cache'):
+        # O cache pode ser compartilhado entre empresas: é apagado uma vez, antes de todas
+        for nome in empresas:
+            configs = constantes[nome].get('configuracao_execucao', {})
+            fechar_cache_metadados(abrir_cache_metadados(configs.get('pasta_cache'), limpar=True))
+        opcoes = dict(opcoes, limpar_cache=False)
+    sucesso = True
+    with ProcessPoolExecutor(max_workers=len(grupos)) as executor:
+        futuros = [executor.submit(_executar_grupo_em_processo, nomes, constantes, opcoes) for nomes in grupos]
+        for futuro in as_completed(futuros):
+            saida, falhou = futuro.result()
+            print(saida, end='')
+            sucesso = sucesso and not falhou
+    return sucesso
+
+
+# --- Loop Principal do Programa ---
+if __name__ == "__main__":
+    print("\n==================== INICIANDO GERENCIADOR DE XMLs ====================\n")
+    parser = argparse.ArgumentParser(description="Manipulador de XMLs NFe, CT-e e Inutilização")
+    parser.add_argument('--config', default=None,
+                        help="Arquivo de constantes (padrão: constantes.json do diretório atual ou da pasta do script).")
+    parser.add_argument('--empresa', action='append', metavar='NOME',
+                        help="Empresa a processar (pode ser repetido). Sem esta opção, a empresa é perguntada.")
+    parser.add_argument('--all-empresas', '--todas-empresas', dest='todas_empresas', action='store_true',
+                        help="Processa todas as empresas do arquivo de constantes.")
+    parser.add_argument('--stage', '--etapa', dest='etapa', choices=('rename', 'edit', 'both'), default=None,
+                        help="Etapas a executar. Sobrepõe processar_e_renomear/editar_arquivos da configuração.")
+    parser.add_argument('--dry-run', '--simular', dest='simular', action='store_true',
+                        help="Mostra o que seria renomeado e editado, sem alterar nenhum arquivo.")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Número de processos paralelos (0 = todos os núcleos). Sobrepõe configuracao_execucao.workers.")
+    parser.add_argument('--sem-cache', action='store_true', help="Ignora o cache persistente de metadados nesta execução.")
+    parser.add_argument('--limpar-cache', action='store_true', help="Apaga o cache persistente de metadados antes de processar.")
+    parser.add_argument('--monitorar', '--watch', action='store_true',
+                        help="Permanece em execução e processa apenas os XMLs que chegarem na pasta.")
+    parser.add_argument('--intervalo', type=float, default=2.0, help="Segundos entre as varreduras do modo --monitorar.")
+    parser.add_argument('--metricas', action='store_true',
+                        help="Mostra tempo e arquivos/s por fase, arquivos mais lentos e pico de memória.")
+    parser.add_argument('--relatorio-metricas', metavar='ARQUIVO.json', default=None,
+                        help="Grava as métricas em JSON (liga --metricas).")
+    parser.add_argument('--mais-lentos', type=int, default=10, help="Quantidade de arquivos mais lentos no relatório.")
+    parser.add_argument('--cprofile', metavar='ARQUIVO.prof', default=None,
+                        help="Grava um perfil cProfile do processo principal (abra com pstats ou snakeviz).")
+    parser.add_argument('--recursivo', action='store_true', help="Inclui os XMLs das subpastas (cada um é renomeado na própria pasta).")
+    parser.add_argument('--ler-zip', action='store_true',
+                        help="Lê os XMLs de dentro dos arquivos ZIP da pasta, sem extraí-los.")
+    parser.add_argument('--zip-saida', metavar='ARQUIVO.zip', default=None,
+                        help="Grava todos os XMLs (renomeados e editados) em um novo ZIP, sem alterar os originais.")
+    parser.add_argument('--pasta-saida', metavar='PASTA', default=None,
+                        help="Grava os XMLs renomeados e editados em outra pasta, sem alterar os originais "
+                             "(os inalterados viram hardlinks). Sobrepõe caminhos.pasta_saida.")
+    parser.add_argument('--copiar-inalterados', action='store_true',
+                        help="Na pasta de saída, copia (ou clona por reflink) os XMLs inalterados em vez de usar hardlinks.")
+    parser.add_argument('--plano', metavar='ARQUIVO.json', default=None,
+                        help="Calcula renomeações e edições sem alterar nenhum arquivo e grava o plano (.gz para compactar).")
+    parser.add_argument('--aplicar-plano', metavar='ARQUIVO.json', default=None,
+                        help="Executa um plano gerado por --plano, sem reler os metadados dos XMLs.")
+    parser.add_argument('--memoria-limitada', action='store_true',
+                        help="Mantém em memória só os metadados compactos; cada XML é relido na edição (pastas muito grandes).")
+    parser.add_argument('--limite-arvores-mb', type=float, default=None,
+                        help=f"MB de XML cujas árvores ficam em memória entre a renomeação e a edição; os demais "
+                             f"arquivos são relidos na edição (padrão {_LIMITE_ARVORES_MB_PADRAO}).")
+    parser.add_argument('--backend-xml', choices=_BACKENDS_XML, default=None,
+                        help="Biblioteca das árvores XML: etree (ElementTree, padrão) ou lxml (se instalado).")
+    parser.add_argument('--threads-io', type=int, default=None,
+                        help="Threads de leitura antecipada e de gravação em segundo plano na edição sequencial "
+                             "(0 = desligado, padrão). Útil em pastas de rede ou discos lentos.")
+    parser.add_argument('--fila-leitura', type=int, default=None,
+                        help="Máximo de arquivos lidos à frente da edição (padrão 64).")
+    parser.add_argument('--fila-gravacao', type=int, default=None,
+                        help="Máximo de arquivos editados aguardando gravação (padrão 64).")
+    parser.add_argument('-v', '--verbose', dest='verbosidade', action='count', default=0,
+                        help="-v lista cada arquivo renomeado/editado; -vv também cada alteração. "
+                             "Sem a opção, apenas resumos e erros.")
+    parser.add_argument('--log-alteracoes', metavar='ARQUIVO.jsonl', default=None,
+                        help="Acrescenta as renomeações e alterações de cada arquivo em JSONL.")
+    args = parser.parse_args()
+    constantes = carregar_constantes(args.config or _caminho_constantes_padrao())
+    sucesso = constantes is not None
+    if constantes:
+        empresas = _resolver_empresas(constantes, args.empresa, args.todas_empresas)
+        if not empresas:
+            sucesso = False
+        elif args.monitorar and len(empresas) > 1:
+            print("Erro: o modo --monitorar acompanha uma única empresa por vez.")
+            sucesso = False
+        elif args.monitorar and args.simular:
+            print("Erro: o modo --monitorar não pode ser combinado com --dry-run.")
+            sucesso = False
+        elif args.zip_saida and (args.monitorar or args.simular):
+            print("Erro: --zip-saida não pode ser combinado com --monitorar ou --dry-run.")
+            sucesso = False
+        elif args.pasta_saida and args.monitorar:
+            print("Erro: --pasta-saida não pode ser combinado com --monitorar.")
+            sucesso = False
+        elif (args.plano or args.aplicar_plano) and (args.monitorar or args.simular or args.zip_saida or args.pasta_saida):
+            print("Erro: --plano e --aplicar-plano não podem ser combinados com --monitorar, --dry-run, "
+                  "--zip-saida ou --pasta-saida.")
+            sucesso = False
+        elif args.plano and args.aplicar_plano:
+            print("Erro: use --plano e --aplicar-plano em execuções separadas.")
+            sucesso = False
+        else:
+            opcoes = {
+                'workers': args.workers,
+                'sem_cache': args.sem_cache,
+                'limpar_cache': args.limpar_cache,
+                'etapa': args.etapa,
+                'simular': args.simular,
+                'monitorar': args.monitorar,
+                'intervalo': args.intervalo,
+                'metricas': args.metricas or bool(args.relatorio_metricas),
+                'relatorio': args.relatorio_metricas,
+                'mais_lentos': args.mais_lentos,
+                'cprofile': args.cprofile,
+                # A simulação existe para conferir as alterações: lista tudo
+                'verbosidade': 2 if args.simular else args.verbosidade,
+                'log_alteracoes': args.log_alteracoes,
+                'memoria_limitada': args.memoria_limitada,
+                'limite_arvores_mb': args.limite_arvores_mb,
+                'backend_xml': args.backend_xml,
+                'threads_io': args.threads_io,
+                'fila_leitura': args.fila_leitura,
+                'fila_gravacao': args.fila_gravacao,
+                'recursivo': args.recursivo,
+                'ler_zip': args.ler_zip,
+                'zip_saida': args.zip_saida,
+                'pasta_saida': args.pasta_saida,
+                'copiar_inalterados': args.copiar_inalterados,
+                'plano': args.plano,
+                'aplicar_plano': args.aplicar_plano,
+                'varias_empresas': len(empresas) > 1,
+            }
+            sucesso = executar_empresas(empresas, constantes, opcoes)
+
+    print("\n==================== PROCESSAMENTO FINALIZADO ====================\n")
+    sys.exit(0 if sucesso else 1)